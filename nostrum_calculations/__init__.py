@@ -7,3 +7,15 @@ from . import nord4
 from . import mn5
 from . import bright
 from . import tricks
+from . import workflows
+from . import staging
+from . import logs
+from . import markers
+from . import profiles
+from . import submission
+from . import status
+from . import manifest
+from . import telemetry
+from . import sizing
+from . import report
+from . import dispatch
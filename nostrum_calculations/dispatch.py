@@ -0,0 +1,313 @@
+import math
+
+from . import amd
+from . import bright
+from . import cte_power
+from . import local
+from . import marenostrum
+from . import minotauro
+from . import mn5
+from . import nord3
+from . import nord4
+from . import profiles
+from . import markers
+from . import manifest
+
+# Modules generating the scripts of each cluster
+cluster_modules = {
+    "amd": amd,
+    "bright": bright,
+    "cte_power": cte_power,
+    "marenostrum": marenostrum,
+    "minotauro": minotauro,
+    "mn5": mn5,
+    "nord3": nord3,
+    "nord4": nord4,
+    "local": local,
+}
+
+
+def _clusterRates(clusters, job_time=None):
+    """
+    Returns the running tasks, time per job (minutes), queue wait (minutes), job cap
+    and cost per task-hour of each cluster profile (see dispatchJobs()).
+    """
+
+    rates = {}
+    for cluster, profile in clusters.items():
+        if cluster not in cluster_modules:
+            raise ValueError(
+                "Unknown cluster "
+                + cluster
+                + ". Available clusters are: "
+                + ", ".join(cluster_modules)
+            )
+        options = profile.get("options", {})
+        partition = options.get("partition")
+
+        time = profile.get("job_time", job_time)
+        if time == None or time <= 0:
+            raise ValueError("The time per job of " + cluster + " must be given")
+
+        capacity = profile.get("capacity")
+        if capacity == None:
+            if cluster == "local":
+                capacity = options.get("cpus")
+            elif partition in profiles.cluster_profiles.get(cluster, {}):
+                capacity = profiles.arrayThrottle(
+                    cluster,
+                    partition,
+                    cpus=profile.get("cpus", 1),
+                    gpus=profile.get("gpus", 0),
+                )
+        if capacity == None:
+            raise ValueError(
+                "The capacity of " + cluster + " must be given (or its partition)"
+            )
+
+        wait = profile.get("queue_wait")
+        if wait == None:
+            wait = profiles.queue_wait_hours.get(cluster, {}).get(partition, 0)
+
+        max_jobs = math.inf
+        if profile.get("budget") != None:
+            max_jobs = int(profile["budget"] * 60 / time)
+
+        rates[cluster] = {
+            "capacity": capacity,
+            "job_time": time,
+            "queue_wait": wait * 60,
+            "max_jobs": max_jobs,
+            "cost": profile.get("cost", 0),
+        }
+
+    return rates
+
+
+def throughputPlan(n_jobs, clusters, job_time=None):
+    """
+    Splits a number of jobs across clusters so the campaign finishes in the shortest
+    wall time. Each cluster gets jobs in proportion to its throughput (running tasks
+    over time per job) once its queue wait has passed, without exceeding its budget.
+
+    Parameters
+    ==========
+    n_jobs : int
+        Number of jobs of the campaign.
+    clusters : dict
+        Capacity and cost profile of each cluster (see dispatchJobs()).
+    job_time : float
+        Time per job (minutes) of the clusters without a job_time in their profile.
+
+    Returns
+    =======
+    plan : dict
+        Dictionary with the clusters as keys and dictionaries with the keys "jobs",
+        "finish" (estimated hours until the last job finishes) and "cost" as values.
+    """
+
+    rates = _clusterRates(clusters, job_time=job_time)
+
+    max_jobs = sum([r["max_jobs"] for r in rates.values()])
+    if max_jobs < n_jobs:
+        raise ValueError(
+            "The budgets of the clusters only cover " + str(max_jobs) + " jobs"
+        )
+
+    def _jobs(finish):
+        shares = {}
+        for cluster, r in rates.items():
+            share = (finish - r["queue_wait"]) * r["capacity"] / r["job_time"]
+            shares[cluster] = min(max(share, 0), r["max_jobs"])
+        return shares
+
+    # Bisect the finish time at which the clusters cover all the jobs
+    low = 0.0
+    high = max([r["queue_wait"] for r in rates.values()]) + min(
+        [r["job_time"] * n_jobs / r["capacity"] for r in rates.values()]
+    )
+    while sum(_jobs(high).values()) < n_jobs:
+        high *= 2
+    for i in range(100):
+        middle = (low + high) / 2
+        if sum(_jobs(middle).values()) < n_jobs:
+            low = middle
+        else:
+            high = middle
+    shares = _jobs(high)
+
+    # Round the shares, giving the remaining jobs to the largest remainders
+    counts = {c: min(int(s), rates[c]["max_jobs"]) for c, s in shares.items()}
+    remainders = sorted(
+        shares, key=lambda c: shares[c] - int(shares[c]), reverse=True
+    )
+    while sum(counts.values()) < n_jobs:
+        for cluster in remainders:
+            if sum(counts.values()) == n_jobs:
+                break
+            if counts[cluster] < rates[cluster]["max_jobs"]:
+                counts[cluster] += 1
+
+    plan = {}
+    for cluster, n in counts.items():
+        r = rates[cluster]
+        waves = math.ceil(n / r["capacity"])
+        plan[cluster] = {
+            "jobs": n,
+            "finish": (r["queue_wait"] + waves * r["job_time"]) / 60 if n else 0.0,
+            "cost": n * r["job_time"] / 60 * r["cost"],
+        }
+
+    return plan
+
+
+def dispatchJobs(
+    jobs,
+    clusters,
+    job_time=None,
+    script_prefix="campaign",
+    manifest_db="campaign_manifest.db",
+    marker_folder="completion_markers",
+):
+    """
+    Splits a job list across clusters (see throughputPlan()) and writes the scripts
+    of each cluster with its module (jobArrays() of the cluster modules, or
+    local.parallel()). All the jobs are recorded in one SQLite campaign manifest and
+    write completion markers into the same folder, so the progress of the whole
+    campaign is followed with campaignProgress(). The jobs are interleaved across
+    the clusters, so each cluster gets a similar mix of the list.
+
+    Example of a clusters dictionary:
+
+    {"mn5": {"capacity": 200, "job_time": 30, "queue_wait": 4, "budget": 5000,
+             "options": {"partition": "gp_bscls", "time": 1, "job_name": "md"}},
+     "local": {"capacity": 8, "job_time": 50, "options": {}}}
+
+    Parameters
+    ==========
+    jobs : list
+        List of jobs.
+    clusters : dict
+        Dictionary with the clusters (the names of their modules, or "local") as keys
+        and their profiles as values, with the keys:
+            capacity : int
+                Tasks running at the same time (by default, the "auto" throttle of
+                the partition in the options, see profiles.arrayThrottle(), with the
+                "cpus" and "gpus" of the profile; for local, the "cpus" option).
+            job_time : float
+                Time per job in minutes (job_time by default).
+            queue_wait : float
+                Expected queue wait in hours (see profiles.queue_wait_hours).
+            budget : float
+                Maximum task-hours to spend in the cluster.
+            cost : float
+                Cost of a task-hour, to estimate the cost of the campaign.
+            options : dict
+                Options passed to the script generator of the cluster.
+    job_time : float
+        Time per job (minutes) of the clusters without a job_time in their profile.
+    script_prefix : str
+        Prefix of the scripts (<script_prefix>_<cluster>.sh, or
+        <script_prefix>_local for local).
+    manifest_db : str
+        Path to the SQLite campaign manifest.
+    marker_folder : str
+        Folder containing the completion markers.
+
+    Returns
+    =======
+    plan : dict
+        Plan of throughputPlan() with the script of each cluster added under the key
+        "script".
+    """
+
+    if isinstance(jobs, str):
+        jobs = [jobs]
+
+    plan = throughputPlan(len(jobs), clusters, job_time=job_time)
+
+    # Hash the whole list, so repeated commands get their own completion markers
+    # wherever they run (see markers.jobHashes())
+    job_hashes = markers.jobHashes(jobs)
+
+    # Interleave the jobs, giving each one to the cluster furthest from its share
+    assigned = {c: [] for c in plan}
+    assigned_hashes = {c: [] for c in plan}
+    for job, job_hash in zip(jobs, job_hashes):
+        cluster = min(
+            [c for c in plan if len(assigned[c]) < plan[c]["jobs"]],
+            key=lambda c: len(assigned[c]) / plan[c]["jobs"],
+        )
+        assigned[cluster].append(job)
+        assigned_hashes[cluster].append(job_hash)
+
+    for cluster, cluster_jobs in assigned.items():
+        if cluster_jobs == []:
+            plan[cluster]["script"] = None
+            continue
+        options = dict(clusters[cluster].get("options", {}))
+
+        if cluster == "local":
+            script_name = script_prefix + "_local"
+            local.parallel(
+                markers.markJobs(
+                    cluster_jobs, marker_folder, hashes=assigned_hashes[cluster]
+                ),
+                cpus=options.pop("cpus", clusters[cluster].get("capacity")),
+                script_name=script_name,
+                **options
+            )
+            if manifest_db != None:
+                manifest.recordJobs(
+                    manifest_db,
+                    [(job, "local", script_name, None) for job in cluster_jobs],
+                    hashes=assigned_hashes[cluster],
+                )
+        else:
+            script_name = script_prefix + "_" + cluster + ".sh"
+            options.setdefault("job_name", script_prefix + "_" + cluster)
+            cluster_modules[cluster].jobArrays(
+                cluster_jobs,
+                script_name=script_name,
+                completion_markers=True,
+                marker_folder=marker_folder,
+                hashes=assigned_hashes[cluster],
+                manifest_db=manifest_db,
+                **options
+            )
+        plan[cluster]["script"] = script_name
+
+    return plan
+
+
+def campaignProgress(
+    manifest_db="campaign_manifest.db", marker_folder="completion_markers"
+):
+    """
+    Counts the jobs of a dispatched campaign (see dispatchJobs()) in each state per
+    cluster. Jobs with a completion marker are counted as "COMPLETED"; the others
+    keep the state of the manifest (see manifest.updateStates()).
+
+    Parameters
+    ==========
+    manifest_db : str
+        Path to the SQLite campaign manifest.
+    marker_folder : str
+        Folder containing the completion markers.
+
+    Returns
+    =======
+    progress : dict
+        Dictionary with the clusters as keys and dictionaries with the number of
+        jobs in each state as values.
+    """
+
+    completed = markers.completedJobs(marker_folder)
+
+    progress = {}
+    for job in manifest.queryJobs(manifest_db):
+        state = "COMPLETED" if job["job_hash"] in completed else job["state"]
+        counts = progress.setdefault(job["cluster"], {})
+        counts[state] = counts.get(state, 0) + 1
+
+    return progress
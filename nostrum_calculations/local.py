@@ -1,7 +1,9 @@
 import os
 import math
 
-def parallel(jobs, cpus=None, script_name='commands'):
+from . import manifest
+
+def parallel(jobs, cpus=None, script_name='commands', manifest_db=None):
     """
     Generates scripts to run jobs simultaneously in N Cpus in a local computer,
     i.e., without a job manager. The input jobs must be a list representing each
@@ -34,6 +36,9 @@ def parallel(jobs, cpus=None, script_name='commands'):
         Number of CPUs to use in the execution.
     script_name : str
         Name of the output scripts to execute the jobs.
+    manifest_db : str
+        Path to a SQLite campaign manifest where the jobs are recorded with the
+        numbered script executing them.
     """
     # Write parallel execution scheme #
 
@@ -69,6 +74,11 @@ def parallel(jobs, cpus=None, script_name='commands'):
     for c in range(cpus):
         scripts[c].close()
 
+    # Record the jobs in the campaign manifest
+    if manifest_db != None:
+        manifest.recordJobs(manifest_db, [(jobs[i], 'local', script_name+'_'+str(i%cpus).zfill(zf), None)
+                                          for i in range(len(jobs))])
+
     # Write script to execute them all in background
     with open(script_name,'w') as sf:
         sf.write('#!/bin/sh\n')
@@ -0,0 +1,682 @@
+import os
+import re
+import time
+import json
+import shutil
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+from . import manifest
+from . import status
+
+
+# Line written by each task to the SLURM log shared by the array (see
+# shardedLogHeader()), mapping its job ID to its array index
+_task_id_line = 'echo "Array task ${SLURM_ARRAY_TASK_ID} is job ${SLURM_JOB_ID}"\n'
+
+
+def createLogShards(log_folder, n_tasks, shard_size):
+    """
+    Creates the shard subfolders (log_folder/<index//shard_size>) holding the output
+    and error files of an array job of n_tasks (one-based array indexes).
+
+    Parameters
+    ==========
+    log_folder : str
+        Folder containing the shards.
+    n_tasks : int
+        Number of tasks of the array job.
+    shard_size : int
+        Number of array indexes per shard.
+    """
+
+    if not isinstance(shard_size, int) or shard_size < 1:
+        raise ValueError("The log shard size must be a positive integer")
+
+    if not os.path.exists(log_folder):
+        os.mkdir(log_folder)
+
+    for shard in range(1 // shard_size, n_tasks // shard_size + 1):
+        shard_folder = log_folder + "/" + str(shard)
+        if not os.path.exists(shard_folder):
+            os.mkdir(shard_folder)
+
+
+def shardedLogHeader(output, log_folder):
+    """
+    Returns the #SBATCH output lines of an array job with sharded logs. SLURM cannot
+    compute the shard of a task in its --output pattern, so all the tasks of the array
+    append the messages written by SLURM itself (e.g., time limit cancellations) to a
+    single file, while each task redirects its own output into its shard (see
+    shardedLogRedirection()). Before redirecting its output, each task writes its
+    array index and job ID to that file, so scanLogFiles() can assign the SLURM
+    messages (which give the job ID of the task) to their array index.
+
+    Parameters
+    ==========
+    output : str
+        Prefix of the output files.
+    log_folder : str
+        Folder containing the shards.
+
+    Returns
+    =======
+    lines : str
+    """
+
+    lines = "#SBATCH --output=" + log_folder + "/" + output + "_%A.slurm\n"
+    lines += "#SBATCH --error=" + log_folder + "/" + output + "_%A.slurm\n"
+    lines += "#SBATCH --open-mode=append\n"
+
+    return lines
+
+
+def shardedLogRedirection(output, log_folder, shard_size):
+    """
+    Returns the lines redirecting the output and error of an array task into its
+    shard: log_folder/<index//shard_size>/<output>_<index>_<array_id>.(out|err).
+
+    Parameters
+    ==========
+    output : str
+        Prefix of the output files.
+    log_folder : str
+        Folder containing the shards.
+    shard_size : int
+        Number of array indexes per shard.
+
+    Returns
+    =======
+    lines : str
+    """
+
+    log = (
+        log_folder
+        + "/$((SLURM_ARRAY_TASK_ID / "
+        + str(shard_size)
+        + "))/"
+        + output
+        + "_${SLURM_ARRAY_TASK_ID}_${SLURM_ARRAY_JOB_ID}"
+    )
+
+    lines = _task_id_line
+    lines += "exec > " + log + ".out 2> " + log + ".err\n\n"
+
+    return lines
+
+
+def collectLogShards(
+    log_folder, shards=None, min_age=3600, remove=False, states=None, shard_size=None
+):
+    """
+    Packs completed log shards into log_folder/<shard>.tar.gz, replacing thousands
+    of small files by a single one. A shard is considered completed when none of its
+    files has been modified for min_age seconds and, if the states of the array
+    tasks are given, when all the tasks of its indexes are in a terminal state.
+
+    The tasks of a running or throttled array that have not started yet still write
+    into their shard folder, so shard folders are only removed after packing them
+    when the task states are given.
+
+    Parameters
+    ==========
+    log_folder : str
+        Folder containing the shards.
+    shards : list
+        Shards to pack. If not given, all the completed shards are packed.
+    min_age : float
+        Seconds since the last modification of a shard to consider it completed.
+    remove : bool
+        Remove the shard folder after packing it (requires states and shard_size).
+    states : dict
+        State table of all the array jobs writing into the shards (see
+        status.jobStates()). Shards without tasks in the table are not packed.
+    shard_size : int
+        Number of array indexes per shard (needed with states).
+
+    Returns
+    =======
+    packed : list
+        Paths of the written tar files.
+    """
+
+    if states != None and (not isinstance(shard_size, int) or shard_size < 1):
+        raise ValueError("Checking the task states requires a positive shard size")
+    if remove and states == None:
+        raise ValueError(
+            "Removing the shards requires the states of their tasks, since the "
+            "tasks that have not started yet still write into them"
+        )
+
+    if shards != None:
+        shards = [str(s) for s in shards]
+
+    # Shards whose tasks are all known and finished
+    if states != None:
+        finished_shards, active_shards = set(), set()
+        for (job_id, index), entry in states.items():
+            if index == None:
+                continue
+            if entry["state"] in status.terminal_states:
+                finished_shards.add(str(index // shard_size))
+            else:
+                active_shards.add(str(index // shard_size))
+        finished_shards -= active_shards
+
+    now = time.time()
+    packed = []
+    for shard in sorted(os.listdir(log_folder)):
+        shard_folder = log_folder + "/" + shard
+        if not shard.isdigit() or not os.path.isdir(shard_folder):
+            continue
+        if shards != None and shard not in shards:
+            continue
+        if states != None and shard not in finished_shards:
+            continue
+
+        files = os.listdir(shard_folder)
+        if files == []:
+            continue
+
+        last_modification = max(
+            [os.path.getmtime(shard_folder + "/" + f) for f in files]
+        )
+        if now - last_modification < min_age:
+            continue
+
+        tar_file = log_folder + "/" + shard + ".tar.gz"
+        n = 1
+        while os.path.exists(tar_file):
+            tar_file = log_folder + "/" + shard + "." + str(n) + ".tar.gz"
+            n += 1
+        with tarfile.open(tar_file + ".tmp", "w:gz") as tf:
+            for f in sorted(files):
+                tf.add(shard_folder + "/" + f, arcname=shard + "/" + f)
+        os.replace(tar_file + ".tmp", tar_file)
+        packed.append(tar_file)
+
+        if remove:
+            shutil.rmtree(shard_folder)
+
+    return packed
+
+
+def setUpAggregatedLogs(log_folder, aggregate_logs, shard_size=None):
+    """
+    Checks the aggregated logs options and creates the log folder.
+
+    Parameters
+    ==========
+    log_folder : str
+        Folder containing the aggregated log files.
+    aggregate_logs : str
+        Aggregate the task logs by "node" or by "shard".
+    shard_size : int
+        Number of array indexes per shard (needed for aggregate_logs="shard").
+    """
+
+    available_modes = ["node", "shard"]
+    if aggregate_logs not in available_modes:
+        raise ValueError(
+            "Wrong log aggregation selected. Available modes are: "
+            + ", ".join(available_modes)
+        )
+
+    if aggregate_logs == "shard":
+        if not isinstance(shard_size, int) or shard_size < 1:
+            raise ValueError(
+                "Aggregating the logs by shard requires a positive integer log shard size"
+            )
+
+    if not os.path.exists(log_folder):
+        os.mkdir(log_folder)
+
+
+def aggregatedLogRedirection(
+    log_folder, aggregate_logs, shard_size=None, flush_interval=60
+):
+    """
+    Returns the lines that collect the output and error of an array task and append
+    them, with the lines prefixed by "[<array_index> out]" or "[<array_index> err]",
+    to a log file shared by all the tasks of the same node (log_folder/<hostname>.log)
+    or shard (log_folder/<index//shard_size>.log).
+
+    The task output is buffered in node-local scratch and appended as one block when
+    the task exits, under a file lock, so the block of each task is contiguous. Its
+    position is recorded in <log>.index as a line with the array index, the array
+    job id, the byte offset, the byte length and the exit code of the task (see
+    readAggregatedLogs()).
+
+    While the task runs, its buffered output is copied every flush_interval seconds
+    to log_folder/partial/<array_job_id>_<array_index>.(out|err), which are removed
+    when the block is appended. A task killed without running its exit trap (e.g.,
+    by the OOM killer or a node failure) keeps its output up to the last copy there
+    (see partialLogs()).
+
+    Parameters
+    ==========
+    log_folder : str
+        Folder containing the aggregated log files.
+    aggregate_logs : str
+        Aggregate the task logs by "node" or by "shard".
+    shard_size : int
+        Number of array indexes per shard.
+    flush_interval : int
+        Seconds between the copies of the output of the running task.
+
+    Returns
+    =======
+    lines : str
+    """
+
+    if aggregate_logs == "node":
+        log = log_folder + "/$(hostname -s).log"
+    else:
+        log = log_folder + "/$((SLURM_ARRAY_TASK_ID / " + str(shard_size) + ")).log"
+
+    lines = _task_id_line
+    lines += "AGGREGATED_LOG=" + log + "\n"
+    lines += (
+        "PARTIAL_LOG="
+        + log_folder
+        + "/partial/${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}\n"
+    )
+    lines += "mkdir -p " + log_folder + "/partial\n"
+    lines += "TASK_LOGS=$(mktemp -d ${TMPDIR:-/tmp}/task_logs_XXXXXX)\n"
+    lines += "exec 3>&1 4>&2 > $TASK_LOGS/out 2> $TASK_LOGS/err\n"
+    lines += "(\n"
+    lines += "while kill -0 $$ 2> /dev/null; do\n"
+    lines += "    sleep " + str(flush_interval) + "\n"
+    for stream in ["out", "err"]:
+        partial = "$PARTIAL_LOG." + stream
+        lines += "    cp $TASK_LOGS/" + stream + " " + partial + ".tmp"
+        lines += " && mv " + partial + ".tmp " + partial + "\n"
+    lines += "done\n"
+    lines += ") 2> /dev/null &\n"
+    lines += "PARTIAL_FLUSHER=$!\n"
+    lines += "flush_logs() {\n"
+    lines += "    rc=$?\n"
+    lines += "    kill $PARTIAL_FLUSHER 2> /dev/null\n"
+    lines += "    wait $PARTIAL_FLUSHER 2> /dev/null\n"
+    lines += "    exec 1>&3 2>&4\n"
+    lines += "    (\n"
+    lines += "    flock 9\n"
+    lines += "    offset=$(stat -c %s $AGGREGATED_LOG 2> /dev/null || echo 0)\n"
+    lines += '    sed "s/^/[$SLURM_ARRAY_TASK_ID out] /" $TASK_LOGS/out >> $AGGREGATED_LOG\n'
+    lines += '    sed "s/^/[$SLURM_ARRAY_TASK_ID err] /" $TASK_LOGS/err >> $AGGREGATED_LOG\n'
+    lines += "    length=$(( $(stat -c %s $AGGREGATED_LOG) - offset ))\n"
+    lines += (
+        '    echo "$SLURM_ARRAY_TASK_ID $SLURM_ARRAY_JOB_ID $offset $length $rc"'
+        + " >> $AGGREGATED_LOG.index\n"
+    )
+    lines += "    ) 9> $AGGREGATED_LOG.lock\n"
+    lines += "    rm -rf $TASK_LOGS $PARTIAL_LOG.out $PARTIAL_LOG.err\n"
+    lines += "}\n"
+    lines += "trap flush_logs EXIT\n"
+    lines += "trap 'exit 143' TERM\n\n"
+
+    return lines
+
+
+def readAggregatedLogs(log_file, tasks=None):
+    """
+    Reads an aggregated log file (see aggregatedLogRedirection()) through its index.
+
+    Parameters
+    ==========
+    log_file : str
+        Path to the aggregated log file.
+    tasks : list
+        Array indexes to read. If not given, all the tasks in the index are read with
+        a single sequential pass over the log file.
+
+    Returns
+    =======
+    task_logs : dict
+        Dictionary with (array_job_id, array_index) as keys, as the state tables of
+        status.jobStates(), and dictionaries with the keys "exit_code" and "log" (the
+        prefixed lines of the task) as values.
+    """
+
+    index = []
+    with open(log_file + ".index") as lf:
+        for line in lf:
+            ls = line.split()
+            if len(ls) != 5:
+                continue
+            index.append((int(ls[0]), ls[1], int(ls[2]), int(ls[3]), int(ls[4])))
+
+    if tasks != None:
+        tasks = set(tasks)
+        index = [i for i in index if i[0] in tasks]
+
+    task_logs = {}
+    with open(log_file, "rb") as lf:
+        for task, job_id, offset, length, exit_code in sorted(index, key=lambda x: x[2]):
+            lf.seek(offset)
+            task_logs[(job_id, task)] = {
+                "exit_code": exit_code,
+                "log": lf.read(length).decode(errors="replace"),
+            }
+
+    return task_logs
+
+
+def partialLogs(log_folder):
+    """
+    Reads the partial logs of the tasks killed before appending their output to an
+    aggregated log file (see aggregatedLogRedirection()).
+
+    Parameters
+    ==========
+    log_folder : str
+        Folder containing the aggregated log files.
+
+    Returns
+    =======
+    task_logs : dict
+        Dictionary with (array_job_id, array_index) as keys and dictionaries with the
+        keys "out" and "err" (the output copied before the task was killed) as values.
+    """
+
+    partial_folder = log_folder + "/partial"
+    if not os.path.exists(partial_folder):
+        return {}
+
+    task_logs = {}
+    for f in sorted(os.listdir(partial_folder)):
+        name, stream = os.path.splitext(f)
+        if stream not in [".out", ".err"] or name.count("_") != 1:
+            continue
+        job_id, task = name.split("_")
+        if not task.isdigit():
+            continue
+        with open(partial_folder + "/" + f, errors="replace") as pf:
+            entry = task_logs.setdefault((job_id, int(task)), {"out": "", "err": ""})
+            entry[stream[1:]] = pf.read()
+
+    return task_logs
+
+
+# Failure patterns matched by scanLogFiles(), in order of priority
+failure_patterns = {
+    "out_of_memory": rb"oom[-_]kill|Out of memory|OUT_OF_MEMORY|MemoryError|std::bad_alloc",
+    "time_limit": rb"DUE TO TIME LIMIT",
+    "cancelled": rb"CANCELLED AT",
+    "segfault": rb"Segmentation fault|SIGSEGV|signal 11",
+    "python_traceback": rb"Traceback \(most recent call last\)",
+    "pele_error": rb"MPI_ABORT was invoked|PELE.*\bERROR\b",
+    "gromacs_error": rb"Fatal error:|Program:\s+gmx",
+}
+
+# Array task output files: <output>_<array_index>_<array_job_id>.(out|err)
+_task_log = re.compile(r"_(\d+)_(\d+)\.(out|err)$")
+
+# Partial logs of aggregated tasks: partial/<array_job_id>_<array_index>.(out|err)
+_partial_log = re.compile(r"^(\d+)_(\d+)\.(out|err)$")
+
+# SLURM logs shared by the tasks of an array: <output>_<array_job_id>.slurm
+_slurm_log = re.compile(r"_(\d+)\.slurm$")
+
+# Lines of the SLURM logs with the job ID of a task (see _task_id_line), and job
+# references in the SLURM messages (e.g., "*** JOB 1234 ON ... CANCELLED AT ...",
+# "oom_kill event in StepId=1234.batch" or "JOB 1200_5")
+_task_id = re.compile(rb"^Array task (\d+) is job (\d+)$", re.M)
+_slurm_job = re.compile(rb"\b(?:JOB|StepId=)\s*(\d+)(?:_(\d+))?")
+
+
+def _readLines(lf, chunk_size, offset=0, length=None):
+    """
+    Yields the content of an open file in chunks split at line boundaries, from
+    offset and up to length bytes (until the end of the file by default).
+    """
+
+    lf.seek(offset)
+    remainder = b""
+    left = length
+    while True:
+        size = chunk_size if left == None else min(chunk_size, left)
+        chunk = lf.read(size) if size > 0 else b""
+        if left != None:
+            left -= len(chunk)
+        if not chunk:
+            if remainder:
+                yield remainder
+            break
+        chunk = remainder + chunk
+        cut = chunk.rfind(b"\n") + 1
+        if cut == 0:
+            cut = len(chunk)
+        lines, remainder = chunk[:cut], chunk[cut:]
+        yield lines
+
+
+def _matchLines(lines, patterns, found):
+    """
+    Adds the names of the patterns found in a block of lines to the found set.
+    """
+
+    for name, pattern in patterns.items():
+        if name not in found and pattern.search(lines):
+            found.add(name)
+
+
+def _matchLogFile(log_file, patterns, chunk_size):
+    """
+    Returns the names of the patterns found in a file, reading it in chunks split
+    at line boundaries, so the memory used does not depend on the file size.
+    """
+
+    found = set()
+    with open(log_file, "rb") as lf:
+        for lines in _readLines(lf, chunk_size):
+            _matchLines(lines, patterns, found)
+            if len(found) == len(patterns):
+                break
+
+    return sorted(found)
+
+
+def _matchAggregatedLog(log_file, patterns, chunk_size):
+    """
+    Returns the names of the patterns found in the block of each task of an
+    aggregated log file, located through the offsets of its index (see
+    aggregatedLogRedirection()).
+    """
+
+    index = []
+    with open(log_file + ".index") as lf:
+        for line in lf:
+            ls = line.split()
+            if len(ls) == 5:
+                index.append((ls[1] + "|" + ls[0], int(ls[2]), int(ls[3])))
+
+    tasks = {}
+    with open(log_file, "rb") as lf:
+        for task, offset, length in sorted(index, key=lambda x: x[1]):
+            found = set(tasks.get(task, []))
+            for lines in _readLines(lf, chunk_size, offset=offset, length=length):
+                _matchLines(lines, patterns, found)
+            tasks[task] = sorted(found)
+
+    return tasks
+
+
+def _matchSlurmLog(log_file, patterns, chunk_size, array_job_id):
+    """
+    Returns the names of the patterns found in the SLURM log shared by the tasks of
+    an array (see shardedLogHeader()) for each task, assigning the lines of the
+    SLURM messages to the task of the job they refer to.
+    """
+
+    task_jobs = {}
+    found = {}
+    with open(log_file, "rb") as lf:
+        for lines in _readLines(lf, chunk_size):
+            for m in _task_id.finditer(lines):
+                task_jobs[m.group(2).decode()] = int(m.group(1))
+            names = [n for n, p in patterns.items() if p.search(lines)]
+            if names == []:
+                continue
+            for line in lines.split(b"\n"):
+                matched = [n for n in names if patterns[n].search(line)]
+                job = _slurm_job.search(line)
+                if matched != [] and job != None:
+                    found.setdefault(job.groups(), set()).update(matched)
+
+    tasks = {}
+    for task in task_jobs.values():
+        tasks[array_job_id + "|" + str(task)] = set()
+    for (job_id, index), names in found.items():
+        if index != None and job_id.decode() == array_job_id:
+            task = int(index)
+        elif index == None and job_id.decode() in task_jobs:
+            task = task_jobs[job_id.decode()]
+        else:
+            continue
+        tasks.setdefault(array_job_id + "|" + str(task), set()).update(names)
+
+    return {task: sorted(names) for task, names in tasks.items()}
+
+
+def scanLogFiles(
+    log_folder=".",
+    patterns=None,
+    workers=8,
+    chunk_size=1048576,
+    state_file=None,
+    manifest_db=None,
+):
+    """
+    Scans the logs of array tasks for failure patterns and classifies each task by
+    the first matched failure in the order of the patterns, or as "ok". The logs of
+    all the output modes of the array generators are scanned (also inside log
+    shards):
+
+    - the output and error files of each task
+      (<output>_<array_index>_<array_job_id>.out/.err);
+    - the aggregated log files (<name>.log with a <name>.log.index, see
+      aggregatedLogRedirection()), assigning each block to its task through the
+      index, and the partial logs of the tasks killed before appending theirs
+      (partial/<array_job_id>_<array_index>.out/.err);
+    - the SLURM logs shared by the tasks of an array with sharded or aggregated
+      logs (<output>_<array_job_id>.slurm, see shardedLogHeader()), where SLURM
+      writes the time limit, out of memory and cancellation messages. Each message
+      is assigned to the task of the job it refers to.
+
+    The files are read in chunks by a pool of threads. The matches of each file
+    are saved in state_file with its size and modification time, so files not
+    modified since the previous scan are not read again.
+
+    Parameters
+    ==========
+    log_folder : str
+        Folder containing the output files (searched recursively).
+    patterns : dict
+        Dictionary with failure names as keys and regular expressions (str or bytes)
+        as values, in order of priority. By default failure_patterns is used.
+    workers : int
+        Number of threads reading the files.
+    chunk_size : int
+        Bytes read at once from each file.
+    state_file : str
+        JSON file storing the matches of the scanned files (default:
+        log_folder/.log_scan.json).
+    manifest_db : str
+        Path to a SQLite campaign manifest where the classification of the tasks is
+        written (see manifest.setFailures()).
+
+    Returns
+    =======
+    tasks : dict
+        Dictionary with (array_job_id, array_index) as keys and the failure name (or
+        "ok") as values.
+    """
+
+    if patterns == None:
+        patterns = failure_patterns
+
+    compiled = {}
+    for name, pattern in patterns.items():
+        if isinstance(pattern, str):
+            pattern = pattern.encode()
+        compiled[name] = re.compile(pattern)
+
+    if state_file == None:
+        state_file = log_folder + "/.log_scan.json"
+
+    # Scans are only reused if they were done with the same patterns (and format)
+    state = {"format": 2, "patterns": sorted(patterns), "files": {}}
+    if os.path.exists(state_file):
+        with open(state_file) as sf:
+            previous = json.load(sf)
+        if (
+            previous.get("format") == state["format"]
+            and previous.get("patterns") == state["patterns"]
+        ):
+            state = previous
+
+    # Collect the task logs. Aggregated logs are tracked through their index, which
+    # is written after each block.
+    log_files = []
+    folders = [log_folder]
+    while folders != []:
+        folder = folders.pop()
+        for entry in os.scandir(folder):
+            if entry.is_dir():
+                folders.append(entry.path)
+            elif _task_log.search(entry.name):
+                m = _task_log.search(entry.name)
+                log_files.append((entry, "task", m.group(2) + "|" + m.group(1)))
+            elif os.path.basename(folder) == "partial" and _partial_log.match(
+                entry.name
+            ):
+                m = _partial_log.match(entry.name)
+                log_files.append((entry, "task", m.group(1) + "|" + m.group(2)))
+            elif _slurm_log.search(entry.name):
+                m = _slurm_log.search(entry.name)
+                log_files.append((entry, "slurm", m.group(1)))
+            elif entry.name.endswith(".log.index") and os.path.exists(entry.path[:-6]):
+                log_files.append((entry, "aggregated", None))
+
+    def _scan(log_file):
+        entry, kind, key = log_file
+        st = entry.stat()
+        cached = state["files"].get(entry.path)
+        if cached != None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return entry.path, cached
+        if kind == "task":
+            matches = {key: _matchLogFile(entry.path, compiled, chunk_size)}
+        elif kind == "slurm":
+            matches = _matchSlurmLog(entry.path, compiled, chunk_size, key)
+        else:
+            matches = _matchAggregatedLog(entry.path[:-6], compiled, chunk_size)
+        return entry.path, [st.st_size, st.st_mtime_ns, matches]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        scanned = list(executor.map(_scan, log_files))
+
+    state["files"] = dict(scanned)
+    with open(state_file + ".tmp", "w") as sf:
+        json.dump(state, sf)
+    os.replace(state_file + ".tmp", state_file)
+
+    # Classify each task by its highest priority failure
+    found = {}
+    for path, (size, mtime, matches) in scanned:
+        for key, names in matches.items():
+            job_id, index = key.split("|")
+            found.setdefault((job_id, int(index)), set()).update(names)
+
+    tasks = {}
+    for task, matches in found.items():
+        tasks[task] = "ok"
+        for name in patterns:
+            if name in matches:
+                tasks[task] = name
+                break
+
+    if manifest_db != None:
+        manifest.setFailures(manifest_db, tasks)
+
+    return tasks
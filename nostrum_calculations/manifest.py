@@ -0,0 +1,338 @@
+import os
+import time
+import sqlite3
+
+from . import tricks
+from . import markers
+
+# Job manager states of failed jobs
+failed_states = ["FAILED", "TIMEOUT", "OUT_OF_MEMORY", "CANCELLED", "NODE_FAIL"]
+
+
+def connectManifest(db_file):
+    """
+    Opens a SQLite campaign manifest, creating its table and indexes if needed.
+
+    Each row is a command of a generated script: its hash (see markers.jobHashes()),
+    the command, the cluster, the script path (absolute), the array index (0 for
+    non-array jobs), the job ID, the state ("generated" until submitted) and the
+    failure found in its output files (see logs.scanLogFiles()).
+
+    An array index (and its job ID) stands for an array task, not for a command:
+    with grouped (or packed) jobs, all the commands run by a task share its array
+    index, so the states and failures of the task (see updateStates() and
+    setFailures()) are given to every command of the task.
+
+    Parameters
+    ==========
+    db_file : str
+        Path to the SQLite file.
+
+    Returns
+    =======
+    connection : sqlite3.Connection
+    """
+
+    connection = sqlite3.connect(db_file, timeout=60)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            job_hash TEXT NOT NULL,
+            command TEXT NOT NULL,
+            cluster TEXT,
+            script TEXT NOT NULL,
+            array_index INTEGER NOT NULL DEFAULT 0,
+            job_id TEXT,
+            state TEXT NOT NULL DEFAULT 'generated',
+            failure TEXT,
+            updated REAL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS jobs_script_task
+            ON jobs (script, array_index, job_hash);
+        CREATE INDEX IF NOT EXISTS jobs_job_task ON jobs (job_id, array_index);
+        CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, cluster);
+        CREATE INDEX IF NOT EXISTS jobs_hash ON jobs (job_hash);
+        """
+    )
+
+    return connection
+
+
+def recordJobs(db_file, rows, hashes=None):
+    """
+    Writes generated commands into the manifest in a single transaction. Commands
+    already recorded for the same script and array index are reset to the
+    "generated" state, since their script has been rewritten.
+
+    Parameters
+    ==========
+    db_file : str
+        Path to the SQLite file.
+    rows : list
+        (command, cluster, script, array_index) tuples. Use None or 0 as the array
+        index of non-array jobs.
+    hashes : list
+        Hashes of the commands, one per row. By default, the hashes of the commands
+        of the rows in order (see markers.jobHashes()), as used by their completion
+        markers.
+    """
+
+    if hashes == None:
+        hashes = markers.jobHashes([row[0] for row in rows])
+
+    if len(hashes) != len(rows):
+        raise ValueError("The number of hashes must match the number of rows")
+
+    now = time.time()
+    values = []
+    paths = {}
+    for (command, cluster, script, array_index), job_hash in zip(rows, hashes):
+        if script not in paths:
+            paths[script] = os.path.abspath(script)
+        values.append(
+            (
+                job_hash,
+                command,
+                cluster,
+                paths[script],
+                array_index if array_index != None else 0,
+                now,
+            )
+        )
+
+    connection = connectManifest(db_file)
+    with connection:
+        connection.executemany(
+            """
+            INSERT INTO jobs (job_hash, command, cluster, script, array_index, updated)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (script, array_index, job_hash) DO UPDATE SET
+                command = excluded.command,
+                cluster = excluded.cluster,
+                job_id = NULL,
+                state = 'generated',
+                failure = NULL,
+                updated = excluded.updated
+            """,
+            values,
+        )
+    connection.close()
+
+
+def recordArrayJobs(
+    db_file,
+    commands,
+    cluster,
+    script_name,
+    array_specs,
+    jobs_per_task=1,
+    hashes=None,
+):
+    """
+    Records the commands of an array script (see jobArrays()) in the manifest,
+    mapping each command to the array index of the task that runs it. With
+    jobs_per_task > 1, consecutive commands share the array index of their task,
+    so the state and failure later found for the task apply to all of them.
+
+    Parameters
+    ==========
+    db_file : str
+        Path to the SQLite file.
+    commands : list
+        Commands given to the generator, in order.
+    cluster : str
+        Name of the cluster.
+    script_name : str
+        Path to the array script.
+    array_specs : list
+        Array specs of the script and its split parts (see tricks.splitArrayIndexes()).
+    jobs_per_task : int
+        Commands run by each array task (e.g., when grouping jobs or packing
+        simulations): command i (zero-based) runs in the array index
+        i // jobs_per_task + 1.
+    hashes : list
+        Hashes of the commands, one per command (by default, see markers.jobHashes()).
+    """
+
+    # Script (or split part) of each array index
+    task_scripts = {}
+    for n, spec in enumerate(array_specs, 1):
+        part_script = tricks.splitScriptName(script_name, n)
+        for index in tricks.expandArrayIndexes(spec):
+            task_scripts[index] = part_script
+
+    # Hash the whole list, so repeated commands match their completion markers
+    if hashes == None:
+        hashes = markers.jobHashes(commands)
+    if len(hashes) != len(commands):
+        raise ValueError("The number of hashes must match the number of commands")
+
+    rows = []
+    row_hashes = []
+    for i, command in enumerate(commands):
+        index = i // jobs_per_task + 1
+        if index in task_scripts:
+            rows.append((command, cluster, task_scripts[index], index))
+            row_hashes.append(hashes[i])
+
+    recordJobs(db_file, rows, hashes=row_hashes)
+
+
+def setJobIDs(db_file, job_ids):
+    """
+    Sets the job IDs of submitted scripts and their state to "submitted".
+
+    Parameters
+    ==========
+    db_file : str
+        Path to the SQLite file.
+    job_ids : dict
+        Dictionary with the script paths as keys and the job IDs as values.
+    """
+
+    now = time.time()
+    connection = connectManifest(db_file)
+    with connection:
+        connection.executemany(
+            "UPDATE jobs SET job_id = ?, state = 'submitted', updated = ? WHERE script = ?",
+            [(j, now, os.path.abspath(s)) for s, j in job_ids.items()],
+        )
+    connection.close()
+
+
+def updateStates(db_file, table):
+    """
+    Updates the state of the submitted jobs from a state table (see
+    status.jobStates()). The state of a task is set on every command it runs.
+
+    Parameters
+    ==========
+    db_file : str
+        Path to the SQLite file.
+    table : dict
+        Dictionary with (job_id, array_index) as keys and dictionaries with the key
+        "state" as values.
+    """
+
+    now = time.time()
+    values = []
+    for (job_id, index), entry in table.items():
+        values.append((entry["state"], now, str(job_id), index if index != None else 0))
+
+    connection = connectManifest(db_file)
+    with connection:
+        connection.executemany(
+            "UPDATE jobs SET state = ?, updated = ? WHERE job_id = ? AND array_index = ?",
+            values,
+        )
+    connection.close()
+
+
+def setFailures(db_file, tasks):
+    """
+    Sets the failure found in the output files of the array tasks (see
+    logs.scanLogFiles()). The output files belong to a task, so the failure is set
+    on every command the task runs (e.g., all the grouped jobs of the task).
+
+    Parameters
+    ==========
+    db_file : str
+        Path to the SQLite file.
+    tasks : dict
+        Dictionary with (job_id, array_index) as keys and the failure names (or "ok")
+        as values.
+    """
+
+    now = time.time()
+    values = []
+    for (job_id, index), failure in tasks.items():
+        values.append((failure, now, str(job_id), index if index != None else 0))
+
+    connection = connectManifest(db_file)
+    with connection:
+        connection.executemany(
+            "UPDATE jobs SET failure = ?, updated = ? WHERE job_id = ? AND array_index = ?",
+            values,
+        )
+    connection.close()
+
+
+def queryJobs(db_file, states=None, cluster=None, job_id=None, failures=None):
+    """
+    Returns the jobs of the manifest, optionally filtered.
+
+    Parameters
+    ==========
+    db_file : str
+        Path to the SQLite file.
+    states : (str, list)
+        Keep only the jobs in these states.
+    cluster : str
+        Keep only the jobs of this cluster.
+    job_id : str
+        Keep only the jobs of this job ID.
+    failures : (str, list)
+        Keep only the jobs with these failures in their output files.
+
+    Returns
+    =======
+    jobs : list
+        List of dictionaries with the columns of the manifest as keys.
+    """
+
+    if isinstance(states, str):
+        states = [states]
+    if isinstance(failures, str):
+        failures = [failures]
+
+    conditions = []
+    values = []
+    if states != None:
+        conditions.append("state IN (" + ",".join(["?"] * len(states)) + ")")
+        values += states
+    if cluster != None:
+        conditions.append("cluster = ?")
+        values.append(cluster)
+    if job_id != None:
+        conditions.append("job_id = ?")
+        values.append(str(job_id))
+    if failures != None:
+        conditions.append("failure IN (" + ",".join(["?"] * len(failures)) + ")")
+        values += failures
+
+    query = "SELECT * FROM jobs"
+    if conditions != []:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY script, array_index, id"
+
+    connection = connectManifest(db_file)
+    connection.row_factory = sqlite3.Row
+    jobs = [dict(row) for row in connection.execute(query, values)]
+    connection.close()
+
+    return jobs
+
+
+def failedJobs(db_file, cluster=None):
+    """
+    Returns the commands of the failed jobs of the manifest (see failed_states),
+    ready to be given again to a generator.
+
+    Parameters
+    ==========
+    db_file : str
+        Path to the SQLite file.
+    cluster : str
+        Keep only the jobs of this cluster.
+
+    Returns
+    =======
+    commands : list
+    """
+
+    jobs = queryJobs(db_file, states=failed_states, cluster=cluster)
+
+    return [job["command"] for job in jobs]
@@ -0,0 +1,231 @@
+import os
+import hashlib
+
+
+def jobHash(job, occurrence=0):
+    """
+    Returns the content hash identifying a job command in its completion marker.
+
+    Markers are keyed by the command only (not by the script or array index), so a
+    job list can be regenerated, reordered or split into other arrays and its
+    completed jobs are still skipped. Identical commands given to the same marker
+    folder in different lists share one marker; use a marker folder per campaign if
+    they must run again.
+
+    Parameters
+    ==========
+    job : str
+        Command to execute.
+    occurrence : int
+        Number of earlier occurrences of the same command in the job list. Repeated
+        commands get their own hash (see jobHashes()).
+
+    Returns
+    =======
+    job_hash : str
+    """
+
+    if occurrence:
+        job += "\n#" + str(occurrence)
+
+    return hashlib.md5(job.encode()).hexdigest()
+
+
+def jobHashes(jobs):
+    """
+    Returns the hashes of a job list (see jobHash()). Repeated commands are numbered
+    by their occurrence in the list, so each one gets its own marker instead of
+    being skipped once the first one completes.
+
+    Parameters
+    ==========
+    jobs : list
+        List of jobs.
+
+    Returns
+    =======
+    job_hashes : list
+    """
+
+    seen = {}
+    job_hashes = []
+    for job in jobs:
+        job_hashes.append(jobHash(job, occurrence=seen.get(job, 0)))
+        seen[job] = seen.get(job, 0) + 1
+
+    return job_hashes
+
+
+def markedJob(job, marker_folder, job_hash=None):
+    """
+    Wraps a job so it writes a completion marker (marker_folder/<job_hash>.done) when
+    it finishes successfully, and exits immediately when a marker for the same
+    command already exists. Resubmitting a partially failed array then only runs
+    the jobs that did not complete. The marker contains the exit code, the UNIX
+    timestamp of the completion and the hash of the command.
+
+    The job runs in a subshell, so grouped jobs are marked independently and the
+    exit code used is the one of the last command of the job.
+
+    Parameters
+    ==========
+    job : str
+        Command to execute.
+    marker_folder : str
+        Folder containing the completion markers.
+    job_hash : str
+        Hash of the command (see jobHash()). Give it when the job has been modified
+        after computing it (e.g., staged), so the marker matches the original command.
+
+    Returns
+    =======
+    marked_job : str
+    """
+
+    if job_hash == None:
+        job_hash = jobHash(job)
+
+    marker = os.path.abspath(marker_folder) + "/" + job_hash + ".done"
+
+    marked_job = "if [ -f " + marker + " ]; then\n"
+    marked_job += '    echo "Skipping completed job ' + job_hash + '"\n'
+    marked_job += "else\n"
+    marked_job += "(\n"
+    marked_job += job
+    if not job.endswith("\n"):
+        marked_job += "\n"
+    marked_job += ")\n"
+    marked_job += "rc=$?\n"
+    marked_job += "if [ $rc -eq 0 ]; then\n"
+    marked_job += (
+        '    echo "$rc $(date +%s) ' + job_hash + '" > ' + marker + ".$$ && mv "
+    )
+    marked_job += marker + ".$$ " + marker + "\n"
+    marked_job += "fi\n"
+    marked_job += "fi\n"
+
+    return marked_job
+
+
+def markJobs(jobs, marker_folder, hashes=None):
+    """
+    Wraps a list of jobs with markedJob() and creates the marker folder. A warning
+    is printed when the list repeats commands, since their markers then depend on
+    the order of the repetitions (see jobHashes()).
+
+    Parameters
+    ==========
+    jobs : list
+        List of jobs.
+    marker_folder : str
+        Folder containing the completion markers.
+    hashes : list
+        Hashes of the original commands, one per job (see jobHashes()).
+
+    Returns
+    =======
+    marked_jobs : list
+    """
+
+    if hashes == None:
+        hashes = jobHashes(jobs)
+
+    if len(hashes) != len(jobs):
+        raise ValueError("The number of hashes must match the number of jobs")
+
+    repeated = len(hashes) - len(set([jobHash(job) for job in jobs]))
+    if repeated:
+        print(
+            "Warning: "
+            + str(repeated)
+            + " jobs repeat an earlier command of the list. Each repetition gets its"
+            + " own completion marker, numbered by its order in the list."
+        )
+
+    if not os.path.exists(marker_folder):
+        os.makedirs(marker_folder)
+
+    return [markedJob(job, marker_folder, job_hash=h) for job, h in zip(jobs, hashes)]
+
+
+def completedJobs(marker_folder):
+    """
+    Reads all the completion markers of a folder.
+
+    Parameters
+    ==========
+    marker_folder : str
+        Folder containing the completion markers.
+
+    Returns
+    =======
+    completed : dict
+        Dictionary with the command hashes as keys and (exit_code, timestamp) tuples
+        as values.
+    """
+
+    completed = {}
+    if not os.path.exists(marker_folder):
+        return completed
+
+    for entry in os.scandir(marker_folder):
+        if not entry.name.endswith(".done"):
+            continue
+        with open(entry.path) as mf:
+            ls = mf.read().split()
+        if len(ls) != 3 or ls[2] + ".done" != entry.name:
+            continue
+        completed[ls[2]] = (int(ls[0]), int(ls[1]))
+
+    return completed
+
+
+def pendingJobs(jobs, marker_folder, return_indexes=False, return_hashes=False):
+    """
+    Returns the jobs without a completion marker, so only those are resubmitted.
+    The marker folder is listed once, instead of checking each job separately.
+
+    Repeated commands are matched by their occurrence in the full list (see
+    jobHashes()), so give the returned hashes to jobArrays() (hashes=...) when
+    resubmitting the pending jobs. Otherwise, a pending repetition would be hashed
+    again as the first occurrence of its command and skipped with its marker.
+
+    Parameters
+    ==========
+    jobs : list
+        List of jobs, as given to jobArrays().
+    marker_folder : str
+        Folder containing the completion markers.
+    return_indexes : bool
+        Also return the zero-based indexes of the pending jobs in the jobs list.
+    return_hashes : bool
+        Also return the hashes of the pending jobs in the jobs list.
+
+    Returns
+    =======
+    pending : list
+        Jobs without a completion marker.
+    indexes : list
+        Indexes of the pending jobs (only if return_indexes is True).
+    hashes : list
+        Hashes of the pending jobs (only if return_hashes is True).
+    """
+
+    done = set()
+    if os.path.exists(marker_folder):
+        done = set([f[:-5] for f in os.listdir(marker_folder) if f.endswith(".done")])
+
+    job_hashes = jobHashes(jobs)
+    indexes = [i for i, h in enumerate(job_hashes) if h not in done]
+    pending = [jobs[i] for i in indexes]
+
+    returned = [pending]
+    if return_indexes:
+        returned.append(indexes)
+    if return_hashes:
+        returned.append([job_hashes[i] for i in indexes])
+
+    if len(returned) == 1:
+        return pending
+
+    return tuple(returned)
@@ -1,7 +1,25 @@
+from . import workflows
+from . import tricks
+from . import profiles
+from . import staging
+from . import markers
+from . import manifest
+from . import logs
+from . import telemetry
+from . import sizing
+
 def jobArrays(jobs, script_name=None, job_name=None, cpus_per_task=8, gpus=1, ntasks=1,
               nodes=1, output=None, mail=None, time=48, modules=None, conda_env=None, constraint=None,
               unload_modules=None, program=None, pythonpath=None, partition='bsc_ls', purge=False,
-              group_jobs_by=None):
+              group_jobs_by=None, simulations_per_gpu=None, mps=False, simulated_ns=None,
+              stage_conda_env=False, env_stage_dir='/dev/shm',
+              env_snapshot=False, env_snapshot_dir='.env_snapshots', stage_files=None,
+              log_shard_size=None, log_folder='logs', aggregate_logs=None,
+              completion_markers=False, marker_folder='completion_markers', hashes=None,
+              job_ids=None, max_array_spec=1000,
+              throttle=None, concurrent_arrays=1, manifest_db=None,
+              job_telemetry=False, telemetry_folder='telemetry',
+              sizing_options=None, queue_wait=None):
 
     """
     Set up job array scripts for Minotauro slurm job manager.
@@ -12,6 +30,80 @@ def jobArrays(jobs, script_name=None, job_name=None, cpus_per_task=8, gpus=1, nt
         List of jobs. Each job is a string representing the command to execute.
     script_name : str
         Name of the SLURM submission script.
+    simulations_per_gpu : int
+        Run this many openmm simulations concurrently on each allocated GPU
+        (see workflows.openmmSimulationsPerGPU() and workflows.openmmPackedJobs()).
+    mps : bool
+        Share the GPUs among the packed openmm simulations through a CUDA MPS daemon.
+    simulated_ns : float
+        Simulated ns of each openmm job, used to report the ns/day of each packed simulation.
+    stage_conda_env : bool
+        Activate the conda environment from a node-local copy unpacked once per node
+        from a conda-pack tarball (see staging.stagedCondaEnv()), instead of from GPFS.
+    env_stage_dir : str
+        Node-local folder where the conda environment is unpacked.
+    env_snapshot : bool
+        Save the environment set up by the first task (modules, conda, exports) into
+        a snapshot that the following tasks source instead (see staging.snapshotEnvironment()).
+    env_snapshot_dir : str
+        Folder where the environment snapshots are saved.
+    stage_files : (dict, list)
+        Run each job in a node-local scratch folder, copying its inputs there and its
+        outputs back. Give a dictionary with the keys "inputs" (paths) and "outputs"
+        (globs) for all jobs, or a list with one dictionary per job (see staging.stagedJob()).
+    log_shard_size : int
+        Write the output and error files of the tasks into shard subfolders of
+        log_folder (log_folder/<array_index//log_shard_size>/), created up front, instead
+        of a single folder (see logs.collectLogShards() to pack completed shards).
+    log_folder : str
+        Folder containing the log shards.
+    aggregate_logs : str
+        Append the output and error of the tasks, with prefixed lines, to one log file
+        per "node" or per "shard" (of log_shard_size indexes) in log_folder, with a
+        byte-offset index per task, instead of one file pair per task (see
+        logs.aggregatedLogRedirection()).
+    completion_markers : bool
+        Wrap each job so it writes a completion marker (marker_folder/<hash>.done) on
+        success and is skipped when its marker already exists, so a partially failed
+        array can be resubmitted as is (see markers.pendingJobs() to get the pending jobs).
+    marker_folder : str
+        Folder containing the completion markers.
+    hashes : list
+        Hashes of the jobs, one per job, for their completion markers and the campaign
+        manifest (see markers.jobHashes()). Give the ones returned by
+        markers.pendingJobs() when resubmitting the pending jobs of a list, so repeated
+        commands keep their markers.
+    job_ids : list
+        One-based IDs of the jobs to submit (e.g., the failed ones), given as an
+        arbitrary list. The array is submitted with a compressed range spec
+        (e.g., 1-5,9,12-40) keeping the original job IDs.
+    max_array_spec : int
+        Maximum length of the range spec of a single submission. Longer specs are
+        split into several scripts (<script>_<n>.sh) with the same jobs.
+    throttle : (int, str)
+        Maximum number of tasks of the array running at the same time (--array=<spec>%N).
+        Give "auto" to estimate it from the profile of the partition and the resources
+        of each task (see profiles.arrayThrottle()).
+    concurrent_arrays : int
+        Number of arrays of the same campaign running at the same time, which share
+        the budget of the "auto" throttle.
+    manifest_db : str
+        Path to a SQLite campaign manifest where the commands are recorded with their
+        script and array index (see manifest.recordArrayJobs()).
+    job_telemetry : bool
+        Wrap each job to record its wall time, CPU time, maximum RSS and exit code, and
+        timestamp the environment set-up of each task separately, in a per-task record
+        (telemetry_folder/<job_id>_<array_index>.tsv, see telemetry.readTelemetry()).
+    telemetry_folder : str
+        Folder containing the telemetry records.
+    sizing_options : dict
+        Options used to size the time (and memory) requests when time="auto" (see
+        sizing.autoResources()), e.g., {"history_file": "sizing_history.json",
+        "input_size": 5000, "percentile": 95, "margin": 0.2}.
+    queue_wait : dict
+        Expected queue wait (hours) of the partitions, used with partition="auto" to
+        select the partition where the array finishes first (see
+        profiles.selectPartition()). The defaults are in profiles.queue_wait_hours.
     """
 
     available_programs = ['openmm', 'alphafold']
@@ -20,11 +112,40 @@ def jobArrays(jobs, script_name=None, job_name=None, cpus_per_task=8, gpus=1, nt
     if isinstance(jobs, str):
         jobs = [jobs]
 
+    # Keep the original commands for the campaign manifest
+    commands = list(jobs)
+
+    # Hash the original commands for the completion markers and the manifest
+    if hashes == None:
+        hashes = markers.jobHashes(jobs)
+
+    # Run the jobs in node-local scratch folders
+    if stage_files != None:
+        jobs = staging.stageJobs(jobs, stage_files)
+
+    # Record the resources used by each job
+    if job_telemetry:
+        jobs = telemetry.telemetryJobs(jobs, telemetry_folder)
+
+    # Skip the jobs with a completion marker and mark the successful ones
+    if completion_markers:
+        jobs = markers.markJobs(jobs, marker_folder, hashes=hashes)
+
     if job_name == None:
         raise ValueError('job_name == None. You need to specify a name for the job')
     if output == None:
         output = job_name
 
+    # Choose the partition from the estimated time of the jobs
+    if partition == 'auto':
+        partition, group_jobs_by = sizing.autoPartition('minotauro', time, len(jobs),
+                                                        program=program if program != None else job_name,
+                                                        cpus=ntasks*cpus_per_task, gpus=gpus,
+                                                        group_jobs_by=group_jobs_by,
+                                                        queue_wait=queue_wait,
+                                                        sizing_options=sizing_options,
+                                                        job_ids=job_ids)
+
     # Group jobs to enter in the same job array (useful for launching many short
     # jobs when there are a max_job_allowed limit per user.)
     if isinstance(group_jobs_by, int):
@@ -59,6 +180,10 @@ def jobArrays(jobs, script_name=None, job_name=None, cpus_per_task=8, gpus=1, nt
         else:
             pythonpath += ['/home/bsc72/bsc72523/Programs/sbm-openmm/compiled/lib/python3.6/site-packages']
 
+        if simulations_per_gpu != None:
+            jobs = workflows.openmmPackedJobs(jobs, simulations_per_gpu, gpus=gpus, mps=mps,
+                                              simulated_ns=simulated_ns)
+
     if program == 'alphafold':
         purge = True
         if modules == None:
@@ -84,6 +209,14 @@ def jobArrays(jobs, script_name=None, job_name=None, cpus_per_task=8, gpus=1, nt
         if not isinstance(conda_env, str):
             raise ValueError('The conda environment must be given as a string')
 
+    # Size the time request from the history of the program
+    if time == 'auto':
+        time = sizing.autoResources(program if program != None else job_name,
+                                    'minotauro', partition,
+                                    sizing_options=sizing_options,
+                                    jobs_per_task=group_jobs_by if isinstance(group_jobs_by, int) else 1)[0]
+        time = sizing.timeHours(time)
+
     if partition == 'debug':
         time = 1
     elif partition == 'bsc_ls':
@@ -91,6 +224,29 @@ def jobArrays(jobs, script_name=None, job_name=None, cpus_per_task=8, gpus=1, nt
             print('Setting time at maximum allowed for the bsc_ls partition (48 hours).')
             time=48
 
+    # Select the array IDs to submit, keeping the original job IDs
+    array_ids = list(range(1, len(jobs) + 1))
+    if job_ids != None:
+        array_ids = tricks.arrayIndexes(job_ids, len(jobs))
+    array_specs = tricks.splitArrayIndexes(array_ids, max_length=max_array_spec)
+
+    # Limit the number of running tasks, sharing the budget among the split arrays
+    if throttle == 'auto':
+        task_cpus = ntasks*cpus_per_task
+        task_gpus = gpus
+        throttle = profiles.arrayThrottle('minotauro', partition, cpus=task_cpus, gpus=task_gpus,
+                                          concurrent_arrays=concurrent_arrays*len(array_specs))
+    if throttle != None:
+        array_specs = profiles.throttledSpecs(array_specs, throttle)
+
+    if aggregate_logs != None:
+        logs.setUpAggregatedLogs(log_folder, aggregate_logs, log_shard_size)
+    elif log_shard_size != None:
+        logs.createLogShards(log_folder, len(jobs), log_shard_size)
+
+    if env_snapshot and stage_conda_env:
+        raise ValueError('The environment snapshot cannot be used with a staged conda environment (it is node-local)')
+
     #Write jobs as array
     with open(script_name,'w') as sf:
         sf.write('#!/bin/bash\n')
@@ -101,15 +257,25 @@ def jobArrays(jobs, script_name=None, job_name=None, cpus_per_task=8, gpus=1, nt
         sf.write('#SBATCH --nodes='+str(nodes)+'\n')
         sf.write('#SBATCH --gres gpu:'+str(gpus)+'\n')
         sf.write('#SBATCH --ntasks='+str(ntasks)+'\n')
-        sf.write('#SBATCH --array=1-'+str(len(jobs))+'\n')
+        sf.write('#SBATCH --array='+array_specs[0]+'\n')
         if constraint:
             sf.write('#SBATCH --constraint='+constraint+'\n')
-        sf.write('#SBATCH --output='+output+'_%a_%A.out\n')
-        sf.write('#SBATCH --error='+output+'_%a_%A.err\n')
+        if log_shard_size != None or aggregate_logs != None:
+            sf.write(logs.shardedLogHeader(output, log_folder))
+        else:
+            sf.write('#SBATCH --output='+output+'_%a_%A.out\n')
+            sf.write('#SBATCH --error='+output+'_%a_%A.err\n')
         if mail != None:
             sf.write('#SBATCH --mail-user='+mail+'\n')
             sf.write('#SBATCH --mail-type=END,FAIL\n')
         sf.write('\n')
+        if aggregate_logs != None:
+            sf.write(logs.aggregatedLogRedirection(log_folder, aggregate_logs, log_shard_size))
+        elif log_shard_size != None:
+            sf.write(logs.shardedLogRedirection(output, log_folder, log_shard_size))
+        if job_telemetry:
+            sf.write(telemetry.telemetryStart())
+        preamble_start = sf.tell()
 
         if purge:
             sf.write('module purge\n')
@@ -122,14 +288,21 @@ def jobArrays(jobs, script_name=None, job_name=None, cpus_per_task=8, gpus=1, nt
                 sf.write('module load '+module+'\n')
             sf.write('\n')
         if conda_env != None:
-            sf.write('source activate '+conda_env+'\n')
+            if stage_conda_env:
+                sf.write(staging.stagedCondaEnv(conda_env, stage_dir=env_stage_dir))
+            else:
+                sf.write('source activate '+conda_env+'\n')
             sf.write('\n')
         if pythonpath != None:
             for pp in pythonpath:
                 sf.write('export PYTHONPATH=$PYTHONPATH:'+pp+'\n')
                 sf.write('\n')
 
-    for i in range(len(jobs)):
+        preamble_end = sf.tell()
+        if job_telemetry:
+            sf.write(telemetry.telemetrySetup(telemetry_folder))
+
+    for i in [a-1 for a in array_ids]:
         with open(script_name,'a') as sf:
             sf.write('if [[ $SLURM_ARRAY_TASK_ID = '+str(i+1)+' ]]; then\n')
             sf.write(jobs[i])
@@ -144,8 +317,39 @@ def jobArrays(jobs, script_name=None, job_name=None, cpus_per_task=8, gpus=1, nt
             sf.write('conda deactivate \n')
             sf.write('\n')
 
+    if env_snapshot:
+        staging.snapshotEnvironment(script_name, preamble_start, preamble_end,
+                                    snapshot_dir=env_snapshot_dir)
+
+    # Split the array if its spec does not fit in a single submission
+    if len(array_specs) > 1:
+        tricks.splitArrayScript(script_name, array_specs)
+
+    # Record the commands of each array index in the campaign manifest
+    if manifest_db != None:
+        jobs_per_task = group_jobs_by if isinstance(group_jobs_by, int) else 1
+        if program == 'openmm' and simulations_per_gpu != None:
+            jobs_per_task *= simulations_per_gpu*gpus
+        manifest.recordArrayJobs(manifest_db, commands, 'minotauro', script_name, array_specs,
+                                 jobs_per_task=jobs_per_task, hashes=hashes)
+
+
 def singleJob(job, script_name=None, job_name=None, partition='class_a', cpus=24, time=1,
-              gpus=1, output=None, mail=None, modules=None, conda_env=None, graphical_job=False):
+              gpus=1, output=None, mail=None, modules=None, conda_env=None, graphical_job=False,
+              env_snapshot=False, env_snapshot_dir='.env_snapshots', stage_files=None,
+              manifest_db=None,
+              job_telemetry=False, telemetry_folder='telemetry'):
+
+    # Keep the original command for the campaign manifest
+    command = job
+
+    # Run the job in a node-local scratch folder
+    if stage_files != None:
+        job = staging.stagedJob(job, **stage_files)
+
+    # Record the resources used by the job
+    if job_telemetry:
+        job = telemetry.telemetryJobs([job], telemetry_folder)[0]
 
     available_partitions = ['bsc_ls', 'debug', ]
 
@@ -191,6 +395,9 @@ def singleJob(job, script_name=None, job_name=None, partition='class_a', cpus=24
         sf.write('#@ gpus_per_node = '+str(gpus)+'\n')
         sf.write('#@ X11 = '+str(int(graphical_job))+'\n')
         sf.write('\n')
+        if job_telemetry:
+            sf.write(telemetry.telemetryStart())
+        preamble_start = sf.tell()
 
         if modules != None:
             for module in modules:
@@ -201,8 +408,20 @@ def singleJob(job, script_name=None, job_name=None, partition='class_a', cpus=24
             sf.write('source activate '+conda_env+'\n')
             sf.write('\n')
 
+        preamble_end = sf.tell()
+        if job_telemetry:
+            sf.write(telemetry.telemetrySetup(telemetry_folder))
+
         sf.write(job+'\n')
 
         if conda_env != None:
             sf.write('conda deactivate \n')
             sf.write('\n')
+
+    if env_snapshot:
+        staging.snapshotEnvironment(script_name, preamble_start, preamble_end,
+                                    snapshot_dir=env_snapshot_dir)
+
+    # Record the command in the campaign manifest
+    if manifest_db != None:
+        manifest.recordJobs(manifest_db, [(command, 'minotauro', script_name, None)])
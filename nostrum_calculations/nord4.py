@@ -1,5 +1,18 @@
 import os
 
+from . import tricks
+from . import profiles
+from . import staging
+from . import markers
+from . import manifest
+from . import logs
+from . import telemetry
+from . import sizing
+from . import submission
+
+# Cores available in each Nord4 node
+cores_per_node = 64
+
 
 def jobArrays(
     jobs,
@@ -24,8 +37,31 @@ def jobArrays(
     jobs_range=None,
     group_jobs_by=None,
     mpi=False,
+    mpi_ranks=None,
+    cpus_per_rank=1,
+    mpi_launcher="srun",
     pythonpath=None,
     pathMN=None,
+    stage_conda_env=False,
+    env_stage_dir="/dev/shm",
+    env_snapshot=False,
+    env_snapshot_dir=".env_snapshots",
+    stage_files=None,
+    log_shard_size=None,
+    log_folder="logs",
+    aggregate_logs=None,
+    completion_markers=False,
+    marker_folder="completion_markers",
+    hashes=None,
+    job_ids=None,
+    max_array_spec=1000,
+    throttle=None,
+    concurrent_arrays=1,
+    manifest_db=None,
+    job_telemetry=False,
+    telemetry_folder="telemetry",
+    sizing_options=None,
+    queue_wait=None,
 ):
     """
     Set up job array scripts for marenostrum slurm job manager.
@@ -40,16 +76,116 @@ def jobArrays(
         The range of job IDs to be included in the job array (one-based numbering).
         This restart the indexing of the slurm array IDs, so keep count of the original
         job IDs based on the supplied jobs list. Also, the range includes the last job ID.
-        Useful when large IDs cannot enter the queue.
+        Useful when large IDs cannot enter the queue. The range refers to the jobs
+        list, so the jobs are sliced before grouping (or packing) them.
     group_jobs_by : int
         Group jobs to enter in the same job array (useful for launching many short
         jobs when there are a max_job_allowed limit per user.
+    mpi_ranks : int
+        Number of MPI ranks for the pyrosetta and asitedesign programs (requires
+        mpi=True).
+        The nodes, tasks and cpus per task are computed to fill whole Nord4 nodes and
+        the launcher (with rank-to-core binding) is exported as $MPIRUN, so the jobs
+        must be given as "$MPIRUN python script.py ...".
+    cpus_per_rank : int
+        Cores bound to each MPI rank.
+    mpi_launcher : str
+        Launcher used to start the MPI ranks ('srun' or 'mpirun').
+    stage_conda_env : bool
+        Activate the conda environment from a node-local copy unpacked once per node
+        from a conda-pack tarball (see staging.stagedCondaEnv()), instead of from GPFS.
+    env_stage_dir : str
+        Node-local folder where the conda environment is unpacked.
+    env_snapshot : bool
+        Save the environment set up by the first task (modules, conda, exports) into
+        a snapshot that the following tasks source instead (see staging.snapshotEnvironment()).
+    env_snapshot_dir : str
+        Folder where the environment snapshots are saved.
+    stage_files : (dict, list)
+        Run each job in a node-local scratch folder, copying its inputs there and its
+        outputs back. Give a dictionary with the keys "inputs" (paths) and "outputs"
+        (globs) for all jobs, or a list with one dictionary per job (see staging.stagedJob()).
+    log_shard_size : int
+        Write the output and error files of the tasks into shard subfolders of
+        log_folder (log_folder/<array_index//log_shard_size>/), created up front, instead
+        of a single folder (see logs.collectLogShards() to pack completed shards).
+    log_folder : str
+        Folder containing the log shards.
+    aggregate_logs : str
+        Append the output and error of the tasks, with prefixed lines, to one log file
+        per "node" or per "shard" (of log_shard_size indexes) in log_folder, with a
+        byte-offset index per task, instead of one file pair per task (see
+        logs.aggregatedLogRedirection()).
+    completion_markers : bool
+        Wrap each job so it writes a completion marker (marker_folder/<hash>.done) on
+        success and is skipped when its marker already exists, so a partially failed
+        array can be resubmitted as is (see markers.pendingJobs() to get the pending jobs).
+    marker_folder : str
+        Folder containing the completion markers.
+    hashes : list
+        Hashes of the jobs, one per job, for their completion markers and the campaign
+        manifest (see markers.jobHashes()). Give the ones returned by
+        markers.pendingJobs() when resubmitting the pending jobs of a list, so repeated
+        commands keep their markers.
+    job_ids : list
+        One-based IDs of the jobs to submit (e.g., the failed ones), given as an
+        arbitrary list. The array is submitted with a compressed range spec
+        (e.g., 1-5,9,12-40) keeping the original job IDs.
+    max_array_spec : int
+        Maximum length of the range spec of a single submission. Longer specs are
+        split into several scripts (<script>_<n>.sh) with the same jobs.
+    throttle : (int, str)
+        Maximum number of tasks of the array running at the same time (--array=<spec>%N).
+        Give "auto" to estimate it from the profile of the partition and the resources
+        of each task (see profiles.arrayThrottle()).
+    concurrent_arrays : int
+        Number of arrays of the same campaign running at the same time, which share
+        the budget of the "auto" throttle.
+    manifest_db : str
+        Path to a SQLite campaign manifest where the commands are recorded with their
+        script and array index (see manifest.recordArrayJobs()).
+    job_telemetry : bool
+        Wrap each job to record its wall time, CPU time, maximum RSS and exit code, and
+        timestamp the environment set-up of each task separately, in a per-task record
+        (telemetry_folder/<job_id>_<array_index>.tsv, see telemetry.readTelemetry()).
+    telemetry_folder : str
+        Folder containing the telemetry records.
+    sizing_options : dict
+        Options used to size the time (and memory) requests when time="auto" (see
+        sizing.autoResources()), e.g., {"history_file": "sizing_history.json",
+        "input_size": 5000, "percentile": 95, "margin": 0.2}.
+    queue_wait : dict
+        Expected queue wait (hours) of the partitions, used with partition="auto" to
+        select the partition where the array finishes first (see
+        profiles.selectPartition()). The defaults are in profiles.queue_wait_hours.
     """
 
     # Check input
     if isinstance(jobs, str):
         jobs = [jobs]
 
+    if mpi_ranks != None and not mpi:
+        raise ValueError("mpi_ranks can only be given together with mpi=True")
+
+    # Keep the original commands for the campaign manifest
+    commands = list(jobs)
+
+    # Hash the original commands for the completion markers and the manifest
+    if hashes == None:
+        hashes = markers.jobHashes(jobs)
+
+    # Run the jobs in node-local scratch folders
+    if stage_files != None:
+        jobs = staging.stageJobs(jobs, stage_files)
+
+    # Record the resources used by each job
+    if job_telemetry:
+        jobs = telemetry.telemetryJobs(jobs, telemetry_folder)
+
+    # Skip the jobs with a completion marker and mark the successful ones
+    if completion_markers:
+        jobs = markers.markJobs(jobs, marker_folder, hashes=hashes)
+
     # Check input
     if jobs_range != None:
         if (
@@ -61,6 +197,30 @@ def jobArrays(
                 "The given jobs_range must be a tuple or a list of 2-integers"
             )
 
+        # Slice the jobs before grouping (or packing) them
+        jobs = jobs[jobs_range[0] - 1 : jobs_range[1]]
+        commands = commands[jobs_range[0] - 1 : jobs_range[1]]
+        hashes = hashes[jobs_range[0] - 1 : jobs_range[1]]
+
+    # Choose the partition from the estimated time of the jobs
+    if partition == "auto":
+        task_cpus = tasks if tasks else 1
+        if cpus_per_task:
+            task_cpus *= cpus_per_task
+        elif threads != None:
+            task_cpus *= threads
+        partition, group_jobs_by = sizing.autoPartition(
+            "nord4",
+            time,
+            len(jobs),
+            program=program if program != None else job_name,
+            cpus=task_cpus,
+            group_jobs_by=group_jobs_by,
+            queue_wait=queue_wait,
+            sizing_options=sizing_options,
+            job_ids=job_ids,
+        )
+
     # Group jobs to enter in the same job array (useful for launching many short
     # jobs when there are a max_job_allowed limit per user.)
     if isinstance(group_jobs_by, int):
@@ -203,6 +363,29 @@ def jobArrays(
             modules += ['ANACONDA']
         conda_env = "/gpfs/projects/bsc72/conda_envs/foldseek"
 
+    # Compute the MPI layout for the programs supporting an mpi mode
+    nodes = None
+    ntasks_per_node = None
+    extras = []
+    if mpi and mpi_ranks != None and program in ["pyrosetta", "asitedesign"]:
+        layout = tricks.mpiLayout(
+            mpi_ranks,
+            cores_per_node,
+            cpus_per_rank=cpus_per_rank,
+            launcher=mpi_launcher,
+        )
+        nodes = layout["nodes"]
+        tasks = layout["ntasks"]
+        ntasks_per_node = layout["ntasks_per_node"]
+        cpus_per_task = layout["cpus_per_task"]
+        extras = [
+            "export OMP_NUM_THREADS=" + str(cpus_per_task),
+            'MPIRUN="' + layout["launch"] + '"',
+        ]
+        for i, job in enumerate(jobs):
+            if "$MPIRUN" not in job:
+                print(f"Warning: '$MPIRUN' not found in job #{i}:\n    {job}")
+
     if job_name == None:
         raise ValueError("job_name == None. You need to specify a name for the job")
     if output == None:
@@ -240,6 +423,19 @@ def jobArrays(
         if not isinstance(conda_env, str):
             raise ValueError("The conda environment must be given as a string")
 
+    # Size the time (and memory) requests from the history of the program
+    if time == "auto":
+        time, suggested_mem = sizing.autoResources(
+            program if program != None else job_name,
+            "nord4",
+            partition,
+            sizing_options=sizing_options,
+            jobs_per_task=group_jobs_by if isinstance(group_jobs_by, int) else 1,
+        )
+        time = (time // 60, time % 60)
+        if mem_per_cpu == None:
+            mem_per_cpu = suggested_mem
+
     if isinstance(time, int):
         time = (time, 0)
     if partition == "debug" and cpus_per_task > 64:
@@ -261,9 +457,42 @@ def jobArrays(
             )
             time = (48, 0)
 
-    # Slice jobs if a range is given
-    if jobs_range != None:
-        jobs = jobs[jobs_range[0] - 1 : jobs_range[1]]
+    # Select the array IDs to submit, keeping the original job IDs
+    array_ids = list(range(1, len(jobs) + 1))
+    if job_ids != None:
+        if jobs_range != None:
+            raise ValueError("jobs_range and job_ids cannot be given together")
+        array_ids = tricks.arrayIndexes(job_ids, len(jobs))
+    array_specs = tricks.splitArrayIndexes(array_ids, max_length=max_array_spec)
+
+    # Limit the number of running tasks, sharing the budget among the split arrays
+    if throttle == "auto":
+        task_cpus = tasks if tasks else 1
+        if cpus_per_task:
+            task_cpus *= cpus_per_task
+        elif threads != None:
+            task_cpus *= threads
+        task_gpus = 0
+        throttle = profiles.arrayThrottle(
+            "nord4",
+            partition,
+            cpus=task_cpus,
+            gpus=task_gpus,
+            nodes=nodes,
+            concurrent_arrays=concurrent_arrays * len(array_specs),
+        )
+    if throttle != None:
+        array_specs = profiles.throttledSpecs(array_specs, throttle)
+
+    if aggregate_logs != None:
+        logs.setUpAggregatedLogs(log_folder, aggregate_logs, log_shard_size)
+    elif log_shard_size != None:
+        logs.createLogShards(log_folder, len(jobs), log_shard_size)
+
+    if env_snapshot and stage_conda_env:
+        raise ValueError(
+            "The environment snapshot cannot be used with a staged conda environment (it is node-local)"
+        )
 
     # Write jobs as array
     with open(script_name, "w") as sf:
@@ -272,6 +501,9 @@ def jobArrays(
         sf.write("#SBATCH --job-name=" + job_name + "\n")
         sf.write("#SBATCH --qos=" + partition + "\n")
         sf.write("#SBATCH --time=" + str(time[0]) + ":" + str(time[1]) + ":00\n")
+        if nodes != None:
+            sf.write("#SBATCH --nodes=" + str(nodes) + "\n")
+            sf.write("#SBATCH --ntasks-per-node=" + str(ntasks_per_node) + "\n")
         if tasks:
             sf.write("#SBATCH --ntasks " + str(tasks) + "\n")
         if cpus_per_task:
@@ -282,13 +514,23 @@ def jobArrays(
             sf.write("#SBATCH --mem-per-cpu " + str(mem_per_cpu) + "\n")
         if threads != None:
             sf.write("#SBATCH -c " + str(threads) + "\n")
-        sf.write("#SBATCH --array=1-" + str(len(jobs)) + "\n")
-        sf.write("#SBATCH --output=" + output + "_%a_%A.out\n")
-        sf.write("#SBATCH --error=" + output + "_%a_%A.err\n")
+        sf.write("#SBATCH --array=" + array_specs[0] + "\n")
+        if log_shard_size != None or aggregate_logs != None:
+            sf.write(logs.shardedLogHeader(output, log_folder))
+        else:
+            sf.write("#SBATCH --output=" + output + "_%a_%A.out\n")
+            sf.write("#SBATCH --error=" + output + "_%a_%A.err\n")
         if mail != None:
             sf.write("#SBATCH --mail-user=" + mail + "\n")
             sf.write("#SBATCH --mail-type=END,FAIL\n")
         sf.write("\n")
+        if aggregate_logs != None:
+            sf.write(logs.aggregatedLogRedirection(log_folder, aggregate_logs, log_shard_size))
+        elif log_shard_size != None:
+            sf.write(logs.shardedLogRedirection(output, log_folder, log_shard_size))
+        if job_telemetry:
+            sf.write(telemetry.telemetryStart())
+        preamble_start = sf.tell()
 
         if module_purge:
             sf.write("module purge\n")
@@ -303,7 +545,10 @@ def jobArrays(
         if conda_eval_bash:
             sf.write('eval "$(conda shell.bash hook)"\n')
         if conda_env != None:
-            sf.write("source activate " + conda_env + "\n")
+            if stage_conda_env:
+                sf.write(staging.stagedCondaEnv(conda_env, stage_dir=env_stage_dir))
+            else:
+                sf.write("source activate " + conda_env + "\n")
             sf.write("\n")
 
         for pp in pythonpath:
@@ -314,7 +559,14 @@ def jobArrays(
             sf.write("export PATH=$PATH:" + pp + "\n")
             sf.write("\n")
 
-    for i in range(len(jobs)):
+        preamble_end = sf.tell()
+        if job_telemetry:
+            sf.write(telemetry.telemetrySetup(telemetry_folder))
+
+        for extra in extras:
+            sf.write(extra + "\n")
+
+    for i in [a - 1 for a in array_ids]:
         with open(script_name, "a") as sf:
             sf.write("if [[ $SLURM_ARRAY_TASK_ID = " + str(i + 1) + " ]]; then\n")
             sf.write(jobs[i])
@@ -329,6 +581,28 @@ def jobArrays(
             sf.write("conda deactivate \n")
             sf.write("\n")
 
+    if env_snapshot:
+        staging.snapshotEnvironment(
+            script_name, preamble_start, preamble_end, snapshot_dir=env_snapshot_dir
+        )
+
+    # Split the array if its spec does not fit in a single submission
+    if len(array_specs) > 1:
+        tricks.splitArrayScript(script_name, array_specs)
+
+    # Record the commands of each array index in the campaign manifest
+    if manifest_db != None:
+        jobs_per_task = group_jobs_by if isinstance(group_jobs_by, int) else 1
+        manifest.recordArrayJobs(
+            manifest_db,
+            commands,
+            "nord4",
+            script_name,
+            array_specs,
+            jobs_per_task=jobs_per_task,
+            hashes=hashes,
+        )
+
 
 def singleJob(
     job,
@@ -351,7 +625,25 @@ def singleJob(
     program=None,
     conda_eval_bash=False,
     exports=None,
+    env_snapshot=False,
+    env_snapshot_dir=".env_snapshots",
+    stage_files=None,
+    array_size=None,
+    manifest_db=None,
+    job_telemetry=False,
+    telemetry_folder="telemetry",
 ):
+
+    # Keep the original command for the campaign manifest
+    command = job
+
+    # Run the job in a node-local scratch folder
+    if stage_files != None:
+        job = staging.stagedJob(job, **stage_files)
+
+    # Record the resources used by the job
+    if job_telemetry:
+        job = telemetry.telemetryJobs([job], telemetry_folder)[0]
     available_programs = ["pele", "pyrosetta", "pml", "netsolp"]
     if program != None:
         if program not in available_programs:
@@ -491,12 +783,17 @@ def singleJob(
             sf.write("#SBATCH --mem-per-cpu " + str(mem_per_cpu) + "\n")
         if threads != None:
             sf.write("#SBATCH -c " + str(threads) + "\n")
+        if array_size != None:
+            sf.write("#SBATCH --array=1-" + str(array_size) + "\n")
         sf.write("#SBATCH --output=" + output + "_%a_%A.out\n")
         sf.write("#SBATCH --error=" + output + "_%a_%A.err\n")
         if mail != None:
             sf.write("#SBATCH --mail-user=" + mail + "\n")
             sf.write("#SBATCH --mail-type=END,FAIL\n")
         sf.write("\n")
+        if job_telemetry:
+            sf.write(telemetry.telemetryStart())
+        preamble_start = sf.tell()
 
         if purge:
             sf.write("module purge\n")
@@ -518,6 +815,10 @@ def singleJob(
                 sf.write(f"export {export}\n")
             sf.write("\n")
 
+        preamble_end = sf.tell()
+        if job_telemetry:
+            sf.write(telemetry.telemetrySetup(telemetry_folder))
+
     with open(script_name, "a") as sf:
         sf.write(job)
         if not job.endswith("\n"):
@@ -530,6 +831,15 @@ def singleJob(
             sf.write("conda deactivate \n")
             sf.write("\n")
 
+    if env_snapshot:
+        staging.snapshotEnvironment(
+            script_name, preamble_start, preamble_end, snapshot_dir=env_snapshot_dir
+        )
+
+    # Record the command in the campaign manifest
+    if manifest_db != None:
+        manifest.recordJobs(manifest_db, [(command, "nord4", script_name, None)])
+
 
 def setUpPELEForNord4(
     jobs,
@@ -541,6 +851,12 @@ def setUpPELEForNord4(
     partition="bsc_ls",
     cpus=96,
     time=None,
+    scripts_per_folder=None,
+    as_array=False,
+    incremental=False,
+    workers=8,
+    submit=False,
+    manifest_db=None,
 ):
     """
     Creates submission scripts for Marenostrum for each PELE job inside the jobs variable.
@@ -549,6 +865,25 @@ def setUpPELEForNord4(
     ==========
     jobs : list
         Commands for run PELE. This is the output of the setUpPELECalculation() function.
+    scripts_per_folder : int
+        Maximum number of scripts per subfolder of scripts_folder. The scripts are
+        written into scripts_folder/<job_index//scripts_per_folder>/ instead of a
+        single flat folder.
+    as_array : bool
+        Write a single array job (scripts_folder/pele_array.sh) that reads the PELE job
+        of each array index from a parameter table (scripts_folder/pele_jobs.table),
+        instead of one script and one sbatch call per job.
+    incremental : bool
+        Only render the scripts (and the general script) whose inputs changed since
+        the last call (see tricks.syncScripts()).
+    workers : int
+        Number of threads used to render the changed scripts when incremental is set.
+    submit : bool
+        Submit the scripts after writing them (see submission.submitGeneralScript()),
+        recording their job IDs in submission_manifest.json.
+    manifest_db : str
+        Path to a SQLite campaign manifest where the PELE jobs are recorded with their
+        script (and array index), and with their job IDs when submitted.
     """
 
     if not isinstance(jobs, list):
@@ -558,18 +893,74 @@ def setUpPELEForNord4(
         os.mkdir(scripts_folder)
 
     zfill = len(str(len(jobs)))
-    with open(general_script, "w") as ps:
-        for i, job in enumerate(jobs):
-            job_name = str(i + 1).zfill(zfill) + "_" + job.split("\n")[0].split("/")[-1]
-            singleJob(
-                job,
-                cpus=cpus,
-                partition=partition,
-                program="pele",
-                time=time,
-                job_name=job_name,
-                script_name=scripts_folder + "/" + job_name + ".sh",
-            )
+    job_names = []
+    for i, job in enumerate(jobs):
+        job_names.append(str(i + 1).zfill(zfill) + "_" + job.split("\n")[0].split("/")[-1])
+
+    # Write a single array job reading each PELE job from a parameter table
+    if as_array:
+        table_file = scripts_folder + "/pele_jobs.table"
+        array_script = scripts_folder + "/pele_array.sh"
+        array_name = os.path.basename(general_script).replace(".sh", "")
+        tricks.writeJobTable(jobs, table_file, names=job_names)
+        singleJob(
+            tricks.jobTableDispatch(table_file),
+            cpus=cpus,
+            partition=partition,
+            program="pele",
+            time=time,
+            job_name=array_name,
+            script_name=array_script,
+            array_size=len(jobs),
+        )
+        with open(general_script, "w") as ps:
             if print_name:
-                ps.write("echo Launching job " + job_name + "\n")
-            ps.write("sbatch -A "+account+' -q '+qos+' '+ scripts_folder + "/" + job_name + ".sh\n")
+                ps.write("echo Launching " + str(len(jobs)) + " jobs as an array\n")
+            ps.write("sbatch -A "+account+' -q '+qos+' '+ array_script + "\n")
+        if manifest_db != None:
+            manifest.recordJobs(
+                manifest_db,
+                [(job, "nord4", array_script, i + 1) for i, job in enumerate(jobs)],
+            )
+        if submit:
+            submission.submitGeneralScript(general_script, manifest_db=manifest_db)
+        return
+
+    manifest_rows = []
+    scripts = {}
+    general_lines = []
+    for i, job in enumerate(jobs):
+        job_name = job_names[i]
+        script_name = tricks.shardedScriptPath(
+            scripts_folder, i, scripts_per_folder, job_name + ".sh"
+        )
+        manifest_rows.append((job, "nord4", script_name, None))
+        scripts[script_name] = {
+                "job": job,
+                "cpus": cpus,
+                "partition": partition,
+                "program": "pele",
+                "time": time,
+                "job_name": job_name,
+        }
+        if print_name:
+            general_lines.append("echo Launching job " + job_name + "\n")
+        general_lines.append("sbatch -A "+account+' -q '+qos+' '+ script_name + "\n")
+
+    # Only render the scripts whose inputs changed since the last call
+    if incremental:
+        tricks.syncScripts(
+            scripts, singleJob, scripts_folder + "/.script_hashes", workers=workers
+        )
+        tricks.writeIfChanged(general_script, "".join(general_lines))
+    else:
+        for script_name, arguments in scripts.items():
+            singleJob(script_name=script_name, **arguments)
+        with open(general_script, "w") as ps:
+            ps.write("".join(general_lines))
+
+    if manifest_db != None:
+        manifest.recordJobs(manifest_db, manifest_rows)
+
+    if submit:
+        submission.submitGeneralScript(general_script, manifest_db=manifest_db)
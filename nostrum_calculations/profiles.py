@@ -0,0 +1,342 @@
+import math
+
+# Per-cluster profiles. For each partition (or QOS): cores and GPUs per node, maximum
+# wall time (hours), maximum number of running jobs per user and number of nodes
+# the group can use concurrently without starving its fair-share. The limits are
+# the usual ones of our accounts; update them if the QOS limits change.
+cluster_profiles = {
+    "mn5": {
+        "gp_debug": {"cores_per_node": 112, "gpus_per_node": 0, "max_time": 2,
+                     "max_running_jobs": 4, "max_nodes": 8},
+        "gp_bscls": {"cores_per_node": 112, "gpus_per_node": 0, "max_time": 48,
+                     "max_running_jobs": 100, "max_nodes": 50},
+        "acc_debug": {"cores_per_node": 80, "gpus_per_node": 4, "max_time": 2,
+                      "max_running_jobs": 4, "max_nodes": 4},
+        "acc_bscls": {"cores_per_node": 80, "gpus_per_node": 4, "max_time": 48,
+                      "max_running_jobs": 100, "max_nodes": 25},
+    },
+    "marenostrum": {
+        "debug": {"cores_per_node": 48, "gpus_per_node": 0, "max_time": 2,
+                  "max_running_jobs": 4, "max_nodes": 16},
+        "bsc_ls": {"cores_per_node": 48, "gpus_per_node": 0, "max_time": 48,
+                   "max_running_jobs": 300, "max_nodes": 100},
+    },
+    "nord3": {
+        "debug": {"cores_per_node": 16, "gpus_per_node": 0, "max_time": 2,
+                  "max_running_jobs": 4, "max_nodes": 4},
+        "bsc_ls": {"cores_per_node": 16, "gpus_per_node": 0, "max_time": 48,
+                   "max_running_jobs": 100, "max_nodes": 50},
+    },
+    "nord4": {
+        "debug": {"cores_per_node": 64, "gpus_per_node": 0, "max_time": 2,
+                  "max_running_jobs": 4, "max_nodes": 4},
+        "bsc_ls": {"cores_per_node": 64, "gpus_per_node": 0, "max_time": 48,
+                   "max_running_jobs": 100, "max_nodes": 25},
+    },
+    "amd": {
+        "debug": {"cores_per_node": 64, "gpus_per_node": 2, "max_time": 2,
+                  "max_running_jobs": 4, "max_nodes": 2},
+        "bsc_ls": {"cores_per_node": 64, "gpus_per_node": 2, "max_time": 48,
+                   "max_running_jobs": 50, "max_nodes": 16},
+    },
+    "cte_power": {
+        "debug": {"cores_per_node": 160, "gpus_per_node": 4, "max_time": 2,
+                  "max_running_jobs": 4, "max_nodes": 2},
+        "bsc_ls": {"cores_per_node": 160, "gpus_per_node": 4, "max_time": 48,
+                   "max_running_jobs": 100, "max_nodes": 20},
+    },
+    "minotauro": {
+        "debug": {"cores_per_node": 16, "gpus_per_node": 4, "max_time": 1,
+                  "max_running_jobs": 4, "max_nodes": 2},
+        "bsc_ls": {"cores_per_node": 16, "gpus_per_node": 4, "max_time": 48,
+                   "max_running_jobs": 100, "max_nodes": 20},
+    },
+    "bright": {
+        "short": {"cores_per_node": 32, "gpus_per_node": 0, "max_time": 2,
+                  "max_running_jobs": 20, "max_nodes": 5},
+        "gpu_short": {"cores_per_node": 32, "gpus_per_node": 4, "max_time": 8,
+                      "max_running_jobs": 20, "max_nodes": 5},
+        "standard-gpu": {"cores_per_node": 32, "gpus_per_node": 4, "max_time": 48,
+                         "max_running_jobs": 50, "max_nodes": 5},
+        "standard-cpu": {"cores_per_node": 32, "gpus_per_node": 0, "max_time": 48,
+                         "max_running_jobs": 50, "max_nodes": 5},
+    },
+}
+
+
+def partitionProfile(cluster, partition):
+    """
+    Returns the profile of a partition of a cluster.
+
+    Parameters
+    ==========
+    cluster : str
+        Name of the cluster (the name of its module, e.g., "mn5").
+    partition : str
+        Partition (or QOS) of the cluster.
+
+    Returns
+    =======
+    profile : dict
+    """
+
+    if cluster not in cluster_profiles:
+        raise ValueError(
+            "Cluster profile not found. Available clusters are: "
+            + ", ".join(cluster_profiles)
+        )
+    if partition not in cluster_profiles[cluster]:
+        raise ValueError(
+            "Partition profile not found. Available partitions for "
+            + cluster
+            + " are: "
+            + ", ".join(cluster_profiles[cluster])
+        )
+
+    return cluster_profiles[cluster][partition]
+
+
+def arrayThrottle(cluster, partition, cpus=1, gpus=0, nodes=None, concurrent_arrays=1):
+    """
+    Estimates the array throttle (the N of --array=<spec>%N) of an array job, so its
+    running tasks fit in the node budget and the running jobs limit of the partition.
+    Arrays of the same campaign running at the same time share the budget.
+
+    Parameters
+    ==========
+    cluster : str
+        Name of the cluster (the name of its module, e.g., "mn5").
+    partition : str
+        Partition (or QOS) of the cluster.
+    cpus : int
+        Cores requested by each array task.
+    gpus : int
+        GPUs requested by each array task.
+    nodes : int
+        Whole nodes requested by each array task (e.g., MPI jobs). Overrides cpus
+        and gpus.
+    concurrent_arrays : int
+        Number of arrays of the campaign sharing the budget.
+
+    Returns
+    =======
+    throttle : int
+    """
+
+    profile = partitionProfile(cluster, partition)
+
+    if not isinstance(concurrent_arrays, int) or concurrent_arrays < 1:
+        raise ValueError("concurrent_arrays must be a positive integer")
+
+    if nodes != None:
+        running_tasks = profile["max_nodes"] // nodes
+    else:
+        cpus = max(cpus, 1)
+        if cpus > profile["cores_per_node"]:
+            raise ValueError(
+                "The requested cores per task ("
+                + str(cpus)
+                + ") exceed the cores per node of the partition ("
+                + str(profile["cores_per_node"])
+                + ")"
+            )
+        tasks_per_node = profile["cores_per_node"] // cpus
+        if gpus:
+            if gpus > profile["gpus_per_node"]:
+                raise ValueError(
+                    "The requested GPUs per task ("
+                    + str(gpus)
+                    + ") exceed the GPUs per node of the partition ("
+                    + str(profile["gpus_per_node"])
+                    + ")"
+                )
+            tasks_per_node = min(tasks_per_node, profile["gpus_per_node"] // gpus)
+        running_tasks = profile["max_nodes"] * tasks_per_node
+
+    running_tasks = min(running_tasks, profile["max_running_jobs"])
+    throttle = max(running_tasks // concurrent_arrays, 1)
+
+    return throttle
+
+
+def throttledSpecs(array_specs, throttle):
+    """
+    Appends the %N throttle to a list of array specs.
+
+    Parameters
+    ==========
+    array_specs : list
+        Array specs (see tricks.splitArrayIndexes()).
+    throttle : int
+        Maximum number of running tasks of each array.
+
+    Returns
+    =======
+    array_specs : list
+    """
+
+    if not isinstance(throttle, int) or throttle < 1:
+        raise ValueError('The throttle must be a positive integer or "auto"')
+
+    return [spec + "%" + str(throttle) for spec in array_specs]
+
+
+# Expected queue wait (hours) of each partition, used by selectPartition(). Rough
+# figures of our usual campaigns; give measured ones with the queue_wait option.
+queue_wait_hours = {
+    "mn5": {"gp_debug": 0.1, "gp_bscls": 4, "acc_debug": 0.1, "acc_bscls": 6},
+    "marenostrum": {"debug": 0.1, "bsc_ls": 4},
+    "nord3": {"debug": 0.1, "bsc_ls": 2},
+    "nord4": {"debug": 0.1, "bsc_ls": 2},
+    "amd": {"debug": 0.1, "bsc_ls": 2},
+    "cte_power": {"debug": 0.1, "bsc_ls": 4},
+    "minotauro": {"debug": 0.1, "bsc_ls": 4},
+    "bright": {"short": 0.1, "gpu_short": 0.25, "standard-gpu": 2, "standard-cpu": 1},
+}
+
+
+def selectPartition(
+    cluster,
+    job_time,
+    n_jobs,
+    cpus=1,
+    gpus=0,
+    nodes=None,
+    partitions=None,
+    group_jobs_by=None,
+    queue_wait=None,
+    regroup=True,
+    strict=False,
+):
+    """
+    Selects the partition where an array of jobs finishes first, from the estimated
+    time of each job, the resources of each task and the expected queue wait of each
+    partition. The array is expected to finish after the queue wait plus as many
+    waves of tasks as needed with the running tasks allowed by the partition (see
+    arrayThrottle()). Partitions whose time limit is shorter than a job are
+    discarded, and grouped jobs are regrouped to fit the time limit (unless regroup
+    is False, e.g., when array indexes are selected, since regrouping changes them).
+
+    Parameters
+    ==========
+    cluster : str
+        Name of the cluster (the name of its module, e.g., "mn5").
+    job_time : float
+        Estimated time of each job in minutes. None selects the partition with the
+        longest time limit.
+    n_jobs : int
+        Number of jobs of the array.
+    cpus : int
+        Cores requested by each task.
+    gpus : int
+        GPUs requested by each task. GPU partitions are only selected for GPU tasks,
+        unless the cluster only has GPU partitions.
+    nodes : int
+        Whole nodes requested by each task.
+    partitions : list
+        Candidate partitions (all the partitions of the cluster by default).
+    group_jobs_by : int
+        Jobs run one after the other by each task.
+    queue_wait : dict
+        Expected queue wait (hours) of the partitions, overriding queue_wait_hours.
+    regroup : bool
+        Regroup the jobs to fit the time limit of the partitions. If False, the
+        partitions where the groups do not fit are discarded.
+    strict : bool
+        Raise an error when the jobs do not fit the time limit of any partition,
+        instead of selecting the partition with the longest time limit (e.g., for
+        clusters whose jobs cannot be grouped or split).
+
+    Returns
+    =======
+    partition : str
+    group_jobs_by : int
+        Jobs run by each task in the selected partition (None if not grouped).
+    """
+
+    if partitions == None:
+        partitions = list(cluster_profiles.get(cluster, {}))
+    partition_profiles = {p: partitionProfile(cluster, p) for p in partitions}
+
+    # Keep the partitions with the requested resources
+    cpu_partitions = [
+        p for p in partitions if partition_profiles[p]["gpus_per_node"] == 0
+    ]
+    candidates = []
+    for p in partitions:
+        if gpus and partition_profiles[p]["gpus_per_node"] < gpus:
+            continue
+        if not gpus and cpu_partitions != [] and p not in cpu_partitions:
+            continue
+        if nodes == None and cpus > partition_profiles[p]["cores_per_node"]:
+            continue
+        if nodes != None and nodes > partition_profiles[p]["max_nodes"]:
+            continue
+        candidates.append(p)
+    if candidates == []:
+        raise ValueError(
+            "No partition of " + cluster + " has the resources requested by each task"
+        )
+
+    longest = max(candidates, key=lambda p: partition_profiles[p]["max_time"])
+    if job_time == None:
+        return longest, group_jobs_by
+
+    waits = dict(queue_wait_hours.get(cluster, {}))
+    if queue_wait != None:
+        waits.update(queue_wait)
+
+    group = group_jobs_by if isinstance(group_jobs_by, int) else 1
+    best = None
+    for p in candidates:
+        max_minutes = partition_profiles[p]["max_time"] * 60
+        if job_time > max_minutes:
+            continue
+        p_group = min(group, max(int(max_minutes // job_time), 1))
+        if not regroup and p_group != group:
+            continue
+        tasks = int(math.ceil(n_jobs / p_group))
+        running = arrayThrottle(cluster, p, cpus=cpus, gpus=gpus, nodes=nodes)
+        finish = waits.get(p, 0) * 60 + math.ceil(tasks / running) * job_time * p_group
+        if best == None or finish < best[0]:
+            best = (finish, p, p_group)
+
+    if best == None:
+        if not regroup and partition_profiles[longest]["max_time"] * 60 >= job_time:
+            raise ValueError(
+                "The groups of "
+                + str(group)
+                + " jobs exceed the time limit of all the partitions and cannot be"
+                + " regrouped, since regrouping changes the selected array indexes."
+                + " Give a smaller group_jobs_by."
+            )
+        message = (
+            "The estimated time of each job ("
+            + str(round(job_time / 60, 1))
+            + " hours) exceeds the time limit of all the partitions."
+        )
+        if strict:
+            raise ValueError(
+                message + " Split the jobs (e.g., in restart chunks) to fit them."
+            )
+        print(
+            message
+            + " Using "
+            + longest
+            + "; split the jobs (e.g., in restart chunks) to fit its time limit."
+        )
+        return longest, group_jobs_by
+
+    finish, partition, p_group = best
+    if p_group != group:
+        print(
+            "Grouping "
+            + str(p_group)
+            + " jobs per task to fit the time limit of the "
+            + partition
+            + " partition."
+        )
+    if not isinstance(group_jobs_by, int) and p_group == 1:
+        p_group = None
+
+    return partition, p_group
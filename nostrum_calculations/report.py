@@ -0,0 +1,351 @@
+import math
+from datetime import datetime
+from functools import lru_cache
+
+from . import sizing
+
+# Fields needed by efficiencyReport() (Cluster and AllocTRES are optional)
+report_fields = [
+    "JobID",
+    "JobName",
+    "Cluster",
+    "State",
+    "Submit",
+    "Start",
+    "ElapsedRaw",
+    "TotalCPU",
+    "AllocCPUS",
+    "AllocNodes",
+    "ReqMem",
+    "MaxRSS",
+    "AllocTRES",
+]
+
+# Positions of the accumulated metrics of each group
+_JOBS, _ELAPSED, _CPU_ALLOC, _CPU_USED, _GPU, _CPUS = 0, 1, 2, 3, 4, 5
+_WAIT, _WAIT_MAX, _WAIT_JOBS, _MEM_REQ, _MEM_USED = 6, 7, 8, 9, 10
+
+
+def sacctCommand(start_time, end_time=None, user=None):
+    """
+    Returns the sacct command whose output (saved to a file) is read by
+    efficiencyReport().
+
+    Parameters
+    ==========
+    start_time : str
+        Start of the period (e.g., 2024-01-01).
+    end_time : str
+        End of the period (now by default).
+    user : str
+        User whose jobs are reported (the current user by default).
+
+    Returns
+    =======
+    command : str
+    """
+
+    command = "sacct --parsable2 -S " + start_time
+    if end_time != None:
+        command += " -E " + end_time
+    if user != None:
+        command += " -u " + user
+    command += " -o " + ",".join(report_fields)
+
+    return command
+
+
+@lru_cache(maxsize=65536)
+def _timestamp(value):
+    """
+    Converts a sacct date into seconds since the epoch (None if unknown). Cached,
+    since the tasks of an array share their submit time.
+    """
+
+    if value in ["", "Unknown", "None"]:
+        return None
+
+    return datetime.fromisoformat(value).timestamp()
+
+
+def _allocatedGPUs(tres):
+    """
+    Returns the GPUs of an AllocTRES field (e.g., cpu=20,gres/gpu=1,mem=8G).
+    """
+
+    i = tres.find("gres/gpu=")
+    if i == -1:
+        return 0
+    value = tres[i + 9 :].split(",", 1)[0]
+
+    return int(value) if value.isdigit() else 0
+
+
+def _readSacctFile(sacct_file, cluster, jobs):
+    """
+    Adds the jobs of a sacct --parsable2 file to a dictionary of job records
+    ([array, program, cluster, metrics...]). Steps only contribute their MaxRSS.
+    """
+
+    with open(sacct_file) as sf:
+        header = sf.readline().rstrip("\n").split("|")
+        column = {field: i for i, field in enumerate(header)}
+        for field in ["JobID", "JobName", "State", "AllocCPUS", "TotalCPU"]:
+            if field not in column:
+                raise ValueError(sacct_file + " has no " + field + " field")
+        if "ElapsedRaw" not in column and "Elapsed" not in column:
+            raise ValueError(sacct_file + " has no Elapsed or ElapsedRaw field")
+
+        c_job = column["JobID"]
+        c_name = column["JobName"]
+        c_state = column["State"]
+        c_cpus = column["AllocCPUS"]
+        c_total = column["TotalCPU"]
+        c_elapsed_raw = column.get("ElapsedRaw")
+        c_elapsed = column.get("Elapsed")
+        c_cluster = column.get("Cluster")
+        c_submit = column.get("Submit")
+        c_start = column.get("Start")
+        c_nodes = column.get("AllocNodes")
+        c_req_mem = column.get("ReqMem")
+        c_rss = column.get("MaxRSS")
+        c_tres = column.get("AllocTRES")
+        n_fields = len(header)
+
+        for line in sf:
+            ls = line.rstrip("\n").split("|")
+            if len(ls) != n_fields:
+                continue
+            job = ls[c_job]
+
+            # Steps: keep the maximum RSS of the job
+            if "." in job:
+                if c_rss == None or ls[c_rss] == "":
+                    continue
+                record = jobs.get(job.split(".", 1)[0])
+                if record != None:
+                    rss = sizing.parseMemory(ls[c_rss])
+                    if rss > record[3]:
+                        record[3] = rss
+                continue
+
+            if ls[c_state] == "PENDING":
+                continue
+
+            if c_elapsed_raw != None:
+                elapsed = float(ls[c_elapsed_raw] or 0)
+            else:
+                elapsed = sizing.parseElapsed(ls[c_elapsed]) or 0.0
+            if elapsed <= 0:
+                continue
+            cpus = int(ls[c_cpus] or 0)
+
+            wait = None
+            if c_submit != None and c_start != None:
+                start = _timestamp(ls[c_start])
+                submit = _timestamp(ls[c_submit])
+                if start != None and submit != None:
+                    wait = max(start - submit, 0)
+
+            req_mem = None
+            if c_req_mem != None and ls[c_req_mem] != "":
+                req_mem = sizing.parseMemory(ls[c_req_mem])
+                if ls[c_req_mem].endswith("c"):
+                    req_mem *= cpus
+                elif ls[c_req_mem].endswith("n") and c_nodes != None:
+                    req_mem *= int(ls[c_nodes] or 1)
+
+            jobs[job] = [
+                job.split("_", 1)[0],
+                ls[c_name],
+                ls[c_cluster] if c_cluster != None else cluster,
+                0.0,
+                elapsed,
+                cpus,
+                sizing.parseElapsed(ls[c_total]) or 0.0,
+                _allocatedGPUs(ls[c_tres]) if c_tres != None else 0,
+                wait,
+                req_mem,
+            ]
+
+
+def _summary(metrics):
+    """
+    Converts the accumulated metrics of a group into its report entry.
+    """
+
+    entry = {
+        "jobs": metrics[_JOBS],
+        "mean_cpus": metrics[_CPUS] / metrics[_JOBS],
+        "cpu_hours": metrics[_CPU_ALLOC] / 3600,
+        "cpu_efficiency": None,
+        "memory_efficiency": None,
+        "gpu_hours": metrics[_GPU] / 3600,
+        "mean_wait_hours": None,
+        "max_wait_hours": None,
+    }
+    if metrics[_CPU_ALLOC] > 0:
+        entry["cpu_efficiency"] = metrics[_CPU_USED] / metrics[_CPU_ALLOC]
+    if metrics[_MEM_REQ] > 0:
+        entry["memory_efficiency"] = metrics[_MEM_USED] / metrics[_MEM_REQ]
+    if metrics[_WAIT_JOBS] > 0:
+        entry["mean_wait_hours"] = metrics[_WAIT] / metrics[_WAIT_JOBS] / 3600
+        entry["max_wait_hours"] = metrics[_WAIT_MAX] / 3600
+
+    return entry
+
+
+def efficiencyReport(sacct_files, cluster=None):
+    """
+    Computes the CPU efficiency, memory efficiency, GPU-hours and queue wait of the
+    jobs of saved "sacct --parsable2" outputs (see sacctCommand()), per array, per
+    program (job name) and per cluster. The files are read in a single pass,
+    keeping only one record per job, so outputs with millions of rows can be
+    reported offline.
+
+    Parameters
+    ==========
+    sacct_files : (str, list, dict)
+        Paths to the sacct outputs, or a dictionary with the cluster names as keys
+        and the paths as values (for outputs without a Cluster field).
+    cluster : str
+        Cluster of the outputs without a Cluster field, when the paths are not given
+        as a dictionary.
+
+    Returns
+    =======
+    report : dict
+        Dictionary with the keys "array", "program" and "cluster", each with a
+        dictionary of report entries (jobs, mean_cpus, cpu_hours, cpu_efficiency,
+        memory_efficiency, gpu_hours, mean_wait_hours, max_wait_hours). The array
+        keys are (cluster, array_job_id) tuples.
+    """
+
+    if isinstance(sacct_files, str):
+        sacct_files = [sacct_files]
+    if not isinstance(sacct_files, dict):
+        sacct_files = {cluster: sacct_files}
+
+    jobs = {}
+    for file_cluster, files in sacct_files.items():
+        if isinstance(files, str):
+            files = [files]
+        for sacct_file in files:
+            _readSacctFile(sacct_file, file_cluster, jobs)
+
+    groups = {"array": {}, "program": {}, "cluster": {}}
+    for array, program, job_cluster, rss, elapsed, cpus, used, gpus, wait, req_mem in jobs.values():
+        keys = {"array": (job_cluster, array), "program": program, "cluster": job_cluster}
+        for level, key in keys.items():
+            metrics = groups[level].get(key)
+            if metrics == None:
+                metrics = groups[level][key] = [0, 0.0, 0.0, 0.0, 0.0, 0, 0.0, 0.0, 0, 0.0, 0.0]
+            metrics[_JOBS] += 1
+            metrics[_ELAPSED] += elapsed
+            metrics[_CPU_ALLOC] += elapsed * cpus
+            metrics[_CPU_USED] += used
+            metrics[_GPU] += elapsed * gpus
+            metrics[_CPUS] += cpus
+            if wait != None:
+                metrics[_WAIT] += wait
+                metrics[_WAIT_JOBS] += 1
+                if wait > metrics[_WAIT_MAX]:
+                    metrics[_WAIT_MAX] = wait
+            if req_mem and rss:
+                metrics[_MEM_REQ] += req_mem
+                metrics[_MEM_USED] += rss
+
+    report = {}
+    for level in groups:
+        report[level] = {key: _summary(m) for key, m in groups[level].items()}
+
+    return report
+
+
+def overallocatedArrays(report, max_efficiency=0.25, min_cpus=8):
+    """
+    Returns the arrays of a report that request many cores but use few of them
+    (e.g., 112 cores requested and 4 used), with the number of cores their tasks
+    actually use.
+
+    Parameters
+    ==========
+    report : dict
+        Report given by efficiencyReport().
+    max_efficiency : float
+        Flag the arrays with a CPU efficiency below this value.
+    min_cpus : int
+        Flag only the arrays requesting at least these cores per task.
+
+    Returns
+    =======
+    arrays : list
+        List of ((cluster, array_job_id), mean_cpus, used_cpus) tuples, sorted by
+        the wasted CPU-hours.
+    """
+
+    arrays = []
+    for key, entry in report["array"].items():
+        if entry["cpu_efficiency"] == None or entry["mean_cpus"] < min_cpus:
+            continue
+        if entry["cpu_efficiency"] < max_efficiency:
+            used_cpus = max(int(math.ceil(entry["mean_cpus"] * entry["cpu_efficiency"])), 1)
+            wasted = entry["cpu_hours"] * (1 - entry["cpu_efficiency"])
+            arrays.append((wasted, key, entry["mean_cpus"], used_cpus))
+
+    arrays.sort(reverse=True)
+
+    return [(key, mean_cpus, used_cpus) for wasted, key, mean_cpus, used_cpus in arrays]
+
+
+def writeReport(report, output_file, max_efficiency=0.25, min_cpus=8):
+    """
+    Writes an efficiency report as a text file, with one table per level and the
+    list of over-allocated arrays (see overallocatedArrays()).
+
+    Parameters
+    ==========
+    report : dict
+        Report given by efficiencyReport().
+    output_file : str
+        Path to the report file.
+    max_efficiency : float
+        CPU efficiency below which arrays are flagged.
+    min_cpus : int
+        Cores per task from which arrays are flagged.
+    """
+
+    def _format(value):
+        if value == None:
+            return "-"
+        if isinstance(value, float):
+            return "%.2f" % value
+        return str(value)
+
+    columns = [
+        "jobs",
+        "mean_cpus",
+        "cpu_hours",
+        "cpu_efficiency",
+        "memory_efficiency",
+        "gpu_hours",
+        "mean_wait_hours",
+        "max_wait_hours",
+    ]
+
+    with open(output_file, "w") as rf:
+        for level in ["cluster", "program", "array"]:
+            rf.write("# Per " + level + "\n")
+            rf.write("\t".join([level] + columns) + "\n")
+            for key in sorted(report[level], key=str):
+                name = "_".join([str(k) for k in key]) if isinstance(key, tuple) else str(key)
+                entry = report[level][key]
+                rf.write("\t".join([name] + [_format(entry[c]) for c in columns]) + "\n")
+            rf.write("\n")
+
+        rf.write("# Over-allocated arrays\n")
+        rf.write("array\tmean_cpus\tused_cpus\n")
+        for key, mean_cpus, used_cpus in overallocatedArrays(
+            report, max_efficiency=max_efficiency, min_cpus=min_cpus
+        ):
+            rf.write("_".join([str(k) for k in key]) + "\t" + _format(mean_cpus) + "\t" + str(used_cpus) + "\n")
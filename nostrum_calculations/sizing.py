@@ -0,0 +1,594 @@
+import os
+import json
+import math
+
+from . import profiles
+from . import telemetry
+
+# Maximum number of samples kept for each (program, cluster, input-size bucket)
+max_samples = 1000
+
+
+def sizeBucket(input_size):
+    """
+    Returns the input-size bucket of a job. Buckets are powers of two of the input
+    size (e.g., number of atoms or residues), so jobs of similar size share their
+    history.
+
+    Parameters
+    ==========
+    input_size : (int, float)
+        Size of the input of the job. None gives the bucket of all the sizes.
+
+    Returns
+    =======
+    bucket : str
+    """
+
+    if input_size == None:
+        return "any"
+
+    return str(int(math.log2(max(input_size, 1))))
+
+
+def readHistory(history_file):
+    """
+    Reads a sizing history file (see addSamples()).
+
+    Parameters
+    ==========
+    history_file : str
+        Path to the JSON history file.
+
+    Returns
+    =======
+    history : dict
+    """
+
+    if not os.path.exists(history_file):
+        return {}
+
+    with open(history_file) as hf:
+        return json.load(hf)
+
+
+def addSamples(history_file, program, cluster, samples, input_size=None):
+    """
+    Adds resource usage samples of a program to a sizing history file. Samples are
+    added both to the bucket of their input size and to the bucket of all the sizes,
+    keeping the last max_samples of each.
+
+    Parameters
+    ==========
+    history_file : str
+        Path to the JSON history file.
+    program : str
+        Name of the program (or of the kind of job).
+    cluster : str
+        Name of the cluster (the name of its module, e.g., "mn5").
+    samples : list
+        (wall_time, mem_per_cpu) or (wall_time, mem_per_cpu, setup_time) tuples, in
+        seconds and MB. The set-up time of a task (modules, conda, ...) is given once
+        per task, with one of its jobs, and is not included in the wall time of the
+        jobs. Use None for an unknown memory usage or set-up time.
+    input_size : (int, float, list)
+        Size of the input of the jobs, or a list with the size of each sample.
+
+    Returns
+    =======
+    added : int
+        Number of samples added.
+    """
+
+    if not isinstance(input_size, list):
+        input_size = [input_size] * len(samples)
+    if len(input_size) != len(samples):
+        raise ValueError("One input size must be given for each sample")
+
+    history = readHistory(history_file)
+    for sample, size in zip(samples, input_size):
+        wall, mem = sample[:2]
+        setup = sample[2] if len(sample) > 2 else None
+        buckets = ["any"]
+        if size != None:
+            buckets.append(sizeBucket(size))
+        for bucket in buckets:
+            key = "|".join([program, cluster, bucket])
+            history.setdefault(key, []).append([wall, mem, setup])
+
+    for key in history:
+        history[key] = history[key][-max_samples:]
+
+    with open(history_file + ".tmp", "w") as hf:
+        json.dump(history, hf)
+    os.replace(history_file + ".tmp", history_file)
+
+    return len(samples)
+
+
+def addTelemetrySamples(
+    history_file, telemetry_folder, program, cluster, cpus=1, input_sizes=None
+):
+    """
+    Adds the successful jobs of a telemetry folder (see telemetry.readTelemetry()) to
+    a sizing history file. The set-up time of each task is added once, with the
+    sample of its first successful job, as a separate term (see suggestResources()).
+
+    The maximum RSS of the records is the peak of the whole task, so the memory
+    usage of a task with grouped jobs is added once, with the sample of its last job
+    (the other jobs of the task are added without memory usage).
+
+    Parameters
+    ==========
+    history_file : str
+        Path to the JSON history file.
+    telemetry_folder : str
+        Folder containing the telemetry records.
+    program : str
+        Name of the program (or of the kind of job).
+    cluster : str
+        Name of the cluster (the name of its module, e.g., "mn5").
+    cpus : int
+        Cores allocated to each task, to get the memory usage per core.
+    input_sizes : dict
+        Input size of the jobs, with their one-based position in the jobs list (the
+        payload of the records) as keys.
+
+    Returns
+    =======
+    added : int
+        Number of samples added.
+    """
+
+    records = telemetry.readTelemetry(telemetry_folder)
+
+    # Last record of each task, holding the peak of the whole task
+    last_records = {}
+    for record in records:
+        task = (record["job_id"], record["task"])
+        if (
+            task not in last_records
+            or record["task_jobs"] >= last_records[task]["task_jobs"]
+        ):
+            last_records[task] = record
+
+    samples = []
+    sizes = []
+    set_up_tasks = set()
+    for record in records:
+        if record["exit_code"] != 0:
+            continue
+        task = (record["job_id"], record["task"])
+        mem = None
+        if last_records[task] is record and record["max_rss"] != None:
+            mem = record["max_rss"] / 1024 / max(cpus, 1)
+        setup = None
+        if task not in set_up_tasks:
+            setup = record["setup"]
+            set_up_tasks.add(task)
+        samples.append((record["wall"], mem, setup))
+        sizes.append(input_sizes.get(record["payload"]) if input_sizes != None else None)
+
+    return addSamples(history_file, program, cluster, samples, input_size=sizes)
+
+
+def parseElapsed(value):
+    """
+    Converts a SLURM time ([D-]HH:MM:SS, MM:SS.mmm, ...) into seconds.
+
+    Parameters
+    ==========
+    value : str
+        SLURM time (e.g., the Elapsed or Timelimit fields of sacct).
+
+    Returns
+    =======
+    seconds : float
+        None for empty or unlimited values.
+    """
+
+    if value in ["", "UNLIMITED", "Partition_Limit", "INVALID"]:
+        return None
+
+    days = 0
+    parts = value.split(":")
+    if "-" in value:
+        days, value = value.split("-", 1)
+        # D-HH, D-HH:MM and D-HH:MM:SS
+        parts = value.split(":")
+        parts += ["0"] * (3 - len(parts))
+    elif len(parts) == 1:
+        # Minutes
+        parts.append("0")
+
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + float(part)
+
+    return int(days) * 86400 + seconds
+
+
+def parseMemory(value):
+    """
+    Converts a SLURM memory value (e.g., 1234K, 4000Mc, 2G) into MB. Values without
+    unit are taken in bytes.
+
+    Parameters
+    ==========
+    value : str
+        SLURM memory value (e.g., the MaxRSS or ReqMem fields of sacct).
+
+    Returns
+    =======
+    mb : float
+        None for empty values.
+    """
+
+    value = value.strip().rstrip("cn")
+    if value == "":
+        return None
+
+    units = {"K": 1.0 / 1024, "M": 1.0, "G": 1024.0, "T": 1024.0**2}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+
+    return float(value) / 1024**2
+
+
+def readSacctDump(sacct_file):
+    """
+    Reads a saved "sacct --parsable2" output (with its header line) merging the
+    fields of the job steps into their jobs: the maximum MaxRSS of the steps is
+    given as the MaxRSS of the job.
+
+    Parameters
+    ==========
+    sacct_file : str
+        Path to the sacct output.
+
+    Returns
+    =======
+    jobs : list
+        List of dictionaries with the sacct fields as keys.
+    """
+
+    jobs = {}
+    steps_rss = {}
+    with open(sacct_file) as sf:
+        header = sf.readline().rstrip("\n").split("|")
+        for line in sf:
+            ls = line.rstrip("\n").split("|")
+            if len(ls) != len(header):
+                continue
+            entry = dict(zip(header, ls))
+            job = entry["JobID"]
+            if "." in job:
+                job = job.split(".")[0]
+                rss = parseMemory(entry.get("MaxRSS", ""))
+                if rss != None:
+                    steps_rss[job] = max(steps_rss.get(job, 0), rss)
+            else:
+                jobs[job] = entry
+
+    for job, rss in steps_rss.items():
+        if job in jobs:
+            jobs[job]["MaxRSS"] = str(rss) + "M"
+
+    return list(jobs.values())
+
+
+def addSacctSamples(
+    history_file,
+    sacct_file,
+    program,
+    cluster,
+    job_name=None,
+    input_size=None,
+    states=["COMPLETED"],
+):
+    """
+    Adds the jobs of a saved "sacct --parsable2" output to a sizing history file.
+    The output must include the JobID, JobName, State, Elapsed, AllocCPUS and MaxRSS
+    fields (e.g., sacct -P -o JobID,JobName,State,Elapsed,AllocCPUS,MaxRSS).
+
+    Parameters
+    ==========
+    history_file : str
+        Path to the JSON history file.
+    sacct_file : str
+        Path to the sacct output.
+    program : str
+        Name of the program (or of the kind of job).
+    cluster : str
+        Name of the cluster (the name of its module, e.g., "mn5").
+    job_name : str
+        Add only the jobs with this name.
+    input_size : (int, float)
+        Size of the input of the jobs.
+    states : list
+        Add only the jobs in these states.
+
+    Returns
+    =======
+    added : int
+        Number of samples added.
+    """
+
+    samples = []
+    for job in readSacctDump(sacct_file):
+        if job_name != None and job.get("JobName") != job_name:
+            continue
+        if job["State"].split()[0] not in states:
+            continue
+        wall = parseElapsed(job["Elapsed"])
+        if wall == None:
+            continue
+        mem = parseMemory(job.get("MaxRSS", ""))
+        if mem != None:
+            mem /= max(int(job.get("AllocCPUS") or 1), 1)
+        samples.append((wall, mem))
+
+    return addSamples(history_file, program, cluster, samples, input_size=input_size)
+
+
+def _percentile(values, percentile):
+    """
+    Returns the percentile of a list of values (nearest rank).
+    """
+
+    values = sorted(values)
+    rank = int(math.ceil(percentile / 100.0 * len(values)))
+
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def suggestResources(
+    history_file,
+    program,
+    cluster,
+    input_size=None,
+    percentile=95,
+    margin=0.2,
+    min_samples=5,
+):
+    """
+    Suggests the time and memory requests of a job from the history of its program
+    in a cluster: the given percentile of the samples plus a margin. The bucket of
+    all the sizes is used when the input-size bucket has too few samples. The set-up
+    time of the tasks is suggested separately, since it is spent once per task
+    whatever the number of jobs it runs.
+
+    Parameters
+    ==========
+    history_file : str
+        Path to the JSON history file.
+    program : str
+        Name of the program (or of the kind of job).
+    cluster : str
+        Name of the cluster (the name of its module, e.g., "mn5").
+    input_size : (int, float)
+        Size of the input of the job.
+    percentile : float
+        Percentile of the samples used.
+    margin : float
+        Fraction added to the percentile.
+    min_samples : int
+        Minimum number of samples needed for a suggestion.
+
+    Returns
+    =======
+    resources : dict
+        Dictionary with the keys "time" (minutes per job), "setup" (minutes per task,
+        0 if no set-up samples are available) and "mem_per_cpu" (MB, None if no
+        memory samples are available), or None if there are not enough samples.
+    """
+
+    history = readHistory(history_file)
+
+    samples = []
+    for bucket in [sizeBucket(input_size), "any"]:
+        samples = history.get("|".join([program, cluster, bucket]), [])
+        if len(samples) >= min_samples:
+            break
+    if len(samples) < min_samples:
+        return None
+
+    walls = [s[0] for s in samples]
+    mems = [s[1] for s in samples if s[1] != None]
+    setups = [s[2] for s in samples if len(s) > 2 and s[2] != None]
+
+    resources = {
+        "time": int(math.ceil(_percentile(walls, percentile) * (1 + margin) / 60)),
+        "setup": 0,
+        "mem_per_cpu": None,
+    }
+    if setups != []:
+        resources["setup"] = int(
+            math.ceil(_percentile(setups, percentile) * (1 + margin) / 60)
+        )
+    if mems != []:
+        resources["mem_per_cpu"] = int(
+            math.ceil(_percentile(mems, percentile) * (1 + margin))
+        )
+
+    return resources
+
+
+def autoResources(program, cluster, partition, sizing_options=None, jobs_per_task=1):
+    """
+    Returns the time and memory requests of the tasks of an array with time="auto"
+    (see suggestResources()): the time of the jobs run by each task plus the set-up
+    time of the task. When there is not enough history, the maximum time of the
+    partition (see profiles.cluster_profiles) is returned.
+
+    Parameters
+    ==========
+    program : str
+        Name of the program (or of the kind of job).
+    cluster : str
+        Name of the cluster (the name of its module, e.g., "mn5").
+    partition : str
+        Partition (or QOS) of the cluster.
+    sizing_options : dict
+        Options passed to suggestResources() (history_file, input_size, percentile,
+        margin, min_samples). The history file is "sizing_history.json" by default.
+    jobs_per_task : int
+        Jobs run one after the other by each task (e.g., when grouping jobs).
+
+    Returns
+    =======
+    time : int
+        Minutes.
+    mem_per_cpu : int
+        MB (None if unknown).
+    """
+
+    if sizing_options == None:
+        sizing_options = {}
+    sizing_options = dict(sizing_options)
+    history_file = sizing_options.pop("history_file", "sizing_history.json")
+
+    max_time = 48 * 60
+    if partition in profiles.cluster_profiles.get(cluster, {}):
+        max_time = profiles.partitionProfile(cluster, partition)["max_time"] * 60
+
+    resources = suggestResources(history_file, program, cluster, **sizing_options)
+    if resources == None:
+        print(
+            "Not enough sizing history for "
+            + str(program)
+            + " in "
+            + cluster
+            + ". Setting time at maximum allowed for the partition."
+        )
+        return max_time, None
+
+    time = min(resources["time"] * jobs_per_task + resources["setup"], max_time)
+
+    return time, resources["mem_per_cpu"]
+
+
+def timeHours(minutes):
+    """
+    Rounds a time request up to whole hours, for the modules that request the time
+    in hours.
+
+    Parameters
+    ==========
+    minutes : int
+        Time request in minutes.
+
+    Returns
+    =======
+    hours : int
+    """
+
+    return max(int(math.ceil(minutes / 60.0)), 1)
+
+
+def autoPartition(
+    cluster,
+    time,
+    n_jobs,
+    program=None,
+    cpus=1,
+    gpus=0,
+    nodes=None,
+    partitions=None,
+    group_jobs_by=None,
+    queue_wait=None,
+    sizing_options=None,
+    job_ids=None,
+):
+    """
+    Selects the partition of an array with partition="auto" (see
+    profiles.selectPartition()).
+
+    A given time is the time limit of each task (as written in the script), so the
+    partition is selected for tasks of that time and the grouping is kept. With
+    time="auto", the time of each job is estimated from the sizing history of the
+    program (see suggestResources()) and the jobs are regrouped to fit the time
+    limit of the selected partition, unless job_ids selects array indexes, since
+    regrouping would change the tasks they point to. The time of the
+    tasks is then sized with autoResources() for the returned grouping.
+
+    Parameters
+    ==========
+    cluster : str
+        Name of the cluster (the name of its module, e.g., "mn5").
+    time : (int, tuple, str)
+        Time of each task in hours, as (hours, minutes), or "auto".
+    n_jobs : int
+        Number of jobs of the array.
+    program : str
+        Name of the program (or of the kind of job).
+    cpus : int
+        Cores requested by each task.
+    gpus : int
+        GPUs requested by each task.
+    nodes : int
+        Whole nodes requested by each task.
+    partitions : list
+        Candidate partitions.
+    group_jobs_by : int
+        Jobs run one after the other by each task.
+    queue_wait : dict
+        Expected queue wait (hours) of the partitions.
+    sizing_options : dict
+        Options passed to suggestResources().
+    job_ids : list
+        One-based array indexes (of the grouped jobs) to submit.
+
+    Returns
+    =======
+    partition : str
+    group_jobs_by : int
+    """
+
+    # Only the selected tasks are submitted, with the given grouping
+    group = group_jobs_by if isinstance(group_jobs_by, int) else 1
+    n_tasks = int(math.ceil(n_jobs / group))
+    if job_ids != None:
+        n_tasks = len(job_ids)
+
+    if time != "auto":
+        task_time = None
+        if isinstance(time, (tuple, list)):
+            task_time = time[0] * 60 + time[1]
+        elif time != None:
+            task_time = time * 60
+        partition = profiles.selectPartition(
+            cluster,
+            task_time,
+            n_tasks,
+            cpus=cpus,
+            gpus=gpus,
+            nodes=nodes,
+            partitions=partitions,
+            queue_wait=queue_wait,
+            strict=True,
+        )[0]
+        return partition, group_jobs_by
+
+    if sizing_options == None:
+        sizing_options = {}
+    sizing_options = dict(sizing_options)
+    history_file = sizing_options.pop("history_file", "sizing_history.json")
+    resources = suggestResources(history_file, program, cluster, **sizing_options)
+    job_time = None
+    if resources != None:
+        job_time = resources["time"]
+
+    return profiles.selectPartition(
+        cluster,
+        job_time,
+        n_tasks * group,
+        cpus=cpus,
+        gpus=gpus,
+        nodes=nodes,
+        partitions=partitions,
+        group_jobs_by=group_jobs_by,
+        queue_wait=queue_wait,
+        regroup=job_ids == None,
+        strict=True,
+    )
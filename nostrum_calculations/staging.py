@@ -0,0 +1,251 @@
+import os
+import hashlib
+
+
+def stagedCondaEnv(conda_env, tarball=None, stage_dir="/dev/shm"):
+    """
+    Returns the shell lines that activate a conda environment from a node-local copy
+    instead of from GPFS. The environment must be packed beforehand with conda-pack:
+
+        conda pack -p /gpfs/projects/bsc72/conda_envs/env -o /gpfs/projects/bsc72/conda_envs/env.tar.gz
+
+    The tarball is unpacked once per node into stage_dir (the prefixes are rewritten
+    with conda-unpack), in a folder named after the modification time and size of
+    the tarball. If the unpacking fails, the partial copy is removed and the task
+    exits with an error. Concurrent tasks on the same node share the unpacked copy: the
+    unpacking is done under a file lock and the rest of the tasks wait for it and
+    reuse it. The default /dev/shm is shared by all the jobs of a node, contrary to
+    the per-job $TMPDIR.
+
+    Parameters
+    ==========
+    conda_env : str
+        Path to the conda environment on GPFS.
+    tarball : str
+        Path to the conda-pack tarball (conda_env + ".tar.gz" by default).
+    stage_dir : str
+        Node-local folder where the environment is unpacked.
+
+    Returns
+    =======
+    lines : str
+    """
+
+    conda_env = conda_env.rstrip("/")
+    if tarball == None:
+        tarball = conda_env + ".tar.gz"
+
+    # Key the copy by the modification time and size of the tarball, so a rebuilt
+    # environment is unpacked again instead of reusing the old copy
+    env_dir = (
+        stage_dir
+        + "/conda_envs_$USER/"
+        + os.path.basename(conda_env)
+        + "_$(stat -Lc %Y_%s "
+        + tarball
+        + ")"
+    )
+
+    lines = "STAGED_ENV=" + env_dir + "\n"
+    lines += "mkdir -p $(dirname $STAGED_ENV)\n"
+    lines += "(\n"
+    lines += "flock 9\n"
+    lines += "if [ ! -f $STAGED_ENV/.unpacked ]; then\n"
+    lines += "    rm -rf $STAGED_ENV\n"
+    lines += "    mkdir -p $STAGED_ENV\n"
+    lines += (
+        "    if ! (tar -xzf "
+        + tarball
+        + " -C $STAGED_ENV && source $STAGED_ENV/bin/activate && conda-unpack"
+        + " && touch $STAGED_ENV/.unpacked); then\n"
+    )
+    lines += '        echo "Failed to stage the conda environment ' + conda_env + '" >&2\n'
+    lines += "        rm -rf $STAGED_ENV\n"
+    lines += "        exit 1\n"
+    lines += "    fi\n"
+    lines += "fi\n"
+    lines += ") 9>$STAGED_ENV.lock || exit 1\n"
+    lines += "source $STAGED_ENV/bin/activate\n"
+
+    return lines
+
+
+def snapshotEnvironment(script_name, preamble_start, preamble_end, snapshot_dir=".env_snapshots"):
+    """
+    Rewrites the environment set-up (module loads, conda activation, exports, ...)
+    of a generated script so it is only executed by the first task that runs it.
+    That task saves the changes of the set-up into a snapshot file, and the following
+    tasks source the snapshot instead of running the set-up again, skipping the module
+    and conda initialisation.
+
+    The snapshot replays the exported variables added or changed by the set-up, unsets
+    the ones it removed (e.g., with "module purge"), and defines the shell functions it
+    added or changed (e.g., "module" or "conda"), exporting them if they were exported.
+    Non-exported shell variables are not restored, as in a new shell.
+
+    The snapshot file is named after a hash of the set-up lines, so any change in the
+    modules, environments or exports writes a new snapshot instead of reusing an
+    outdated one.
+
+    Parameters
+    ==========
+    script_name : str
+        Path to the generated script.
+    preamble_start : int
+        Byte offset where the set-up lines start in the script.
+    preamble_end : int
+        Byte offset where the set-up lines end in the script.
+    snapshot_dir : str
+        Folder where the environment snapshots are saved.
+    """
+
+    with open(script_name, "rb") as sf:
+        script = sf.read()
+
+    header = script[:preamble_start].decode()
+    preamble = script[preamble_start:preamble_end].decode()
+    body = script[preamble_end:].decode()
+
+    if preamble.strip() == "":
+        return
+
+    key = hashlib.md5(preamble.encode()).hexdigest()[:16]
+    snapshot = snapshot_dir + "/" + key + ".env"
+
+    lines = "ENV_SNAPSHOT=" + snapshot + "\n"
+    lines += "if [ -s $ENV_SNAPSHOT ]; then\n"
+    lines += "source $ENV_SNAPSHOT\n"
+    lines += "else\n"
+    lines += "ENV_BEFORE=$(mktemp -d)\n"
+    lines += "declare -px > $ENV_BEFORE/variables\n"
+    lines += "compgen -e | sort > $ENV_BEFORE/names\n"
+    lines += 'for f in $(compgen -A function); do echo "$f $(declare -f $f | md5sum)"; done'
+    lines += " > $ENV_BEFORE/functions\n"
+    lines += preamble
+    if not preamble.endswith("\n"):
+        lines += "\n"
+    lines += "mkdir -p " + snapshot_dir + "\n"
+    lines += "{\n"
+    lines += 'for v in $(compgen -e | sort | comm -23 $ENV_BEFORE/names -); do echo "unset $v"; done\n'
+    lines += "declare -px | grep -Fxv -f $ENV_BEFORE/variables\n"
+    lines += "for f in $(compgen -A function); do\n"
+    lines += '    if ! grep -qFx "$f $(declare -f $f | md5sum)" $ENV_BEFORE/functions; then\n'
+    lines += "        declare -f $f\n"
+    lines += '        if declare -Fx | grep -qx "declare -fx $f"; then echo "export -f $f"; fi\n'
+    lines += "    fi\n"
+    lines += "done\n"
+    lines += "for f in $(cut -d ' ' -f 1 $ENV_BEFORE/functions); do\n"
+    lines += '    if ! declare -F $f > /dev/null; then echo "unset -f $f"; fi\n'
+    lines += "done\n"
+    lines += "} > $ENV_SNAPSHOT.$$\n"
+    lines += "mv $ENV_SNAPSHOT.$$ $ENV_SNAPSHOT\n"
+    lines += "rm -rf $ENV_BEFORE\n"
+    lines += "fi\n\n"
+
+    # conda is only defined if the set-up defined it (e.g., with its shell hook)
+    body = body.replace(
+        "conda deactivate \n", "if type conda &> /dev/null; then conda deactivate; fi\n"
+    )
+
+    with open(script_name, "w") as sf:
+        sf.write(header + lines + body)
+
+
+def stagedJob(job, inputs, outputs, scratch_dir="${TMPDIR:-/tmp}"):
+    """
+    Wraps a job so it runs in a node-local scratch folder instead of the (GPFS)
+    submission folder. The inputs are copied to the scratch folder, the job is run
+    there and the files matching the output globs are copied back to the submission
+    folder. Files are moved as tar streams, so folders with many small files are
+    transferred in one sequential read/write.
+
+    The outputs are copied back when the job exits for any reason, including
+    failures and the SIGTERM sent by SLURM when the time limit is reached, so
+    partial outputs are not lost. The job runs in a subshell, so grouped jobs
+    are staged independently.
+
+    Parameters
+    ==========
+    job : str
+        Command to execute.
+    inputs : list
+        Files or folders needed by the job, relative to the submission folder.
+    outputs : list
+        Globs of the files or folders to copy back, relative to the scratch folder.
+    scratch_dir : str
+        Node-local folder where the job is run.
+
+    Returns
+    =======
+    staged_job : str
+    """
+
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if isinstance(outputs, str):
+        outputs = [outputs]
+
+    for path in inputs + outputs:
+        if os.path.isabs(path):
+            raise ValueError(
+                "Staged paths must be relative to the submission folder: " + path
+            )
+
+    staged_job = "(\n"
+    staged_job += "SUBMIT_DIR=$(pwd)\n"
+    staged_job += "STAGE_DIR=$(mktemp -d " + scratch_dir + "/stage_XXXXXX)\n"
+    staged_job += "stage_back() {\n"
+    staged_job += "    cd $STAGE_DIR\n"
+    staged_job += "    shopt -s nullglob\n"
+    staged_job += "    outputs=(" + " ".join(outputs) + ")\n"
+    staged_job += '    if [ ${#outputs[@]} -gt 0 ]; then\n'
+    staged_job += '        tar -cf - "${outputs[@]}" | tar -xf - -C $SUBMIT_DIR\n'
+    staged_job += "    fi\n"
+    staged_job += "    cd $SUBMIT_DIR\n"
+    staged_job += "    rm -rf $STAGE_DIR\n"
+    staged_job += "}\n"
+    staged_job += "trap stage_back EXIT\n"
+    staged_job += "trap 'exit 143' TERM\n"
+    if inputs != []:
+        staged_job += "tar -cf - " + " ".join(inputs) + " | tar -xf - -C $STAGE_DIR\n"
+    staged_job += "cd $STAGE_DIR\n"
+    staged_job += job
+    if not job.endswith("\n"):
+        staged_job += "\n"
+    staged_job += ")\n"
+
+    return staged_job
+
+
+def stageJobs(jobs, stage_files):
+    """
+    Wraps a list of jobs with stagedJob().
+
+    Parameters
+    ==========
+    jobs : list
+        List of jobs.
+    stage_files : (dict, list)
+        Dictionary with the keys "inputs" and "outputs" (and optionally "scratch_dir")
+        applied to all the jobs, or a list with one such dictionary per job.
+
+    Returns
+    =======
+    staged_jobs : list
+    """
+
+    if isinstance(stage_files, dict):
+        stage_files = [stage_files] * len(jobs)
+
+    if not isinstance(stage_files, list) or len(stage_files) != len(jobs):
+        raise ValueError(
+            "stage_files must be a dictionary or a list with one dictionary per job"
+        )
+
+    staged_jobs = []
+    for job, sf in zip(jobs, stage_files):
+        if "inputs" not in sf or "outputs" not in sf:
+            raise ValueError('Each stage_files entry must contain "inputs" and "outputs"')
+        staged_jobs.append(stagedJob(job, **sf))
+
+    return staged_jobs
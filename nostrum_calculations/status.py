@@ -0,0 +1,231 @@
+import os
+import time
+import json
+import shlex
+import subprocess
+
+from . import tricks
+
+# States of the tasks that will not run (again)
+terminal_states = [
+    "COMPLETED",
+    "FAILED",
+    "TIMEOUT",
+    "OUT_OF_MEMORY",
+    "CANCELLED",
+    "NODE_FAIL",
+    "BOOT_FAIL",
+    "DEADLINE",
+]
+
+# Last snapshot of the job states, reused while it is younger than its TTL
+_snapshot = {"key": None, "time": 0, "table": {}}
+
+
+def parseJobRecords(output):
+    """
+    Parses "JobID|State|ExitCode" lines (the parsable output of sacct, or of squeue
+    with a "%i|%T" format) into a state table with one entry per array task.
+    Array records of pending tasks (e.g., 1234_[5-100%10]) are expanded.
+
+    Parameters
+    ==========
+    output : str
+        Output of the sacct or squeue call.
+
+    Returns
+    =======
+    table : dict
+        Dictionary with (job_id, array_index) as keys (array_index is None for
+        non-array jobs) and dictionaries with the keys "state" and "exit_code" as
+        values.
+    """
+
+    table = {}
+    for line in output.split("\n"):
+        ls = line.strip().split("|")
+        if len(ls) < 2 or ls[0] == "":
+            continue
+        job, state = ls[0], ls[1].split()[0]
+        exit_code = ls[2] if len(ls) > 2 else None
+
+        # Skip job steps and heterogeneous job components
+        if "." in job or "+" in job:
+            continue
+
+        if "_" in job:
+            job_id, index = job.split("_", 1)
+            if index.startswith("["):
+                indexes = tricks.expandArrayIndexes(index.strip("[]"))
+            else:
+                indexes = [int(index)]
+        else:
+            job_id = job
+            indexes = [None]
+
+        for index in indexes:
+            table[(job_id, index)] = {"state": state, "exit_code": exit_code}
+
+    return table
+
+
+def queryJobStates(job_ids, source="sacct", command=None):
+    """
+    Returns the state of all the tasks of the given jobs with a single sacct (or
+    squeue) call.
+
+    Parameters
+    ==========
+    job_ids : list
+        Job IDs to query (array job IDs cover all their tasks).
+    source : str
+        Command used to query the states ("sacct" or "squeue"). squeue only reports
+        pending and running jobs.
+    command : str
+        Command to run instead of the default sacct or squeue one (e.g., a wrapper).
+
+    Returns
+    =======
+    table : dict
+        State table (see parseJobRecords()).
+    """
+
+    available_sources = ["sacct", "squeue"]
+    if source not in available_sources:
+        raise ValueError(
+            "Wrong status source selected. Available sources are: "
+            + ", ".join(available_sources)
+        )
+
+    job_ids = sorted(set([str(j).split("_")[0] for j in job_ids]))
+    if job_ids == []:
+        return {}
+
+    if command == None:
+        command = source
+
+    if source == "sacct":
+        arguments = ["-n", "-P", "-X", "-o", "JobID,State,ExitCode"]
+    else:
+        arguments = ["-h", "-o", "%i|%T"]
+    arguments += ["-j", ",".join(job_ids)]
+
+    output = subprocess.run(
+        shlex.split(command) + arguments, capture_output=True, text=True, check=True
+    )
+
+    return parseJobRecords(output.stdout)
+
+
+def jobStates(job_ids, ttl=60, source="sacct", command=None):
+    """
+    Returns the state table of the tracked jobs, querying the job manager only
+    when the last snapshot of the same jobs is older than ttl seconds.
+
+    Parameters
+    ==========
+    job_ids : list
+        Tracked job IDs.
+    ttl : float
+        Seconds a snapshot is reused.
+    source : str
+        Command used to query the states ("sacct" or "squeue").
+    command : str
+        Command to run instead of the default sacct or squeue one.
+
+    Returns
+    =======
+    table : dict
+        State table (see parseJobRecords()).
+    """
+
+    key = (source, command, frozenset([str(j).split("_")[0] for j in job_ids]))
+    if _snapshot["key"] == key and time.time() - _snapshot["time"] < ttl:
+        return _snapshot["table"]
+
+    table = queryJobStates(job_ids, source=source, command=command)
+    _snapshot["key"] = key
+    _snapshot["time"] = time.time()
+    _snapshot["table"] = table
+
+    return table
+
+
+def jobState(job_id, index=None, job_ids=None, **kwargs):
+    """
+    Returns the state of a job or of an array task from the cached snapshot of the
+    tracked jobs (see jobStates()).
+
+    Parameters
+    ==========
+    job_id : str
+        Job ID.
+    index : int
+        Array index of the task.
+    job_ids : list
+        Tracked job IDs. Give the whole campaign so all the queries share the same
+        snapshot (only job_id is queried by default).
+    kwargs
+        Options passed to jobStates().
+
+    Returns
+    =======
+    state : str
+        State of the job, or None if the job is not found.
+    """
+
+    if job_ids == None:
+        job_ids = [job_id]
+
+    table = jobStates(job_ids, **kwargs)
+    entry = table.get((str(job_id), index))
+    if entry == None:
+        return None
+
+    return entry["state"]
+
+
+def stateCounts(table):
+    """
+    Counts the tasks of a state table in each state.
+
+    Parameters
+    ==========
+    table : dict
+        State table (see parseJobRecords()).
+
+    Returns
+    =======
+    counts : dict
+    """
+
+    counts = {}
+    for entry in table.values():
+        counts.setdefault(entry["state"], 0)
+        counts[entry["state"]] += 1
+
+    return counts
+
+
+def manifestJobIDs(manifest="submission_manifest.json"):
+    """
+    Returns the job IDs recorded in a submission manifest (see
+    submission.submitScripts()).
+
+    Parameters
+    ==========
+    manifest : str
+        Path to the JSON manifest.
+
+    Returns
+    =======
+    job_ids : list
+    """
+
+    if not os.path.exists(manifest):
+        return []
+
+    with open(manifest) as mf:
+        submitted = json.load(mf)
+
+    return [entry["job_id"] for entry in submitted.values()]
@@ -0,0 +1,665 @@
+import os
+import time
+import json
+import shlex
+import threading
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from . import tricks
+from . import manifest as campaign_manifest
+
+
+def scriptTasks(script_name):
+    """
+    Returns the number of queue entries a script adds when submitted: the number
+    of array tasks for array scripts, and one otherwise.
+
+    Parameters
+    ==========
+    script_name : str
+        Path to the SLURM script.
+
+    Returns
+    =======
+    tasks : int
+    """
+
+    with open(script_name) as sf:
+        for line in sf:
+            if line.startswith("#SBATCH --array="):
+                return len(tricks.expandArrayIndexes(line.split("=", 1)[1].strip()))
+            if line.strip() != "" and not line.startswith("#"):
+                break
+
+    return 1
+
+
+def scriptJobName(script_name):
+    """
+    Returns the job name of a script (its #SBATCH --job-name, or the script file
+    name, which is the name SLURM gives by default).
+
+    Parameters
+    ==========
+    script_name : str
+        Path to the SLURM script.
+
+    Returns
+    =======
+    job_name : str
+    """
+
+    with open(script_name) as sf:
+        for line in sf:
+            ls = line.split()
+            if len(ls) > 1 and ls[0] == "#SBATCH":
+                if ls[1].startswith("--job-name="):
+                    return ls[1].split("=", 1)[1]
+                if ls[1] in ["--job-name", "-J"] and len(ls) > 2:
+                    return ls[2]
+            elif line.strip() != "" and not line.startswith("#"):
+                break
+
+    return os.path.basename(script_name)
+
+
+def readSubmissionState(state_file):
+    """
+    Reads the state of a submission backlog (see addToBacklog()).
+
+    Parameters
+    ==========
+    state_file : str
+        Path to the JSON state file.
+
+    Returns
+    =======
+    state : dict
+    """
+
+    if not os.path.exists(state_file):
+        return {"backlog": []}
+
+    with open(state_file) as sf:
+        return json.load(sf)
+
+
+def writeSubmissionState(state, state_file):
+    """
+    Writes the state of a submission backlog atomically, so an interrupted write
+    never leaves a corrupted state file.
+
+    Parameters
+    ==========
+    state : dict
+        Submission state.
+    state_file : str
+        Path to the JSON state file.
+    """
+
+    with open(state_file + ".tmp", "w") as sf:
+        json.dump(state, sf, indent=1)
+    os.replace(state_file + ".tmp", state_file)
+
+
+def addToBacklog(scripts, state_file="submission_state.json"):
+    """
+    Adds SLURM scripts to the backlog of a submission state file, to be submitted
+    by submissionDaemon() as queue slots become free. Scripts already in the
+    backlog are not added again.
+
+    Parameters
+    ==========
+    scripts : (str, list)
+        Paths to the SLURM scripts, in submission order.
+    state_file : str
+        Path to the JSON state file.
+
+    Returns
+    =======
+    added : int
+        Number of scripts added.
+    """
+
+    if isinstance(scripts, str):
+        scripts = [scripts]
+
+    state = readSubmissionState(state_file)
+    in_backlog = set([s["script"] for s in state["backlog"]])
+
+    added = 0
+    for script_name in scripts:
+        script_name = os.path.abspath(script_name)
+        if script_name in in_backlog:
+            continue
+        state["backlog"].append(
+            {
+                "script": script_name,
+                "cwd": os.getcwd(),
+                "tasks": scriptTasks(script_name),
+                "job_id": None,
+                "submitted": None,
+            }
+        )
+        in_backlog.add(script_name)
+        added += 1
+
+    writeSubmissionState(state, state_file)
+
+    return added
+
+
+def queueOccupancy(squeue="squeue", user=None):
+    """
+    Returns the number of queue entries (pending and running jobs, counting each
+    array task) of a user with a single squeue call.
+
+    Parameters
+    ==========
+    squeue : str
+        squeue command (e.g., to run it through ssh or a wrapper).
+    user : str
+        User to check (the current user by default).
+
+    Returns
+    =======
+    occupancy : int
+    """
+
+    if user == None:
+        user = os.environ.get("USER")
+
+    command = shlex.split(squeue) + ["-h", "-r", "-u", user, "-o", "%i"]
+    output = subprocess.run(command, capture_output=True, text=True, check=True)
+
+    return len([line for line in output.stdout.split("\n") if line.strip() != ""])
+
+
+def submittedJobs(job_name, since, squeue="squeue", sacct="sacct", user=None):
+    """
+    Returns the IDs of the jobs of a user with a given name submitted since a given
+    time, looking first in the queue and then, for the jobs that already left it, in
+    the accounting. It tells whether a submission whose sbatch call was interrupted
+    reached the queue.
+
+    Parameters
+    ==========
+    job_name : str
+        Name of the jobs.
+    since : float
+        Submission time (seconds since the epoch) from which the jobs are returned.
+    squeue : str
+        squeue command.
+    sacct : str
+        sacct command (None to only look in the queue, e.g., in clusters without
+        accounting).
+    user : str
+        User whose jobs are checked (the current user by default).
+
+    Returns
+    =======
+    job_ids : list
+        Job IDs (of the whole array for array jobs), sorted by submission time.
+    """
+
+    if user == None:
+        user = os.environ.get("USER")
+
+    commands = [
+        shlex.split(squeue)
+        + ["-h", "-u", user, "--name=" + job_name, "-o", "%F|%V"]
+    ]
+    if sacct != None:
+        commands.append(
+            shlex.split(sacct)
+            + ["-n", "-X", "-P", "-u", user, "--name=" + job_name]
+            + ["-S", time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(since))]
+            + ["-o", "JobID,Submit"]
+        )
+
+    for command in commands:
+        output = subprocess.run(command, capture_output=True, text=True, check=True)
+        jobs = {}
+        for line in output.stdout.split("\n"):
+            ls = line.strip().split("|")
+            if len(ls) != 2:
+                continue
+            try:
+                submit = datetime.fromisoformat(ls[1]).timestamp()
+            except ValueError:
+                continue
+            if submit >= int(since):
+                jobs[ls[0].split("_")[0]] = submit
+        if jobs != {}:
+            return sorted(jobs, key=jobs.get)
+
+    return []
+
+
+def sbatchScript(script_name, sbatch="sbatch", options=None, cwd=None):
+    """
+    Submits a script with sbatch --parsable and returns its job ID.
+
+    Parameters
+    ==========
+    script_name : str
+        Path to the SLURM script.
+    sbatch : str
+        sbatch command.
+    options : list
+        Additional sbatch options (e.g., ["-A", "bsc72"]).
+    cwd : str
+        Folder from which the script is submitted (the current one by default). The
+        relative paths of the script are resolved from it.
+
+    Returns
+    =======
+    job_id : str
+    """
+
+    if options == None:
+        options = []
+
+    command = shlex.split(sbatch) + ["--parsable"] + options + [script_name]
+    output = subprocess.run(command, capture_output=True, text=True, cwd=cwd)
+    if output.returncode != 0:
+        raise RuntimeError(
+            "sbatch failed for " + script_name + ": " + output.stderr.strip()
+        )
+
+    # The parsable output is "<job_id>[;<cluster>]"
+    return output.stdout.strip().split("\n")[-1].split(";")[0]
+
+
+# Messages of sbatch failures caused by an overloaded slurmctld
+transient_errors = [
+    "Socket timed out",
+    "Unable to contact slurm controller",
+    "Resource temporarily unavailable",
+    "Slurm temporarily unable",
+]
+
+
+def sbatchWithRetries(
+    script_name,
+    sbatch="sbatch",
+    options=None,
+    cwd=None,
+    retries=5,
+    backoff=2.0,
+    squeue="squeue",
+    user=None,
+    known_jobs=None,
+):
+    """
+    Submits a script with sbatchScript(), retrying with exponential backoff when
+    sbatch fails with a transient error (see transient_errors). sbatch may have
+    queued the job even when its reply timed out, so after a "Socket timed out"
+    error the queue is checked for a job with the name of the script (see
+    submittedJobs()) before submitting it again.
+
+    Parameters
+    ==========
+    script_name : str
+        Path to the SLURM script.
+    sbatch : str
+        sbatch command.
+    options : list
+        Additional sbatch options.
+    cwd : str
+        Folder from which the script is submitted.
+    retries : int
+        Maximum number of retries.
+    backoff : float
+        Seconds to wait before the first retry (doubled at each retry).
+    squeue : str
+        squeue command.
+    user : str
+        User whose queue is checked.
+    known_jobs : set
+        Job IDs already assigned to other scripts, which are not taken as the job of
+        this one when checking the queue.
+
+    Returns
+    =======
+    job_id : str
+    """
+
+    if known_jobs == None:
+        known_jobs = set()
+
+    for attempt in range(retries + 1):
+        start = time.time()
+        try:
+            return sbatchScript(script_name, sbatch=sbatch, options=options, cwd=cwd)
+        except RuntimeError as e:
+            if "Socket timed out" in str(e):
+                try:
+                    # Allow for a clock skew between this node and the SLURM controller
+                    job_ids = submittedJobs(
+                        scriptJobName(os.path.join(cwd or "", script_name)),
+                        start - 60,
+                        squeue=squeue,
+                        sacct=None,
+                        user=user,
+                    )
+                except subprocess.CalledProcessError as se:
+                    raise RuntimeError(
+                        "sbatch timed out for "
+                        + script_name
+                        + " and the queue could not be checked: "
+                        + se.stderr.strip()
+                    )
+                job_ids = [j for j in job_ids if j not in known_jobs]
+                if job_ids != []:
+                    return job_ids[0]
+            if attempt == retries or not any([t in str(e) for t in transient_errors]):
+                raise
+            time.sleep(backoff * 2**attempt)
+
+
+def submitScripts(
+    scripts,
+    manifest="submission_manifest.json",
+    sbatch="sbatch",
+    workers=4,
+    retries=5,
+    backoff=2.0,
+    resubmit=False,
+    manifest_db=None,
+    squeue="squeue",
+):
+    """
+    Submits SLURM scripts written by any of the cluster modules with sbatch --parsable,
+    using a bounded pool of concurrent sbatch calls, and records their job IDs in a
+    JSON manifest. Transient sbatch failures are retried (see sbatchWithRetries()).
+    The manifest is rewritten after each submission, and scripts already in it are
+    not submitted again, so an interrupted submission can be rerun.
+
+    Parameters
+    ==========
+    scripts : (str, list)
+        Paths to the scripts, or (path, options) tuples with additional sbatch options.
+    manifest : str
+        Path to the JSON manifest with the script paths (absolute) as keys.
+    sbatch : str
+        sbatch command (e.g., a wrapper script or a stub sbatch for testing).
+    workers : int
+        Maximum number of concurrent sbatch calls.
+    retries : int
+        Maximum number of retries of each submission.
+    backoff : float
+        Seconds to wait before the first retry (doubled at each retry).
+    resubmit : bool
+        Submit the scripts already in the manifest again.
+    manifest_db : str
+        Path to a SQLite campaign manifest where the job IDs of the submitted scripts
+        are also recorded (see manifest.setJobIDs()). The job ID is given to all the
+        commands of the script, which keep the array index of the task that runs
+        them, so grouped commands share the job ID and array index of their task.
+    squeue : str
+        squeue command, to check the queue after sbatch timeouts.
+
+    Returns
+    =======
+    job_ids : dict
+        Dictionary with the given script paths as keys and their job IDs as values.
+    """
+
+    if isinstance(scripts, str):
+        scripts = [scripts]
+    scripts = [s if isinstance(s, tuple) else (s, None) for s in scripts]
+
+    submitted = {}
+    if os.path.exists(manifest):
+        with open(manifest) as mf:
+            submitted = json.load(mf)
+
+    job_ids = {}
+    to_submit = []
+    for script_name, options in scripts:
+        key = os.path.abspath(script_name)
+        if key in submitted and not resubmit:
+            job_ids[script_name] = submitted[key]["job_id"]
+        else:
+            to_submit.append((script_name, options))
+
+    lock = threading.Lock()
+    known_jobs = set([s["job_id"] for s in submitted.values()])
+
+    def _submit(item):
+        script_name, options = item
+        job_id = sbatchWithRetries(
+            script_name,
+            sbatch=sbatch,
+            options=options,
+            retries=retries,
+            backoff=backoff,
+            squeue=squeue,
+            known_jobs=known_jobs,
+        )
+        with lock:
+            known_jobs.add(job_id)
+            submitted[os.path.abspath(script_name)] = {
+                "job_id": job_id,
+                "submitted": time.time(),
+            }
+            writeSubmissionState(submitted, manifest)
+        return job_id
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_submit, item): item[0] for item in to_submit}
+        for future in as_completed(futures):
+            try:
+                job_ids[futures[future]] = future.result()
+            except RuntimeError as e:
+                errors.append(str(e))
+
+    if manifest_db != None:
+        campaign_manifest.setJobIDs(manifest_db, job_ids)
+
+    if errors != []:
+        raise RuntimeError(
+            str(len(errors)) + " submissions failed:\n" + "\n".join(errors)
+        )
+
+    return job_ids
+
+
+def submitGeneralScript(general_script, **kwargs):
+    """
+    Submits the scripts of a launcher script made of sbatch lines (e.g., the
+    general_script of the setUpPELEFor* functions) with submitScripts(), keeping the
+    sbatch options of each line and capturing the job IDs.
+
+    Parameters
+    ==========
+    general_script : str
+        Path to the launcher script.
+    kwargs
+        Options passed to submitScripts().
+
+    Returns
+    =======
+    job_ids : dict
+        Dictionary with the script paths as keys and their job IDs as values.
+    """
+
+    scripts = []
+    with open(general_script) as gf:
+        for line in gf:
+            ls = shlex.split(line)
+            if ls == [] or ls[0] != "sbatch":
+                continue
+            scripts.append((ls[-1], ls[1:-1]))
+
+    return submitScripts(scripts, **kwargs)
+
+
+def submitFromBacklog(
+    state_file, max_jobs, sbatch="sbatch", squeue="squeue", sacct="sacct", user=None
+):
+    """
+    Submits the next scripts of the backlog that fit in the free queue slots. The
+    backlog order is kept: a script that does not fit blocks the following ones.
+
+    Each script is marked as "submitting" in the state before calling sbatch. A
+    marked script without job ID (the sbatch call or the state update was
+    interrupted) is looked up by its job name in the queue and the accounting (see
+    submittedJobs()) before submitting it again.
+
+    Parameters
+    ==========
+    state_file : str
+        Path to the JSON state file.
+    max_jobs : int
+        Maximum number of queue entries of the user (MaxSubmitJobs).
+    sbatch : str
+        sbatch command.
+    squeue : str
+        squeue command.
+    sacct : str
+        sacct command (None to only look in the queue for interrupted submissions).
+    user : str
+        User whose queue is checked.
+
+    Returns
+    =======
+    submitted : list
+        Job IDs submitted.
+    """
+
+    state = readSubmissionState(state_file)
+    known = set([s["job_id"] for s in state["backlog"] if s["job_id"] != None])
+
+    for entry in state["backlog"]:
+        if entry["job_id"] != None or entry.get("submitting") == None:
+            continue
+        # Allow for a clock skew between this node and the SLURM controller
+        job_ids = submittedJobs(
+            scriptJobName(entry["script"]),
+            entry["submitting"] - 60,
+            squeue=squeue,
+            sacct=sacct,
+            user=user,
+        )
+        job_ids = [j for j in job_ids if j not in known]
+        if job_ids != []:
+            print(
+                "Found job "
+                + job_ids[0]
+                + " of the interrupted submission of "
+                + entry["script"]
+            )
+            entry["job_id"] = job_ids[0]
+            entry["submitted"] = entry["submitting"]
+            known.add(job_ids[0])
+        del entry["submitting"]
+        writeSubmissionState(state, state_file)
+
+    pending = [s for s in state["backlog"] if s["job_id"] == None]
+    if pending == []:
+        return []
+
+    headroom = max_jobs - queueOccupancy(squeue=squeue, user=user)
+
+    submitted = []
+    for entry in pending:
+        if entry["tasks"] > max_jobs:
+            raise ValueError(
+                entry["script"]
+                + " has more tasks ("
+                + str(entry["tasks"])
+                + ") than the maximum number of jobs. Split it with max_array_spec."
+            )
+        if entry["tasks"] > headroom:
+            break
+
+        # A crash after sbatch leaves the marker, so the restart checks the queue
+        entry["submitting"] = time.time()
+        writeSubmissionState(state, state_file)
+
+        entry["job_id"] = sbatchWithRetries(
+            entry["script"],
+            sbatch=sbatch,
+            cwd=entry.get("cwd"),
+            squeue=squeue,
+            user=user,
+            known_jobs=known,
+        )
+        known.add(entry["job_id"])
+        entry["submitted"] = time.time()
+        del entry["submitting"]
+        headroom -= entry["tasks"]
+        submitted.append(entry["job_id"])
+        writeSubmissionState(state, state_file)
+
+    return submitted
+
+
+def submissionDaemon(
+    state_file="submission_state.json",
+    max_jobs=100,
+    interval=60,
+    sbatch="sbatch",
+    squeue="squeue",
+    sacct="sacct",
+    user=None,
+):
+    """
+    Submits the scripts of a backlog (see addToBacklog()) as the queue slots of the
+    user become free, checking the queue occupancy with a single squeue call every
+    interval seconds. The state is persisted in state_file around each submission,
+    so the daemon can be stopped and restarted (e.g., with nohup in a login node):
+    interrupted submissions are looked up in the queue before submitting them again
+    (see submitFromBacklog()). Failed squeue or sbatch calls (e.g., an unresponsive
+    SLURM controller) are reported and retried at the next interval. It returns when
+    the whole backlog has been submitted.
+
+    Parameters
+    ==========
+    state_file : str
+        Path to the JSON state file.
+    max_jobs : int
+        Maximum number of queue entries of the user (MaxSubmitJobs).
+    interval : float
+        Seconds between queue checks.
+    sbatch : str
+        sbatch command (e.g., a wrapper script or a fake sbatch for testing).
+    squeue : str
+        squeue command.
+    sacct : str
+        sacct command (None to only look in the queue for interrupted submissions).
+    user : str
+        User whose queue is checked.
+    """
+
+    while True:
+        try:
+            submitted = submitFromBacklog(
+                state_file,
+                max_jobs,
+                sbatch=sbatch,
+                squeue=squeue,
+                sacct=sacct,
+                user=user,
+            )
+        except (subprocess.CalledProcessError, RuntimeError) as e:
+            message = str(e)
+            if isinstance(e, subprocess.CalledProcessError) and e.stderr:
+                message += " " + e.stderr.strip()
+            print("Submission failed, retrying in " + str(interval) + " s: " + message)
+            submitted = []
+        for job_id in submitted:
+            print("Submitted job " + job_id)
+
+        state = readSubmissionState(state_file)
+        remaining = len([s for s in state["backlog"] if s["job_id"] == None])
+        if remaining == 0:
+            print("All the scripts in the backlog have been submitted.")
+            break
+
+        time.sleep(interval)
@@ -0,0 +1,200 @@
+import os
+
+# Columns of the telemetry records (see readTelemetry())
+telemetry_columns = [
+    "task",
+    "payload",
+    "host",
+    "setup",
+    "wall",
+    "user",
+    "sys",
+    "max_rss",
+    "exit_code",
+    "task_jobs",
+]
+
+
+def telemetryStart():
+    """
+    Returns the line timestamping the start of a task, before its environment set-up
+    (modules, conda, exports).
+
+    Returns
+    =======
+    lines : str
+    """
+
+    return "TELEMETRY_START=$(date +%s.%N)\n"
+
+
+def telemetrySetup(telemetry_folder):
+    """
+    Returns the lines timestamping the end of the environment set-up of a task and
+    defining the shell functions used by telemetryJob() to write its records into
+    telemetry_folder/<job_id>_<array_index>.tsv (one line per job).
+
+    The maximum RSS is read from the memory cgroup of the task (cgroup v2
+    memory.peak or v1 memory.max_usage_in_bytes), so it is the peak of the whole
+    task up to the end of each job, not of the job alone. Each record also counts the
+    jobs run by the task up to it, so the peak of a task with grouped jobs is taken
+    once, from its last record (see sizing.addTelemetrySamples()). The CPU times are
+    those of the job processes, from the bash times builtin.
+
+    Parameters
+    ==========
+    telemetry_folder : str
+        Folder containing the telemetry records.
+
+    Returns
+    =======
+    lines : str
+    """
+
+    telemetry_folder = os.path.abspath(telemetry_folder)
+
+    lines = "TELEMETRY_SETUP_END=$(date +%s.%N)\n"
+    lines += (
+        "TELEMETRY_FILE="
+        + telemetry_folder
+        + "/${SLURM_ARRAY_JOB_ID:-${SLURM_JOB_ID:-$$}}_${SLURM_ARRAY_TASK_ID:-0}.tsv\n"
+    )
+    lines += "TELEMETRY_TIMES=${TMPDIR:-/tmp}/telemetry_times.$$\n"
+    lines += "telemetry_cpu() {\n"
+    lines += "    times > $TELEMETRY_TIMES\n"
+    lines += (
+        "    read -r TELEMETRY_USER TELEMETRY_SYS < <(awk 'NR == 2 {split($1, u, /[ms]/);"
+        ' split($2, s, /[ms]/); print u[1] * 60 + u[2], s[1] * 60 + s[2]}\' $TELEMETRY_TIMES)\n'
+    )
+    lines += "    rm -f $TELEMETRY_TIMES\n"
+    lines += "}\n"
+    lines += "telemetry_max_rss() {\n"
+    lines += "    cg=$(awk -F: '$1 == \"0\" {print $3}' /proc/self/cgroup)\n"
+    lines += "    cg1=$(awk -F: '$2 ~ /(^|,)memory(,|$)/ {print $3}' /proc/self/cgroup)\n"
+    lines += "    if [ -n \"$cg\" ] && [ -f /sys/fs/cgroup$cg/memory.peak ]; then\n"
+    lines += "        echo $(( $(cat /sys/fs/cgroup$cg/memory.peak) / 1024 ))\n"
+    lines += "    elif [ -f /sys/fs/cgroup/memory$cg1/memory.max_usage_in_bytes ]; then\n"
+    lines += "        echo $(( $(cat /sys/fs/cgroup/memory$cg1/memory.max_usage_in_bytes) / 1024 ))\n"
+    lines += "    else\n"
+    lines += "        echo NA\n"
+    lines += "    fi\n"
+    lines += "}\n"
+    lines += "TELEMETRY_JOBS=0\n"
+    lines += "telemetry_record() {\n"
+    lines += "    local end=$(date +%s.%N)\n"
+    lines += "    TELEMETRY_JOBS=$((TELEMETRY_JOBS + 1))\n"
+    lines += "    local user0=$TELEMETRY_USER sys0=$TELEMETRY_SYS\n"
+    lines += "    telemetry_cpu\n"
+    lines += (
+        "    awk -v task=${SLURM_ARRAY_TASK_ID:-0} -v payload=$1 -v host=$(hostname -s)"
+        " -v start=$TELEMETRY_START -v setup=$TELEMETRY_SETUP_END -v begin=$2 -v end=$end"
+        " -v user=$(awk -v a=$user0 -v b=$TELEMETRY_USER 'BEGIN {print b - a}')"
+        " -v sys=$(awk -v a=$sys0 -v b=$TELEMETRY_SYS 'BEGIN {print b - a}')"
+        " -v rss=$(telemetry_max_rss) -v rc=$3 -v jobs=$TELEMETRY_JOBS"
+        " 'BEGIN {printf \"%s\\t%s\\t%s\\t%.2f\\t%.2f\\t%.2f\\t%.2f\\t%s\\t%s\\t%s\\n\","
+        " task, payload, host, setup - start, end - begin, user, sys, rss, rc, jobs}'"
+        " >> $TELEMETRY_FILE\n"
+    )
+    lines += "}\n"
+    lines += "telemetry_cpu\n\n"
+
+    return lines
+
+
+def telemetryJob(job, payload):
+    """
+    Wraps a job so its wall time, CPU time, maximum RSS and exit code are recorded
+    (see telemetrySetup()). The job runs in a subshell.
+
+    Parameters
+    ==========
+    job : str
+        Command to execute.
+    payload : int
+        Number identifying the job in the records (e.g., its one-based position in
+        the jobs list).
+
+    Returns
+    =======
+    telemetry_job : str
+    """
+
+    telemetry_job = "telemetry_cpu\n"
+    telemetry_job += "payload_start=$(date +%s.%N)\n"
+    telemetry_job += "(\n"
+    telemetry_job += job
+    if not job.endswith("\n"):
+        telemetry_job += "\n"
+    telemetry_job += ")\n"
+    telemetry_job += "rc=$?\n"
+    telemetry_job += "telemetry_record " + str(payload) + " $payload_start $rc\n"
+    telemetry_job += "(exit $rc)\n"
+
+    return telemetry_job
+
+
+def telemetryJobs(jobs, telemetry_folder):
+    """
+    Wraps a list of jobs with telemetryJob(), numbering them by their one-based
+    position, and creates the telemetry folder.
+
+    Parameters
+    ==========
+    jobs : list
+        List of jobs.
+    telemetry_folder : str
+        Folder containing the telemetry records.
+
+    Returns
+    =======
+    telemetry_jobs : list
+    """
+
+    if not os.path.exists(telemetry_folder):
+        os.makedirs(telemetry_folder)
+
+    return [telemetryJob(job, i + 1) for i, job in enumerate(jobs)]
+
+
+def readTelemetry(telemetry_folder):
+    """
+    Reads the telemetry records of a folder.
+
+    Parameters
+    ==========
+    telemetry_folder : str
+        Folder containing the telemetry records.
+
+    Returns
+    =======
+    records : list
+        List of dictionaries with the job_id and the telemetry_columns as keys. Times
+        are given in seconds and the maximum RSS in KB (None if not available). The
+        maximum RSS is the peak of the task up to the end of the job, and task_jobs
+        the number of jobs run by the task up to the job (see telemetrySetup()).
+    """
+
+    records = []
+    for f in sorted(os.listdir(telemetry_folder)):
+        if not f.endswith(".tsv"):
+            continue
+        job_id = f.split("_")[0]
+        with open(telemetry_folder + "/" + f) as tf:
+            for line in tf:
+                ls = line.rstrip("\n").split("\t")
+                if len(ls) != len(telemetry_columns):
+                    continue
+                record = dict(zip(telemetry_columns, ls))
+                record["job_id"] = job_id
+                record["task"] = int(record["task"])
+                record["payload"] = int(record["payload"])
+                for c in ["setup", "wall", "user", "sys"]:
+                    record[c] = float(record[c])
+                record["max_rss"] = (
+                    int(record["max_rss"]) if record["max_rss"].isdigit() else None
+                )
+                record["exit_code"] = int(record["exit_code"])
+                record["task_jobs"] = int(record["task_jobs"])
+                records.append(record)
+
+    return records
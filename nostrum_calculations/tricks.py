@@ -1,3 +1,10 @@
+import os
+import copy
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+
 def batchJobsForSingleJobs(jobs, batch_size):
     """
     Splits a list of job strings into batches of a fixed size and concatenates
@@ -26,3 +33,540 @@ def batchJobsForSingleJobs(jobs, batch_size):
         jobs_batchs[batch] = ''.join(jobs_batchs[batch])
 
     return jobs_batchs
+
+
+def mpiLayout(
+    ranks,
+    cores_per_node,
+    cpus_per_rank=1,
+    nodes=None,
+    launcher="srun",
+    mpi_type="pmix",
+):
+    """
+    Computes the SLURM task layout and launch command for an MPI job, making
+    sure the ranks are evenly distributed across whole nodes.
+
+    Parameters
+    ==========
+    ranks : int
+        Total number of MPI ranks.
+    cores_per_node : int
+        Number of cores available in each node of the cluster (e.g., 112 for MN5).
+    cpus_per_rank : int
+        Number of cores bound to each rank (OMP threads per rank).
+    nodes : int
+        Number of nodes to use. If not given, the minimum number of nodes able
+        to hold all the ranks is used.
+    launcher : str
+        MPI launcher to use ('srun' or 'mpirun').
+    mpi_type : str
+        PMI plugin passed to srun --mpi.
+
+    Returns
+    =======
+    layout : dict
+        Dictionary with the keys: nodes, ntasks, ntasks_per_node, cpus_per_task
+        and launch (the launcher command with rank-to-core binding).
+    """
+
+    available_launchers = ["srun", "mpirun"]
+    if launcher not in available_launchers:
+        raise ValueError(
+            "Wrong MPI launcher selected. Available launchers are: "
+            + ", ".join(available_launchers)
+        )
+
+    for name, value in [
+        ("ranks", ranks),
+        ("cores_per_node", cores_per_node),
+        ("cpus_per_rank", cpus_per_rank),
+    ]:
+        if not isinstance(value, int) or value < 1:
+            raise ValueError(name + " must be a positive integer")
+
+    if cpus_per_rank > cores_per_node:
+        raise ValueError(
+            "cpus_per_rank (%s) is larger than the cores in one node (%s)"
+            % (cpus_per_rank, cores_per_node)
+        )
+
+    ranks_per_node_max = cores_per_node // cpus_per_rank
+    if nodes == None:
+        nodes = -(-ranks // ranks_per_node_max)
+    elif not isinstance(nodes, int) or nodes < 1:
+        raise ValueError("nodes must be a positive integer")
+
+    if ranks % nodes != 0:
+        lower = (ranks // nodes) * nodes
+        upper = lower + nodes
+        raise ValueError(
+            "%s ranks cannot be evenly distributed across %s nodes of %s cores. "
+            "Use a multiple of %s ranks (e.g., %s or %s)."
+            % (ranks, nodes, cores_per_node, nodes, lower, upper)
+        )
+
+    ranks_per_node = ranks // nodes
+    if ranks_per_node > ranks_per_node_max:
+        raise ValueError(
+            "%s ranks per node with %s cpus per rank do not fit in a %s-core node"
+            % (ranks_per_node, cpus_per_rank, cores_per_node)
+        )
+
+    if launcher == "srun":
+        launch = (
+            "srun --mpi=" + mpi_type
+            + " --ntasks=" + str(ranks)
+            + " --ntasks-per-node=" + str(ranks_per_node)
+            + " --cpus-per-task=" + str(cpus_per_rank)
+            + " --cpu-bind=cores"
+        )
+    else:
+        launch = (
+            "mpirun -np " + str(ranks)
+            + " --map-by ppr:" + str(ranks_per_node) + ":node:PE=" + str(cpus_per_rank)
+            + " --bind-to core --report-bindings"
+        )
+
+    layout = {
+        "nodes": nodes,
+        "ntasks": ranks,
+        "ntasks_per_node": ranks_per_node,
+        "cpus_per_task": cpus_per_rank,
+        "launch": launch,
+    }
+
+    return layout
+
+
+def writeJobTable(jobs, table_file, names=None):
+    """
+    Writes a list of jobs into a single parameter table file, so an array job can
+    read the job of each index from it (see jobTableDispatch()) instead of having
+    one script per job. Each job is written verbatim after a "### JOB <index> <name>"
+    line (one-based indexes).
+
+    Parameters
+    ==========
+    jobs : list
+        List of jobs. Each job is a string representing the command to execute.
+    table_file : str
+        Path to the table file.
+    names : list
+        Optional names of the jobs, written in the index lines for reference.
+    """
+
+    if names != None and len(names) != len(jobs):
+        raise ValueError("The number of names must match the number of jobs")
+
+    with open(table_file, "w") as tf:
+        for i, job in enumerate(jobs):
+            tf.write("### JOB " + str(i + 1))
+            if names != None:
+                tf.write(" " + names[i])
+            tf.write("\n")
+            tf.write(job)
+            if not job.endswith("\n"):
+                tf.write("\n")
+
+
+def jobTableDispatch(table_file):
+    """
+    Returns the lines of an array job that extract the job of the current array
+    index from a table written with writeJobTable() and execute it.
+
+    Parameters
+    ==========
+    table_file : str
+        Path to the table file.
+
+    Returns
+    =======
+    lines : str
+    """
+
+    lines = "TASK_JOB=$(mktemp)\n"
+    lines += (
+        "awk -v id=$SLURM_ARRAY_TASK_ID '/^### JOB /{f=($3==id); next} f' "
+        + table_file
+        + " > $TASK_JOB\n"
+    )
+    lines += "source $TASK_JOB\n"
+    lines += "rm -f $TASK_JOB\n"
+
+    return lines
+
+
+def shardedScriptPath(scripts_folder, index, scripts_per_folder, script_name):
+    """
+    Returns the path of a script inside a bounded fan-out folder layout, where each
+    subfolder of scripts_folder holds at most scripts_per_folder scripts, and creates
+    the subfolder if needed.
+
+    Parameters
+    ==========
+    scripts_folder : str
+        Root folder of the scripts.
+    index : int
+        Zero-based index of the script.
+    scripts_per_folder : int
+        Maximum number of scripts per subfolder. If None, scripts_folder is used.
+    script_name : str
+        File name of the script.
+
+    Returns
+    =======
+    script_path : str
+    """
+
+    if scripts_per_folder == None:
+        return scripts_folder + "/" + script_name
+
+    if not isinstance(scripts_per_folder, int) or scripts_per_folder < 1:
+        raise ValueError("scripts_per_folder must be a positive integer")
+
+    shard_folder = scripts_folder + "/" + str(index // scripts_per_folder)
+    if not os.path.exists(shard_folder):
+        os.mkdir(shard_folder)
+
+    return shard_folder + "/" + script_name
+
+
+def _sourceFingerprint():
+    """
+    Returns the hash of the source files of this package, so scripts rendered by a
+    different version of the script generators are rendered again.
+    """
+
+    package_folder = os.path.dirname(os.path.abspath(__file__))
+    fingerprint = hashlib.md5()
+    for f in sorted(os.listdir(package_folder)):
+        if f.endswith(".py"):
+            with open(package_folder + "/" + f, "rb") as sf:
+                fingerprint.update(sf.read())
+
+    return fingerprint.hexdigest()
+
+
+def writeIfChanged(file_name, content):
+    """
+    Writes a text file only when its content changed, through a temporary file that
+    is renamed over the final path.
+
+    Parameters
+    ==========
+    file_name : str
+        Path to the file.
+    content : str
+        Content of the file.
+
+    Returns
+    =======
+    changed : bool
+        Whether the file was (re)written.
+    """
+
+    if os.path.exists(file_name):
+        with open(file_name) as f:
+            if f.read() == content:
+                return False
+
+    tmp_name = file_name + ".tmp." + str(os.getpid())
+    with open(tmp_name, "w") as f:
+        f.write(content)
+    os.replace(tmp_name, file_name)
+
+    return True
+
+
+def syncScripts(scripts, render, hash_file, workers=8):
+    """
+    Renders scripts only when their inputs changed. The hash of the inputs of each
+    script (its render() arguments and the source of this package), with the size
+    and modification time of the written script, are kept in hash_file, so the
+    unchanged scripts are detected with a single stat call, without rendering them.
+    The changed scripts are rendered in parallel with a thread pool into a temporary
+    file that replaces the final path only if its content differs, so a half-written
+    script is never submitted.
+
+    Parameters
+    ==========
+    scripts : dict
+        Dictionary with the final script paths as keys and dictionaries with the
+        keyword arguments of render() as values.
+    render : function
+        Function writing a script, called as render(script_name=path, **arguments)
+        (e.g., the singleJob() function of a cluster module).
+    hash_file : str
+        Path to the file storing the input hashes of the written scripts.
+    workers : int
+        Number of threads used to render the changed scripts.
+
+    Returns
+    =======
+    written : list
+        Paths of the scripts that were (re)written.
+    """
+
+    # Read hashes of the scripts written in previous calls
+    hashes = {}
+    if os.path.exists(hash_file):
+        with open(hash_file) as hf:
+            for line in hf:
+                ls = line.rstrip("\n").split(" ", 3)
+                if len(ls) == 4:
+                    hashes[ls[3]] = (ls[0], int(ls[1]), int(ls[2]))
+
+    fingerprint = _sourceFingerprint()
+
+    changed = []
+    for script_name, arguments in scripts.items():
+        input_hash = hashlib.md5(
+            (fingerprint + json.dumps(arguments, sort_keys=True, default=str)).encode()
+        ).hexdigest()
+        if script_name in hashes and hashes[script_name][0] == input_hash:
+            try:
+                st = os.stat(script_name)
+                if (st.st_size, st.st_mtime_ns) == hashes[script_name][1:]:
+                    continue
+            except FileNotFoundError:
+                pass
+        changed.append((script_name, input_hash))
+
+    def _render(item):
+        script_name, input_hash = item
+        tmp_name = script_name + ".tmp." + str(os.getpid())
+        # Copy the arguments, since the renderers may extend the lists they are given
+        render(script_name=tmp_name, **copy.deepcopy(scripts[script_name]))
+        with open(tmp_name, "rb") as tf:
+            content = tf.read()
+
+        written = True
+        try:
+            with open(script_name, "rb") as sf:
+                written = sf.read() != content
+        except FileNotFoundError:
+            pass
+        if written:
+            os.replace(tmp_name, script_name)
+        else:
+            os.remove(tmp_name)
+
+        st = os.stat(script_name)
+        return script_name, (input_hash, st.st_size, st.st_mtime_ns), written
+
+    written = []
+    if changed != []:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for script_name, entry, rewritten in executor.map(_render, changed):
+                hashes[script_name] = entry
+                if rewritten:
+                    written.append(script_name)
+
+    if changed != [] or not os.path.exists(hash_file):
+        with open(hash_file + ".tmp", "w") as hf:
+            for script_name in sorted(hashes):
+                input_hash, size, mtime = hashes[script_name]
+                hf.write(
+                    input_hash + " " + str(size) + " " + str(mtime) + " " + script_name + "\n"
+                )
+        os.replace(hash_file + ".tmp", hash_file)
+
+    return written
+
+
+def arrayIndexes(job_ids, n_jobs):
+    """
+    Checks a selection of one-based array IDs and returns them sorted and without
+    duplicates.
+
+    Parameters
+    ==========
+    job_ids : list
+        One-based array IDs to select.
+    n_jobs : int
+        Number of jobs of the full array.
+
+    Returns
+    =======
+    indexes : list
+    """
+
+    if isinstance(job_ids, int):
+        job_ids = [job_ids]
+
+    if not isinstance(job_ids, (list, tuple, set, range)) or len(job_ids) == 0:
+        raise ValueError("job_ids must be a non-empty list of integers")
+
+    for i in job_ids:
+        if not isinstance(i, int) or i < 1 or i > n_jobs:
+            raise ValueError(
+                "Wrong job ID " + str(i) + ". IDs must be integers from 1 to " + str(n_jobs)
+            )
+
+    return sorted(set(job_ids))
+
+
+def compressArrayIndexes(indexes):
+    """
+    Returns the SLURM range spec of a list of array IDs, merging consecutive IDs
+    into ranges (e.g., [1, 2, 3, 4, 5, 9, 12, 13] -> "1-5,9,12-13").
+
+    Parameters
+    ==========
+    indexes : list
+        Array IDs.
+
+    Returns
+    =======
+    spec : str
+    """
+
+    return ",".join(_arrayRanges(indexes))
+
+
+def _arrayRanges(indexes):
+    indexes = sorted(set(indexes))
+    ranges = []
+    start = None
+    for i in indexes:
+        if start == None:
+            start = previous = i
+        elif i == previous + 1:
+            previous = i
+        else:
+            ranges.append(str(start) if start == previous else str(start) + "-" + str(previous))
+            start = previous = i
+    if start != None:
+        ranges.append(str(start) if start == previous else str(start) + "-" + str(previous))
+    return ranges
+
+
+def splitArrayIndexes(indexes, max_length=1000):
+    """
+    Returns the SLURM range specs of a list of array IDs, split into several specs
+    of at most max_length characters so each one fits in a single --array option.
+
+    Parameters
+    ==========
+    indexes : list
+        Array IDs.
+    max_length : int
+        Maximum length of each spec.
+
+    Returns
+    =======
+    specs : list
+    """
+
+    specs = []
+    spec = ""
+    for r in _arrayRanges(indexes):
+        if spec != "" and len(spec) + 1 + len(r) > max_length:
+            specs.append(spec)
+            spec = ""
+        spec = r if spec == "" else spec + "," + r
+    if spec != "":
+        specs.append(spec)
+
+    return specs
+
+
+def splitScriptName(script_name, n):
+    """
+    Returns the name of the n-th part (one-based) of a split array script (see
+    splitArrayScript()).
+
+    Parameters
+    ==========
+    script_name : str
+        Path to the array script.
+    n : int
+        Part number.
+
+    Returns
+    =======
+    part_script : str
+    """
+
+    if n == 1:
+        return script_name
+
+    return os.path.splitext(script_name)[0] + "_" + str(n) + ".sh"
+
+
+def splitArrayScript(script_name, array_specs):
+    """
+    Writes a copy of an array script for each additional array spec, changing its
+    --array option, so an array whose spec is too long for a single submission is
+    submitted as several arrays keeping the original array IDs. The copies are
+    named <script>_<n>.sh, starting from n=2 (the given script keeps the first spec).
+
+    Parameters
+    ==========
+    script_name : str
+        Path to the array script.
+    array_specs : list
+        Array specs (see splitArrayIndexes()). The script must contain the first one.
+
+    Returns
+    =======
+    scripts : list
+        Paths of all the scripts (including the given one).
+    """
+
+    with open(script_name) as sf:
+        script = sf.read()
+
+    array_line = "#SBATCH --array=" + array_specs[0] + "\n"
+    if array_line not in script:
+        raise ValueError("The script does not contain the array spec " + array_specs[0])
+
+    scripts = [script_name]
+    for n, spec in enumerate(array_specs[1:], 2):
+        part_script = splitScriptName(script_name, n)
+        with open(part_script, "w") as sf:
+            sf.write(script.replace(array_line, "#SBATCH --array=" + spec + "\n", 1))
+        scripts.append(part_script)
+
+    print(
+        "The array spec is too long for a single submission. The array was split into "
+        + str(len(scripts))
+        + " scripts: "
+        + ", ".join(scripts)
+    )
+
+    return scripts
+
+
+def expandArrayIndexes(spec):
+    """
+    Returns the array IDs of a SLURM range spec (e.g., "1-5,9,12-40:2%10"),
+    ignoring the %N throttle.
+
+    Parameters
+    ==========
+    spec : str
+        Array spec.
+
+    Returns
+    =======
+    indexes : list
+    """
+
+    spec = spec.split("%")[0]
+    indexes = []
+    for r in spec.split(","):
+        if r == "":
+            continue
+        step = 1
+        if ":" in r:
+            r, step = r.split(":")
+            step = int(step)
+        if "-" in r:
+            start, end = r.split("-")
+            indexes += list(range(int(start), int(end) + 1, step))
+        else:
+            indexes.append(int(r))
+
+    return indexes
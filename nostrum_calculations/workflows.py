@@ -0,0 +1,460 @@
+import os
+import re
+import fnmatch
+
+
+def proteinMPNNBatchJobs(
+    input_pdbs,
+    output_folder,
+    proteinmpnn_path,
+    batch_size=100,
+    batch_folder="proteinmpnn_batches",
+    extra_arguments=None,
+):
+    """
+    Groups many ProteinMPNN backbone inputs into batches, so each array task loads
+    the model (and initialises CUDA) only once and streams through all the inputs
+    of its batch. The returned jobs are meant to be given to jobArrays() with
+    program="proteinmpnn" (one array task per batch).
+
+    Each batch job only parses the inputs that do not have a sequence file yet in
+    the output folder, so a re-queued or relaunched task resumes from the inputs
+    still missing instead of starting the whole batch again. ProteinMPNN writes into
+    a temporary folder of the batch and its outputs are moved into the output folder
+    only when it succeeds, so the files left truncated by a killed run are redone.
+
+    Parameters
+    ==========
+    input_pdbs : list
+        Paths to the backbone PDB files to design.
+    output_folder : str
+        ProteinMPNN output folder shared by all batches (results are written per
+        input at output_folder/seqs/<input_name>.fa).
+    proteinmpnn_path : str
+        Path to the ProteinMPNN repository (containing protein_mpnn_run.py).
+    batch_size : int
+        Number of inputs processed by each array task.
+    batch_folder : str
+        Folder where the per-batch input lists and parsed inputs are written.
+    extra_arguments : str
+        Additional arguments given to protein_mpnn_run.py (e.g., "--num_seq_per_target 8").
+
+    Returns
+    =======
+    jobs : list
+        List of jobs, one per batch.
+    """
+
+    if isinstance(input_pdbs, str):
+        input_pdbs = [input_pdbs]
+
+    if input_pdbs == []:
+        raise ValueError("The input_pdbs list is empty!")
+
+    if not isinstance(batch_size, int) or batch_size < 1:
+        raise ValueError("batch_size must be a positive integer")
+
+    if extra_arguments == None:
+        extra_arguments = ""
+
+    if not os.path.exists(batch_folder):
+        os.mkdir(batch_folder)
+
+    n_batches = -(-len(input_pdbs) // batch_size)
+    zf = len(str(n_batches))
+
+    jobs = []
+    for b in range(n_batches):
+        batch_name = batch_folder + "/batch_" + str(b + 1).zfill(zf)
+        if not os.path.exists(batch_name):
+            os.mkdir(batch_name)
+
+        with open(batch_name + "/inputs.txt", "w") as bf:
+            for pdb in input_pdbs[b * batch_size : (b + 1) * batch_size]:
+                bf.write(os.path.abspath(pdb) + "\n")
+
+        job = "BATCH=" + batch_name + "\n"
+        job += "rm -rf $BATCH/pdbs $BATCH/parsed.jsonl\n"
+        job += "mkdir -p $BATCH/pdbs\n"
+        job += "while read pdb; do\n"
+        job += "    name=$(basename $pdb .pdb)\n"
+        job += "    if [ ! -s " + output_folder + "/seqs/$name.fa ]; then\n"
+        job += "        ln -s $pdb $BATCH/pdbs/$name.pdb\n"
+        job += "    fi\n"
+        job += "done < $BATCH/inputs.txt\n"
+        job += 'if [ -n "$(ls -A $BATCH/pdbs)" ]; then\n'
+        job += (
+            "python "
+            + proteinmpnn_path
+            + "/helper_scripts/parse_multiple_chains.py"
+            + " --input_path=$BATCH/pdbs"
+            + " --output_path=$BATCH/parsed.jsonl\n"
+        )
+        job += "rm -rf $BATCH/out\n"
+        job += (
+            "python "
+            + proteinmpnn_path
+            + "/protein_mpnn_run.py"
+            + " --jsonl_path $BATCH/parsed.jsonl"
+            + " --out_folder $BATCH/out"
+        )
+        if extra_arguments != "":
+            job += " " + extra_arguments
+        job += "\n"
+        job += "rc=$?\n"
+        job += "if [ $rc -eq 0 ]; then\n"
+        job += "    for f in $BATCH/out/*/*; do\n"
+        job += "        out=" + output_folder + "/$(basename $(dirname $f))\n"
+        job += "        mkdir -p $out\n"
+        job += "        mv $f $out/\n"
+        job += "    done\n"
+        job += "fi\n"
+        job += "(exit $rc)\n"
+        job += "fi\n"
+        jobs.append(job)
+
+    return jobs
+
+
+def openmmSimulationsPerGPU(atoms=None, estimate=None, atoms_per_gpu=150000, max_per_gpu=8):
+    """
+    Estimates how many OpenMM simulations can share one GPU. Small solvated systems
+    do not saturate a modern GPU, so several of them can run concurrently with
+    little loss of per-simulation speed.
+
+    Parameters
+    ==========
+    atoms : int
+        Number of atoms of the (largest) simulated system.
+    estimate : int
+        User estimate of the simulations per GPU. If given, it is used directly.
+    atoms_per_gpu : int
+        Approximate number of atoms needed to saturate one GPU.
+    max_per_gpu : int
+        Upper limit of concurrent simulations per GPU.
+
+    Returns
+    =======
+    simulations_per_gpu : int
+    """
+
+    if estimate != None:
+        if not isinstance(estimate, int) or estimate < 1:
+            raise ValueError("The estimate must be a positive integer")
+        return estimate
+
+    if atoms == None:
+        raise ValueError("You must give the number of atoms or an estimate")
+    if not isinstance(atoms, int) or atoms < 1:
+        raise ValueError("The number of atoms must be a positive integer")
+
+    return max(1, min(max_per_gpu, atoms_per_gpu // atoms))
+
+
+def openmmPackedJobs(jobs, simulations_per_gpu, gpus=1, mps=False, simulated_ns=None):
+    """
+    Packs OpenMM jobs so that each array task runs simulations_per_gpu simulations
+    concurrently on each of its allocated GPUs, optionally under a CUDA MPS daemon.
+    Each task waits for all its simulations and reports, for each one, the exit
+    code, the elapsed time and (if simulated_ns is given) the speed in ns/day.
+
+    Simulations are pinned to one GPU through CUDA_VISIBLE_DEVICES, so inside each
+    job the device index is always 0. The 'GPUID' placeholder (see
+    local.multipleGPUSimulations) is replaced accordingly.
+
+    Parameters
+    ==========
+    jobs : list
+        List of OpenMM jobs. Each job is a string representing the command to execute.
+    simulations_per_gpu : int
+        Number of concurrent simulations on each GPU (see openmmSimulationsPerGPU()).
+    gpus : int
+        Number of GPUs allocated to each array task.
+    mps : bool
+        Start a CUDA MPS daemon in each task so the simulations share the GPUs
+        without context switching.
+    simulated_ns : float
+        Simulated time of each job in ns, used to report the ns/day of each simulation.
+
+    Returns
+    =======
+    packed_jobs : list
+        List of jobs, each running up to gpus*simulations_per_gpu simulations.
+    """
+
+    if isinstance(jobs, str):
+        jobs = [jobs]
+
+    if not isinstance(simulations_per_gpu, int) or simulations_per_gpu < 1:
+        raise ValueError("simulations_per_gpu must be a positive integer")
+    if not isinstance(gpus, int) or gpus < 1:
+        raise ValueError("gpus must be a positive integer")
+
+    slots = gpus * simulations_per_gpu
+
+    packed_jobs = []
+    for p in range(0, len(jobs), slots):
+        pj = 'GPUS=(${CUDA_VISIBLE_DEVICES//,/ })\n'
+        if mps:
+            pj += "export CUDA_MPS_PIPE_DIRECTORY=/tmp/mps_pipe_${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID}\n"
+            pj += "export CUDA_MPS_LOG_DIRECTORY=/tmp/mps_log_${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID}\n"
+            pj += "mkdir -p $CUDA_MPS_PIPE_DIRECTORY $CUDA_MPS_LOG_DIRECTORY\n"
+            pj += "nvidia-cuda-mps-control -d\n"
+        pj += "pids=()\n"
+
+        for s, job in enumerate(jobs[p : p + slots]):
+            sim = p + s + 1
+            job = job.replace("GPUID", "0")
+            if not job.endswith("\n"):
+                job += "\n"
+            pj += "(\n"
+            pj += "export CUDA_VISIBLE_DEVICES=${GPUS[" + str(s % gpus) + "]}\n"
+            pj += "start=$(date +%s)\n"
+            pj += job
+            pj += "rc=$?\n"
+            pj += "elapsed=$(( $(date +%s) - start ))\n"
+            if simulated_ns != None:
+                pj += (
+                    "nsday=$(awk -v t=$elapsed 'BEGIN {if (t > 0) printf \"%.2f\", "
+                    + str(simulated_ns)
+                    + "*86400/t; else print \"nan\"}')\n"
+                )
+                pj += (
+                    'echo "Simulation ' + str(sim)
+                    + ': exit code $rc, $elapsed s, $nsday ns/day"\n'
+                )
+            else:
+                pj += 'echo "Simulation ' + str(sim) + ': exit code $rc, $elapsed s"\n'
+            pj += "exit $rc\n"
+            pj += ") &\n"
+            pj += "pids+=($!)\n"
+
+        pj += "failed=0\n"
+        pj += 'for pid in "${pids[@]}"; do\n'
+        pj += "    wait $pid || failed=$((failed + 1))\n"
+        pj += "done\n"
+        if mps:
+            pj += "echo quit | nvidia-cuda-mps-control\n"
+        pj += 'echo "$failed simulation(s) failed"\n'
+        pj += "[ $failed -eq 0 ]\n"
+        packed_jobs.append(pj)
+
+    return packed_jobs
+
+
+def _naturalKey(name):
+    """
+    Sort key comparing the numbers in a name as integers (fep_2 before fep_10).
+    """
+
+    return [int(t) if t.isdigit() else t for t in re.split(r"(\d+)", name)]
+
+
+def q6FEPJobs(
+    fep_folder,
+    qdyn_command="srun Qdyn6p",
+    input_patterns=("relax_*.inp", "equil_*.inp", "fep_*.inp"),
+):
+    """
+    Creates Q6 FEP jobs from a FEP folder with the layout:
+
+        fep_folder/<mutation>/<replica>/*.inp
+
+    Mutations and replicas are independent, so each (mutation, replica) pair becomes
+    one job (i.e., one array index when given to jobArrays() with program="Q6"). The
+    lambda windows of each replica are run in sequence inside its job, ordered by
+    input_patterns and then by name (numbers compared as integers, so fep_2 runs
+    before fep_10). A marker file (<input>.done) is written after each window
+    finishes successfully, so a re-queued task restarts from the first window not
+    completed. If a window fails, the remaining windows of that replica
+    are not run.
+
+    Parameters
+    ==========
+    fep_folder : str
+        Path to the FEP folder.
+    qdyn_command : str
+        Command used to run each window (the input file is given as argument).
+    input_patterns : tuple
+        Glob patterns of the window inputs in the order they must be run.
+
+    Returns
+    =======
+    jobs : list
+        List of jobs, one per (mutation, replica) pair.
+    """
+
+    if not os.path.isdir(fep_folder):
+        raise ValueError("FEP folder not found: " + fep_folder)
+
+    if isinstance(input_patterns, str):
+        input_patterns = [input_patterns]
+
+    jobs = []
+    for mutation in sorted(os.listdir(fep_folder), key=_naturalKey):
+        mutation_folder = os.path.join(fep_folder, mutation)
+        if not os.path.isdir(mutation_folder):
+            continue
+
+        for replica in sorted(os.listdir(mutation_folder), key=_naturalKey):
+            replica_folder = os.path.join(mutation_folder, replica)
+            if not os.path.isdir(replica_folder):
+                continue
+
+            inputs = sorted(
+                [f for f in os.listdir(replica_folder) if f.endswith(".inp")],
+                key=_naturalKey,
+            )
+            windows = []
+            for pattern in input_patterns:
+                windows += [f for f in fnmatch.filter(inputs, pattern) if f not in windows]
+
+            if windows == []:
+                continue
+
+            job = "(\n"
+            job += "cd " + os.path.abspath(replica_folder) + "\n"
+            job += "for inp in " + " ".join(windows) + "; do\n"
+            job += "    if [ -f $inp.done ]; then\n"
+            job += "        continue\n"
+            job += "    fi\n"
+            job += "    " + qdyn_command + " $inp > ${inp%.inp}.log || exit 1\n"
+            job += "    touch $inp.done\n"
+            job += "done\n"
+            job += ")\n"
+            jobs.append(job)
+
+    if jobs == []:
+        raise ValueError("No replica folders with Q6 inputs were found in " + fep_folder)
+
+    return jobs
+
+
+def bioemuSplitJobs(
+    sequence,
+    num_samples,
+    output_folder,
+    splits,
+    gpus=1,
+    cache_embeds_dir=None,
+    base_seed=0,
+    extra_arguments=None,
+):
+    """
+    Splits a BioEmu sampling of num_samples into several processes, each with a
+    distinct seed and its own output subfolder (output_folder/split_<n>). The splits
+    are distributed in jobs running gpus splits concurrently (one per GPU), so the
+    jobs can be given to jobArrays() with program="bioemu" (one array task per job)
+    or, with gpus equal to the GPUs of one node, run within a single job.
+
+    All splits share the same ColabFold embedding cache. The embeddings are computed
+    under a file lock before sampling, so only the first process computes them and
+    the rest read them from the cache. Use bioemuMergeJob() to concatenate the
+    trajectories once all the splits have finished.
+
+    Parameters
+    ==========
+    sequence : str
+        Protein sequence to sample.
+    num_samples : int
+        Total number of samples.
+    output_folder : str
+        Folder where the split subfolders are written.
+    splits : int
+        Number of processes to split the samples into.
+    gpus : int
+        Number of GPUs (i.e., concurrent splits) of each job.
+    cache_embeds_dir : str
+        Shared ColabFold embeddings cache (output_folder/embeds_cache by default).
+    base_seed : int
+        Seed of the first split. Each following split starts at the seed of the
+        previous one plus its number of samples, so if bioemu derives the seed of
+        each sample from the base seed plus its offset, the splits never share seeds.
+    extra_arguments : str
+        Additional arguments given to bioemu.sample.
+
+    Returns
+    =======
+    jobs : list
+        List of jobs.
+    """
+
+    for name, value in [("num_samples", num_samples), ("splits", splits), ("gpus", gpus)]:
+        if not isinstance(value, int) or value < 1:
+            raise ValueError(name + " must be a positive integer")
+
+    if splits > num_samples:
+        print("The number of splits is larger than the number of samples.")
+        splits = num_samples
+        print("Using %s splits" % splits)
+
+    if cache_embeds_dir == None:
+        cache_embeds_dir = output_folder + "/embeds_cache"
+
+    if extra_arguments == None:
+        extra_arguments = ""
+
+    zf = len(str(splits))
+    split_samples = [num_samples // splits] * splits
+    for s in range(num_samples % splits):
+        split_samples[s] += 1
+
+    # Stride the seeds by the samples of the previous splits
+    split_seeds = [base_seed + sum(split_samples[:s]) for s in range(splits)]
+
+    jobs = []
+    for j in range(0, splits, gpus):
+        job = "mkdir -p " + cache_embeds_dir + "\n"
+        job += "flock " + cache_embeds_dir + "/.lock python -c "
+        job += (
+            '"from bioemu.get_embeds import get_colabfold_embeds; '
+            + "get_colabfold_embeds('" + sequence + "', '" + cache_embeds_dir + "')\"\n"
+        )
+        job += 'GPUS=(${CUDA_VISIBLE_DEVICES//,/ })\n'
+        job += "pids=()\n"
+        for g, s in enumerate(range(j, min(j + gpus, splits))):
+            split_folder = output_folder + "/split_" + str(s + 1).zfill(zf)
+            job += "CUDA_VISIBLE_DEVICES=${GPUS[" + str(g) + "]} "
+            job += "python -m bioemu.sample"
+            job += " --sequence " + sequence
+            job += " --num_samples " + str(split_samples[s])
+            job += " --output_dir " + split_folder
+            job += " --cache_embeds_dir " + cache_embeds_dir
+            job += " --base_seed " + str(split_seeds[s])
+            if extra_arguments != "":
+                job += " " + extra_arguments
+            job += " &\n"
+            job += "pids+=($!)\n"
+        job += "failed=0\n"
+        job += 'for pid in "${pids[@]}"; do\n'
+        job += "    wait $pid || failed=1\n"
+        job += "done\n"
+        job += "[ $failed = 0 ]\n"
+        jobs.append(job)
+
+    return jobs
+
+
+def bioemuMergeJob(output_folder):
+    """
+    Returns a job concatenating the trajectories of the splits written by
+    bioemuSplitJobs() into output_folder/samples.xtc (with its topology.pdb). It
+    uses mdconvert from mdtraj, available in the BioEmu environment.
+
+    Parameters
+    ==========
+    output_folder : str
+        Output folder given to bioemuSplitJobs().
+
+    Returns
+    =======
+    job : str
+    """
+
+    job = "cp $(ls " + output_folder + "/split_*/topology.pdb | head -n 1) "
+    job += output_folder + "/topology.pdb\n"
+    job += "mdconvert -f -t " + output_folder + "/topology.pdb"
+    job += " -o " + output_folder + "/samples.xtc"
+    job += " " + output_folder + "/split_*/samples.xtc\n"
+
+    return job
@@ -0,0 +1,45 @@
+from nostrum_calculations import dispatch
+from nostrum_calculations import manifest
+from nostrum_calculations import markers
+
+clusters = {
+    "mn5": {
+        "capacity": 1,
+        "job_time": 10,
+        "queue_wait": 0,
+        "options": {"partition": "gp_debug", "time": 1},
+    },
+    "amd": {
+        "capacity": 2,
+        "job_time": 10,
+        "queue_wait": 0,
+        "options": {"partition": "debug", "time": 1},
+    },
+}
+
+
+def test_throughput_plan_splits_jobs_by_capacity():
+    plan = dispatch.throughputPlan(6, clusters)
+    assert {c: p["jobs"] for c, p in plan.items()} == {"mn5": 2, "amd": 4}
+
+
+def test_repeated_commands_keep_their_markers_across_clusters(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    jobs = ["echo a\n"] * 6
+    hashes = markers.jobHashes(jobs)
+
+    dispatch.dispatchJobs(jobs, clusters)
+
+    recorded = manifest.queryJobs("campaign_manifest.db")
+    assert sorted([j["job_hash"] for j in recorded]) == sorted(hashes)
+    scripts = (tmp_path / "campaign_mn5.sh").read_text()
+    scripts += (tmp_path / "campaign_amd.sh").read_text()
+    assert all([h in scripts for h in hashes])
+
+    # Completing a job on one cluster does not complete its copies on the other
+    (tmp_path / "completion_markers" / (hashes[0] + ".done")).write_text(
+        "0 0 " + hashes[0] + "\n"
+    )
+    progress = dispatch.campaignProgress()
+    assert sum([c.get("COMPLETED", 0) for c in progress.values()]) == 1
+    assert sum([sum(c.values()) for c in progress.values()]) == 6
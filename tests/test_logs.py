@@ -0,0 +1,173 @@
+import os
+import subprocess
+
+import pytest
+
+from nostrum_calculations import logs
+from nostrum_calculations import manifest
+
+
+def test_collect_log_shards_waits_for_all_the_tasks(tmp_path):
+    log_folder = str(tmp_path / "logs")
+    logs.createLogShards(log_folder, 25, 10)
+    for index in [1, 12, 25]:
+        shard_folder = log_folder + "/" + str(index // 10)
+        with open(shard_folder + "/job_" + str(index) + "_7.out", "w") as f:
+            f.write("done\n")
+
+    states = {
+        ("7", 1): {"state": "COMPLETED", "exit_code": "0:0"},
+        ("7", 12): {"state": "FAILED", "exit_code": "1:0"},
+        ("7", 13): {"state": "PENDING", "exit_code": None},
+        ("7", 25): {"state": "RUNNING", "exit_code": None},
+    }
+
+    with pytest.raises(ValueError):
+        logs.collectLogShards(log_folder, min_age=0, remove=True)
+
+    packed = logs.collectLogShards(
+        log_folder, min_age=0, remove=True, states=states, shard_size=10
+    )
+    assert packed == [log_folder + "/0.tar.gz"]
+    assert not os.path.exists(log_folder + "/0")
+    assert os.path.exists(log_folder + "/1")
+    assert os.path.exists(log_folder + "/2")
+
+    # Without the states, the shards are packed but kept for the pending tasks
+    packed = logs.collectLogShards(log_folder, min_age=0)
+    assert packed == [log_folder + "/1.tar.gz", log_folder + "/2.tar.gz"]
+    assert os.path.exists(log_folder + "/1")
+
+
+def test_aggregated_logs_of_killed_tasks_are_kept(tmp_path):
+    log_folder = str(tmp_path / "logs")
+    logs.setUpAggregatedLogs(log_folder, "shard", 10)
+    lines = logs.aggregatedLogRedirection(log_folder, "shard", 10, flush_interval=1)
+
+    script = str(tmp_path / "task.sh")
+    with open(script, "w") as sf:
+        sf.write("#!/bin/bash\n" + lines)
+        sf.write('echo "task $SLURM_ARRAY_TASK_ID"\n')
+        sf.write('if [ $SLURM_ARRAY_TASK_ID -eq 2 ]; then sleep 2.5; kill -9 $$; fi\n')
+
+    for task in [1, 2]:
+        env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(task), SLURM_ARRAY_JOB_ID="7")
+        subprocess.run(["bash", script], env=env)
+
+    task_logs = logs.readAggregatedLogs(log_folder + "/0.log")
+    assert task_logs == {("7", 1): {"exit_code": 0, "log": "[1 out] task 1\n"}}
+    assert logs.partialLogs(log_folder) == {("7", 2): {"out": "task 2\n", "err": ""}}
+
+    # The keys are the ones of the state tables and of the manifest
+    db_file = str(tmp_path / "campaign.db")
+    manifest.recordArrayJobs(db_file, ["echo 1", "echo 2"], "mn5", script, ["1-2"])
+    manifest.setJobIDs(db_file, {script: "7"})
+    failures = {task: "ok" for task in task_logs}
+    failures.update({task: "killed" for task in logs.partialLogs(log_folder)})
+    manifest.setFailures(db_file, failures)
+    recorded = sorted(manifest.queryJobs(db_file), key=lambda j: j["array_index"])
+    assert [j["failure"] for j in recorded] == ["ok", "killed"]
+
+
+def runTask(tmp_path, lines, body, task, job_id, slurm_log):
+    """
+    Runs an array task script with its output appended to the SLURM log, as SLURM
+    does with the --output of shardedLogHeader().
+    """
+
+    script = str(tmp_path / "task.sh")
+    with open(script, "w") as sf:
+        sf.write("#!/bin/bash\n" + lines + body)
+    env = dict(
+        os.environ,
+        SLURM_ARRAY_TASK_ID=str(task),
+        SLURM_ARRAY_JOB_ID="1000",
+        SLURM_JOB_ID=str(job_id),
+    )
+    with open(slurm_log, "a") as sf:
+        subprocess.run(["bash", script], env=env, stdout=sf, stderr=sf)
+
+
+def test_scan_task_log_files(tmp_path):
+    log_folder = str(tmp_path)
+    (tmp_path / "job_1_1000.out").write_text("done\n")
+    (tmp_path / "job_2_1000.err").write_text(
+        "slurmstepd: error: *** JOB 1002 ON n1 CANCELLED AT 2024-01-01T00:00:00"
+        " DUE TO TIME LIMIT ***\n"
+    )
+    (tmp_path / "job_3_1000.err").write_text("Traceback (most recent call last):\n")
+
+    tasks = logs.scanLogFiles(log_folder)
+    assert tasks == {
+        ("1000", 1): "ok",
+        ("1000", 2): "time_limit",
+        ("1000", 3): "python_traceback",
+    }
+
+    # Unchanged files are taken from the previous scan
+    assert logs.scanLogFiles(log_folder) == tasks
+
+
+def test_scan_sharded_logs_assigns_slurm_messages_to_tasks(tmp_path):
+    log_folder = str(tmp_path / "logs")
+    logs.createLogShards(log_folder, 3, 2)
+    lines = logs.shardedLogRedirection("job", log_folder, 2)
+    slurm_log = log_folder + "/job_1000.slurm"
+    for task in [1, 2, 3]:
+        runTask(tmp_path, lines, 'echo "task"\n', task, 1000 + task, slurm_log)
+
+    with open(slurm_log, "a") as sf:
+        sf.write(
+            "slurmstepd: error: *** JOB 1002 ON n1 CANCELLED AT 2024-01-01T00:00:00"
+            " DUE TO TIME LIMIT ***\n"
+        )
+        sf.write(
+            "slurmstepd: error: Detected 1 oom_kill event in StepId=1003.batch."
+            " Some of the step tasks have been OOM Killed.\n"
+        )
+
+    tasks = logs.scanLogFiles(log_folder)
+    assert tasks == {
+        ("1000", 1): "ok",
+        ("1000", 2): "time_limit",
+        ("1000", 3): "out_of_memory",
+    }
+
+
+def test_scan_aggregated_logs_through_their_index(tmp_path):
+    log_folder = str(tmp_path / "logs")
+    logs.setUpAggregatedLogs(log_folder, "shard", 10)
+    lines = logs.aggregatedLogRedirection(log_folder, "shard", 10, flush_interval=1)
+    slurm_log = log_folder + "/job_1000.slurm"
+
+    runTask(tmp_path, lines, 'echo "task"\n', 1, 1001, slurm_log)
+    runTask(
+        tmp_path,
+        lines,
+        'echo "Traceback (most recent call last):" >&2\nexit 1\n',
+        2,
+        1002,
+        slurm_log,
+    )
+    runTask(tmp_path, lines, 'echo "task"\n', 3, 1003, slurm_log)
+    runTask(
+        tmp_path,
+        lines,
+        'echo "MemoryError"\nsleep 1.5\nkill -9 $$\n',
+        4,
+        1004,
+        slurm_log,
+    )
+    with open(slurm_log, "a") as sf:
+        sf.write(
+            "slurmstepd: error: *** JOB 1003 ON n1 CANCELLED AT 2024-01-01T00:00:00"
+            " ***\n"
+        )
+
+    tasks = logs.scanLogFiles(log_folder)
+    assert tasks == {
+        ("1000", 1): "ok",
+        ("1000", 2): "python_traceback",
+        ("1000", 3): "cancelled",
+        ("1000", 4): "out_of_memory",
+    }
@@ -0,0 +1,35 @@
+from nostrum_calculations import manifest
+
+
+def test_manifest_follows_the_jobs_from_generation_to_failure(tmp_path):
+    db_file = str(tmp_path / "campaign.db")
+    script = str(tmp_path / "run.sh")
+    commands = ["echo " + str(i) for i in range(3)]
+
+    manifest.recordArrayJobs(db_file, commands, "mn5", script, ["1-3"])
+    jobs = manifest.queryJobs(db_file)
+    assert [j["array_index"] for j in jobs] == [1, 2, 3]
+    assert set([j["state"] for j in jobs]) == {"generated"}
+    assert set([j["failure"] for j in jobs]) == {None}
+
+    manifest.setJobIDs(db_file, {script: "1000"})
+    manifest.updateStates(
+        db_file,
+        {
+            ("1000", 1): {"state": "COMPLETED"},
+            ("1000", 2): {"state": "TIMEOUT"},
+            ("1000", 3): {"state": "RUNNING"},
+        },
+    )
+    manifest.setFailures(db_file, {("1000", 2): "time_limit"})
+
+    assert manifest.failedJobs(db_file) == ["echo 1"]
+    failed = manifest.queryJobs(db_file, failures="time_limit")
+    assert [(j["job_id"], j["state"]) for j in failed] == [("1000", "TIMEOUT")]
+
+    # Regenerating the script resets its jobs
+    manifest.recordArrayJobs(db_file, commands, "mn5", script, ["1-3"])
+    jobs = manifest.queryJobs(db_file)
+    assert len(jobs) == 3
+    assert set([j["state"] for j in jobs]) == {"generated"}
+    assert set([j["job_id"] for j in jobs]) == {None}
@@ -0,0 +1,80 @@
+import subprocess
+
+from nostrum_calculations import markers
+from nostrum_calculations import manifest
+
+
+def runJobs(jobs, tmp_path):
+    script = tmp_path / "jobs.sh"
+    script.write_text("".join(jobs))
+    subprocess.run(["bash", str(script)], check=True, cwd=str(tmp_path))
+
+
+def test_repeated_commands_get_their_own_markers(tmp_path, capsys):
+    marker_folder = str(tmp_path / "markers")
+    jobs = ["echo run >> runs.txt\n", "echo other\n", "echo run >> runs.txt\n"]
+
+    hashes = markers.jobHashes(jobs)
+    assert hashes[0] == markers.jobHash(jobs[0])
+    assert len(set(hashes)) == 3
+
+    runJobs(markers.markJobs(jobs, marker_folder), tmp_path)
+    assert "repeat an earlier command" in capsys.readouterr().out
+    assert (tmp_path / "runs.txt").read_text() == "run\nrun\n"
+    assert sorted(markers.completedJobs(marker_folder)) == sorted(hashes)
+
+    # Resubmitting skips both repetitions
+    assert markers.pendingJobs(jobs, marker_folder) == []
+    runJobs(markers.markJobs(jobs, marker_folder), tmp_path)
+    assert (tmp_path / "runs.txt").read_text() == "run\nrun\n"
+
+
+def test_pending_jobs_match_repetitions_by_occurrence(tmp_path):
+    marker_folder = str(tmp_path / "markers")
+    jobs = ["echo a\n", "echo a\n", "echo b\n"]
+
+    runJobs(markers.markJobs(jobs[:1], marker_folder), tmp_path)
+    pending, indexes = markers.pendingJobs(jobs, marker_folder, return_indexes=True)
+    assert indexes == [1, 2]
+
+
+def test_manifest_hashes_match_the_markers(tmp_path):
+    db_file = str(tmp_path / "campaign.db")
+    jobs = ["echo a\n", "echo a\n", "echo b\n"]
+
+    manifest.recordArrayJobs(db_file, jobs, "mn5", str(tmp_path / "run.sh"), ["1-3"])
+    recorded = sorted(manifest.queryJobs(db_file), key=lambda j: j["array_index"])
+    assert [j["job_hash"] for j in recorded] == markers.jobHashes(jobs)
+
+
+def test_resubmitted_repetitions_keep_their_markers(tmp_path, monkeypatch):
+    from nostrum_calculations import mn5
+
+    monkeypatch.chdir(tmp_path)
+    marker_folder = str(tmp_path / "markers")
+    jobs = ["echo a\n", "echo a\n", "echo b\n"]
+    hashes = markers.jobHashes(jobs)
+
+    # Only the first copy of the repeated command completed
+    runJobs(markers.markJobs(jobs[:1], marker_folder), tmp_path)
+    pending, pending_hashes = markers.pendingJobs(
+        jobs, marker_folder, return_hashes=True
+    )
+    assert pending == jobs[1:]
+    assert pending_hashes == hashes[1:]
+
+    mn5.jobArrays(
+        pending,
+        job_name="test",
+        partition="gp_debug",
+        time=1,
+        completion_markers=True,
+        marker_folder=marker_folder,
+        hashes=pending_hashes,
+        manifest_db="campaign.db",
+    )
+    script = (tmp_path / "slurm_array.sh").read_text()
+    assert hashes[0] not in script
+    assert hashes[1] in script and hashes[2] in script
+    recorded = manifest.queryJobs("campaign.db")
+    assert sorted([j["job_hash"] for j in recorded]) == sorted(hashes[1:])
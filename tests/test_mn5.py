@@ -0,0 +1,81 @@
+import re
+
+import pytest
+
+from nostrum_calculations import manifest
+from nostrum_calculations import mn5
+
+
+def test_jobs_range_refers_to_the_jobs_list_when_packing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    jobs = ["echo job" + str(i) + "\n" for i in range(12)]
+
+    mn5.jobArrays(
+        jobs,
+        job_name="md",
+        partition="acc_bscls",
+        time=1,
+        program="openmm",
+        simulations_per_gpu=2,
+        gpus=1,
+        jobs_range=(3, 6),
+        manifest_db="campaign.db",
+    )
+    script = (tmp_path / "slurm_array.sh").read_text()
+    assert re.findall(r"job\d+", script) == ["job2", "job3", "job4", "job5"]
+    assert "#SBATCH --array=1-2\n" in script
+
+    recorded = manifest.queryJobs("campaign.db")
+    assert [(j["command"], j["array_index"]) for j in recorded] == [
+        ("echo job2\n", 1),
+        ("echo job3\n", 1),
+        ("echo job4\n", 2),
+        ("echo job5\n", 2),
+    ]
+
+
+def test_grouped_commands_share_the_index_and_failure_of_their_task(
+    tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    jobs = ["echo job" + str(i) + "\n" for i in range(10)]
+
+    # Jobs 3 to 8 grouped by 4: tasks 1 (jobs 3 to 6) and 2 (jobs 7 and 8)
+    mn5.jobArrays(
+        jobs,
+        job_name="md",
+        partition="gp_bscls",
+        time=1,
+        group_jobs_by=4,
+        jobs_range=(3, 8),
+        manifest_db="campaign.db",
+    )
+    assert "#SBATCH --array=1-2\n" in (tmp_path / "slurm_array.sh").read_text()
+
+    recorded = manifest.queryJobs("campaign.db")
+    assert [(j["command"], j["array_index"]) for j in recorded] == [
+        ("echo job2\n", 1),
+        ("echo job3\n", 1),
+        ("echo job4\n", 1),
+        ("echo job5\n", 1),
+        ("echo job6\n", 2),
+        ("echo job7\n", 2),
+    ]
+
+    manifest.setJobIDs("campaign.db", {"slurm_array.sh": "1000"})
+    manifest.setFailures("campaign.db", {("1000", 2): "time_limit"})
+    failed = manifest.queryJobs("campaign.db", failures="time_limit")
+    assert [j["command"] for j in failed] == ["echo job6\n", "echo job7\n"]
+
+
+def test_mpi_ranks_require_mpi(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(ValueError):
+        mn5.jobArrays(
+            ["$MPIRUN python script.py\n"],
+            job_name="design",
+            partition="gp_debug",
+            program="pyrosetta",
+            mpi_ranks=224,
+        )
+    assert not (tmp_path / "slurm_array.sh").exists()
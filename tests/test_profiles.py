@@ -0,0 +1,85 @@
+import pytest
+
+from nostrum_calculations import profiles
+
+
+def test_select_partition_regroups_to_fit_the_time_limit():
+    partition, group = profiles.selectPartition(
+        "mn5", 20 * 60, 40, partitions=["gp_debug", "gp_bscls"], group_jobs_by=4
+    )
+    assert (partition, group) == ("gp_bscls", 2)
+
+
+def test_select_partition_keeps_the_groups_of_selected_indexes():
+    partition, group = profiles.selectPartition(
+        "mn5",
+        60,
+        40,
+        partitions=["gp_debug", "gp_bscls"],
+        group_jobs_by=4,
+        regroup=False,
+    )
+    assert (partition, group) == ("gp_bscls", 4)
+
+    with pytest.raises(ValueError):
+        profiles.selectPartition(
+            "mn5",
+            20 * 60,
+            40,
+            partitions=["gp_debug", "gp_bscls"],
+            group_jobs_by=4,
+            regroup=False,
+        )
+
+
+def test_select_partition_uses_cpu_partitions_for_cpu_tasks():
+    partition, group = profiles.selectPartition("bright", 60, 10, cpus=4)
+    assert profiles.partitionProfile("bright", partition)["gpus_per_node"] == 0
+
+
+def test_select_partition_strict_time_limit():
+    assert profiles.selectPartition("amd", 60 * 60, 10)[0] == "bsc_ls"
+    with pytest.raises(ValueError):
+        profiles.selectPartition("amd", 60 * 60, 10, strict=True)
+
+
+def test_auto_partition_keeps_the_time_of_each_task(tmp_path, monkeypatch):
+    from nostrum_calculations import mn5
+
+    monkeypatch.chdir(tmp_path)
+    jobs = ["echo " + str(i) + "\n" for i in range(500)]
+    mn5.jobArrays(
+        jobs, job_name="test", partition="auto", time=1, group_jobs_by=10
+    )
+    script = (tmp_path / "slurm_array.sh").read_text()
+    assert "#SBATCH --time=1:00:00\n" in script
+    assert "#SBATCH --array=1-50\n" in script
+
+    # The given groups are kept, since the time is the one of the whole task
+    mn5.jobArrays(jobs[:8], job_name="test", partition="auto", time=2, group_jobs_by=4)
+    script = (tmp_path / "slurm_array.sh").read_text()
+    assert "#SBATCH --qos=gp_debug\n" in script
+    assert "#SBATCH --array=1-2\n" in script
+
+    with pytest.raises(ValueError):
+        mn5.jobArrays(jobs, job_name="test", partition="auto", time=60)
+
+
+def test_auto_partition_sizes_grouped_tasks_from_the_history(tmp_path, monkeypatch):
+    from nostrum_calculations import mn5
+    from nostrum_calculations import sizing
+
+    monkeypatch.chdir(tmp_path)
+    sizing.addSamples("sizing_history.json", "md", "mn5", [(20 * 60, None)] * 5)
+    jobs = ["echo " + str(i) + "\n" for i in range(500)]
+    mn5.jobArrays(
+        jobs,
+        job_name="md",
+        partition="auto",
+        time="auto",
+        group_jobs_by=10,
+        sizing_options={"margin": 0},
+    )
+    script = (tmp_path / "slurm_array.sh").read_text()
+    assert "#SBATCH --time=4:00:00\n" in script
+    assert "#SBATCH --array=1-50\n" in script
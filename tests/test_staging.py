@@ -0,0 +1,39 @@
+import os
+import subprocess
+
+from nostrum_calculations import staging
+
+
+def test_environment_snapshot_replays_the_set_up(tmp_path):
+    header = "#!/bin/bash\n"
+    preamble = "unset PURGED\n"
+    preamble += "export LOADED=1\n"
+    preamble += "module() { echo module $*; }\n"
+    preamble += "export -f module\n"
+    preamble += "unset -f old_function\n"
+    body = "echo PURGED=${PURGED:-unset} LOADED=$LOADED\n"
+    body += "module load x\n"
+    body += "type -t old_function || echo no old_function\n"
+
+    script = str(tmp_path / "job.sh")
+    with open(script, "w") as sf:
+        sf.write(header + preamble + body)
+    staging.snapshotEnvironment(
+        script,
+        len(header),
+        len(header + preamble),
+        snapshot_dir=str(tmp_path / "snapshots"),
+    )
+
+    env = dict(os.environ, PURGED="1")
+    env["BASH_FUNC_old_function%%"] = "() { echo old; }"
+    outputs = []
+    for run in range(2):
+        result = subprocess.run(
+            ["bash", script], env=env, capture_output=True, text=True, check=True
+        )
+        outputs.append(result.stdout)
+
+    assert len(os.listdir(tmp_path / "snapshots")) == 1
+    assert outputs[0] == outputs[1]
+    assert outputs[1] == "PURGED=unset LOADED=1\nmodule load x\nno old_function\n"
@@ -0,0 +1,309 @@
+import os
+import sys
+import json
+import stat
+
+import pytest
+
+from nostrum_calculations import submission
+
+# Fake SLURM commands sharing a JSON queue in $FAKE_SLURM/queue.json. Failures are
+# scheduled by writing one mode per line in $FAKE_SLURM/<command>_fail: "error"
+# (rejected), "down" (controller unreachable), "ok" or, for sbatch, "timeout" (the
+# job is queued but the reply times out) and "lost" (the request times out before
+# queueing the job).
+fake_common = """
+import os, sys, json, datetime
+slurm = os.environ["FAKE_SLURM"]
+queue_file = os.path.join(slurm, "queue.json")
+queue = json.load(open(queue_file)) if os.path.exists(queue_file) else []
+command = os.path.basename(sys.argv[0])
+with open(os.path.join(slurm, command + "_calls"), "a") as cf:
+    cf.write(" ".join(sys.argv[1:]) + "\\n")
+mode = None
+fail_file = os.path.join(slurm, command + "_fail")
+if os.path.exists(fail_file):
+    modes = open(fail_file).read().split()
+    if modes != []:
+        mode = modes.pop(0)
+        open(fail_file, "w").write("\\n".join(modes))
+if mode == "error":
+    sys.stderr.write(command + ": error: Invalid account or partition\\n")
+    sys.exit(1)
+if mode == "down":
+    sys.stderr.write(command + ": error: Unable to contact slurm controller\\n")
+    sys.exit(1)
+"""
+
+fake_sbatch = """
+if mode == "lost":
+    sys.stderr.write("sbatch: error: Socket timed out on send/recv operation\\n")
+    sys.exit(1)
+script = sys.argv[-1]
+name, tasks = os.path.basename(script), 1
+for line in open(script):
+    if line.startswith("#SBATCH --job-name="):
+        name = line.split("=", 1)[1].strip()
+    if line.startswith("#SBATCH --array="):
+        first, last = line.split("=", 1)[1].strip().split("-")
+        tasks = int(last) - int(first) + 1
+job_id = str(1000 + len(queue))
+queue.append(
+    {
+        "id": job_id,
+        "name": name,
+        "tasks": tasks,
+        "state": "PENDING",
+        "submit": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+)
+json.dump(queue, open(queue_file, "w"))
+if mode == "timeout":
+    sys.stderr.write("sbatch: error: Socket timed out on send/recv operation\\n")
+    sys.exit(1)
+print(job_id)
+"""
+
+fake_squeue = """
+names = [a.split("=", 1)[1] for a in sys.argv if a.startswith("--name=")]
+for job in queue:
+    if job["state"] == "COMPLETED":
+        continue
+    if names != []:
+        if job["name"] in names:
+            print(job["id"] + "|" + job["submit"])
+    else:
+        for task in range(job["tasks"]):
+            print(job["id"] + "_" + str(task + 1))
+"""
+
+fake_sacct = """
+names = [a.split("=", 1)[1] for a in sys.argv if a.startswith("--name=")]
+for job in queue:
+    if job["name"] in names:
+        print(job["id"] + "|" + job["submit"])
+"""
+
+
+@pytest.fixture
+def slurm(tmp_path, monkeypatch):
+    """
+    Puts fake sbatch, squeue and sacct commands on the PATH and returns the folder
+    of their shared state.
+    """
+
+    slurm = tmp_path / "slurm"
+    bin_folder = slurm / "bin"
+    bin_folder.mkdir(parents=True)
+    for command, body in [
+        ("sbatch", fake_sbatch),
+        ("squeue", fake_squeue),
+        ("sacct", fake_sacct),
+    ]:
+        path = bin_folder / command
+        path.write_text("#!" + sys.executable + "\n" + fake_common + body)
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+    monkeypatch.setenv("PATH", str(bin_folder) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_SLURM", str(slurm))
+    monkeypatch.setenv("USER", "tester")
+    monkeypatch.chdir(tmp_path)
+
+    return slurm
+
+
+def writeScript(name, tasks=1):
+    with open(name, "w") as sf:
+        sf.write("#!/bin/bash\n")
+        sf.write("#SBATCH --job-name=" + name.split(".")[0] + "\n")
+        if tasks > 1:
+            sf.write("#SBATCH --array=1-" + str(tasks) + "\n")
+        sf.write("\necho done\n")
+    return name
+
+
+def readQueue(slurm):
+    return json.loads((slurm / "queue.json").read_text())
+
+
+def finishJobs(slurm):
+    queue = readQueue(slurm)
+    for job in queue:
+        job["state"] = "COMPLETED"
+    (slurm / "queue.json").write_text(json.dumps(queue))
+
+
+def sbatchCalls(slurm):
+    calls = slurm / "sbatch_calls"
+    return calls.read_text().split("\n")[:-1] if calls.exists() else []
+
+
+def test_backlog_is_throttled_by_free_slots(slurm):
+    scripts = [writeScript("job" + str(i) + ".sh", tasks=3) for i in range(3)]
+    submission.addToBacklog(scripts)
+
+    assert submission.submitFromBacklog("submission_state.json", 7) == ["1000", "1001"]
+    assert submission.submitFromBacklog("submission_state.json", 7) == []
+    assert len(sbatchCalls(slurm)) == 2
+
+    finishJobs(slurm)
+    assert submission.submitFromBacklog("submission_state.json", 7) == ["1002"]
+
+    state = submission.readSubmissionState("submission_state.json")
+    assert [s["job_id"] for s in state["backlog"]] == ["1000", "1001", "1002"]
+    assert all(["submitting" not in s for s in state["backlog"]])
+
+
+def test_headroom_counts_other_jobs_of_the_user(slurm):
+    (slurm / "queue.json").write_text(
+        json.dumps(
+            [
+                {
+                    "id": "999",
+                    "name": "other",
+                    "tasks": 5,
+                    "state": "RUNNING",
+                    "submit": "2024-01-01T00:00:00",
+                }
+            ]
+        )
+    )
+    submission.addToBacklog([writeScript("job.sh", tasks=3)])
+
+    assert submission.submitFromBacklog("submission_state.json", 7) == []
+    assert sbatchCalls(slurm) == []
+
+    submission.addToBacklog([writeScript("big.sh", tasks=8)])
+    finishJobs(slurm)
+    with pytest.raises(ValueError):
+        submission.submitFromBacklog("submission_state.json", 7)
+
+
+def test_restart_after_crash_does_not_resubmit(slurm, monkeypatch):
+    submission.addToBacklog([writeScript("job.sh")])
+
+    sbatch = submission.sbatchWithRetries
+
+    def crashAfterSbatch(*args, **kwargs):
+        sbatch(*args, **kwargs)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(submission, "sbatchWithRetries", crashAfterSbatch)
+    with pytest.raises(KeyboardInterrupt):
+        submission.submitFromBacklog("submission_state.json", 10)
+    monkeypatch.setattr(submission, "sbatchWithRetries", sbatch)
+
+    state = submission.readSubmissionState("submission_state.json")
+    assert state["backlog"][0]["job_id"] == None
+    assert state["backlog"][0]["submitting"] != None
+
+    assert submission.submitFromBacklog("submission_state.json", 10) == []
+    state = submission.readSubmissionState("submission_state.json")
+    assert state["backlog"][0]["job_id"] == "1000"
+    assert "submitting" not in state["backlog"][0]
+    assert len(sbatchCalls(slurm)) == 1
+
+
+def test_restart_finds_finished_job_in_accounting(slurm, monkeypatch):
+    submission.addToBacklog([writeScript("job.sh")])
+
+    sbatch = submission.sbatchWithRetries
+
+    def crashAfterSbatch(*args, **kwargs):
+        sbatch(*args, **kwargs)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(submission, "sbatchWithRetries", crashAfterSbatch)
+    with pytest.raises(KeyboardInterrupt):
+        submission.submitFromBacklog("submission_state.json", 10)
+    monkeypatch.setattr(submission, "sbatchWithRetries", sbatch)
+
+    finishJobs(slurm)
+    submission.submitFromBacklog("submission_state.json", 10)
+    state = submission.readSubmissionState("submission_state.json")
+    assert state["backlog"][0]["job_id"] == "1000"
+    assert len(sbatchCalls(slurm)) == 1
+
+
+def test_restart_resubmits_scripts_that_never_reached_the_queue(slurm, monkeypatch):
+    submission.addToBacklog([writeScript("job.sh")])
+
+    def crashBeforeSbatch(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    sbatch = submission.sbatchWithRetries
+    monkeypatch.setattr(submission, "sbatchWithRetries", crashBeforeSbatch)
+    with pytest.raises(KeyboardInterrupt):
+        submission.submitFromBacklog("submission_state.json", 10)
+    monkeypatch.setattr(submission, "sbatchWithRetries", sbatch)
+
+    assert submission.submitFromBacklog("submission_state.json", 10) == ["1000"]
+    assert len(sbatchCalls(slurm)) == 1
+
+
+def test_daemon_survives_failed_slurm_calls(slurm, capsys):
+    scripts = [writeScript("job" + str(i) + ".sh") for i in range(2)]
+    submission.addToBacklog(scripts)
+    (slurm / "squeue_fail").write_text("down")
+    (slurm / "sbatch_fail").write_text("error")
+
+    submission.submissionDaemon(max_jobs=10, interval=0)
+
+    output = capsys.readouterr().out
+    assert output.count("Submission failed") == 2
+    state = submission.readSubmissionState("submission_state.json")
+    assert [s["job_id"] for s in state["backlog"]] == ["1000", "1001"]
+    assert len(sbatchCalls(slurm)) == 3
+
+
+def test_manifest_is_written_after_each_submission(slurm):
+    scripts = [writeScript("job" + str(i) + ".sh") for i in range(3)]
+    (slurm / "sbatch_fail").write_text("ok ok error")
+
+    with pytest.raises(RuntimeError):
+        submission.submitScripts(scripts, workers=1, backoff=0)
+    with open("submission_manifest.json") as mf:
+        recorded = json.load(mf)
+    assert sorted([j["job_id"] for j in recorded.values()]) == ["1000", "1001"]
+
+    job_ids = submission.submitScripts(scripts, workers=1, backoff=0)
+    assert job_ids == {"job0.sh": "1000", "job1.sh": "1001", "job2.sh": "1002"}
+    assert len(sbatchCalls(slurm)) == 4
+
+
+def test_timed_out_submission_is_found_in_the_queue(slurm):
+    scripts = [writeScript("job.sh")]
+    (slurm / "sbatch_fail").write_text("timeout")
+
+    assert submission.submitScripts(scripts, backoff=0) == {"job.sh": "1000"}
+    assert len(readQueue(slurm)) == 1
+    assert len(sbatchCalls(slurm)) == 1
+
+
+def test_timed_out_submission_not_queued_is_retried(slurm):
+    scripts = [writeScript("job.sh")]
+    (slurm / "sbatch_fail").write_text("lost")
+
+    assert submission.submitScripts(scripts, backoff=0) == {"job.sh": "1000"}
+    assert len(sbatchCalls(slurm)) == 2
+
+
+def test_timeout_check_skips_jobs_of_other_scripts(slurm):
+    writeScript("job.sh")
+    os.mkdir("copy")
+    writeScript("copy/job.sh")
+    scripts = ["job.sh", "copy/job.sh"]
+    (slurm / "sbatch_fail").write_text("ok lost")
+
+    job_ids = submission.submitScripts(scripts, workers=1, backoff=0)
+    assert job_ids == {"job.sh": "1000", "copy/job.sh": "1001"}
+
+
+def test_job_ids_are_recorded_in_the_campaign_manifest(slurm):
+    from nostrum_calculations import manifest
+
+    script = os.path.abspath(writeScript("job.sh"))
+    manifest.recordJobs("campaign.db", [("echo done", "mn5", script, None)])
+
+    submission.submitScripts(["job.sh"], manifest_db="campaign.db")
+    assert [j["job_id"] for j in manifest.queryJobs("campaign.db")] == ["1000"]
@@ -0,0 +1,69 @@
+import os
+import subprocess
+
+from nostrum_calculations import sizing
+from nostrum_calculations import telemetry
+
+
+def test_records_count_the_jobs_of_each_task(tmp_path):
+    telemetry_folder = str(tmp_path / "telemetry")
+    jobs = telemetry.telemetryJobs(["true\n", "true\n", "false\n"], telemetry_folder)
+
+    script = str(tmp_path / "task.sh")
+    with open(script, "w") as sf:
+        sf.write("#!/bin/bash\n")
+        sf.write(telemetry.telemetryStart())
+        sf.write(telemetry.telemetrySetup(telemetry_folder))
+        sf.write("".join(jobs))
+    env = dict(os.environ, SLURM_ARRAY_JOB_ID="1000", SLURM_ARRAY_TASK_ID="1")
+    subprocess.run(["bash", script], env=env)
+
+    records = telemetry.readTelemetry(telemetry_folder)
+    assert [r["payload"] for r in records] == [1, 2, 3]
+    assert [r["task_jobs"] for r in records] == [1, 2, 3]
+    assert [r["exit_code"] for r in records] == [0, 0, 1]
+    assert all([r["job_id"] == "1000" and r["task"] == 1 for r in records])
+
+
+def writeRecords(telemetry_folder, task, rows):
+    os.makedirs(telemetry_folder, exist_ok=True)
+    with open(telemetry_folder + "/1000_" + str(task) + ".tsv", "w") as tf:
+        for n, (payload, setup, wall, rss) in enumerate(rows, 1):
+            values = [task, payload, "n1", setup, wall, 0, 0, rss, 0, n]
+            tf.write("\t".join([str(v) for v in values]) + "\n")
+
+
+def test_task_memory_peak_is_added_once_per_task(tmp_path):
+    telemetry_folder = str(tmp_path / "telemetry")
+    history_file = str(tmp_path / "history.json")
+
+    # The peak grows with the first job and is reported again by the next ones
+    writeRecords(telemetry_folder, 1, [(1, 0, 60, 4096000), (2, 0, 60, 4096000)])
+    writeRecords(telemetry_folder, 2, [(3, 0, 60, 1024000), (4, 0, 60, 2048000)])
+
+    assert sizing.addTelemetrySamples(history_file, telemetry_folder, "md", "mn5") == 4
+    samples = sizing.readHistory(history_file)["md|mn5|any"]
+    assert sorted([s[1] for s in samples if s[1] != None]) == [2000, 4000]
+
+
+def test_task_set_up_time_is_counted_once_per_task(tmp_path):
+    telemetry_folder = str(tmp_path / "telemetry")
+    history_file = str(tmp_path / "history.json")
+
+    # Tasks of 5 jobs of 10 minutes after a set-up of 5 minutes
+    for task in range(1, 3):
+        rows = [(5 * (task - 1) + i, 300, 600, "NA") for i in range(1, 6)]
+        writeRecords(telemetry_folder, task, rows)
+    sizing.addTelemetrySamples(history_file, telemetry_folder, "md", "mn5")
+
+    resources = sizing.suggestResources(history_file, "md", "mn5", margin=0)
+    assert resources == {"time": 10, "setup": 5, "mem_per_cpu": None}
+
+    time, mem = sizing.autoResources(
+        "md",
+        "mn5",
+        "gp_bscls",
+        sizing_options={"history_file": history_file, "margin": 0},
+        jobs_per_task=10,
+    )
+    assert time == 10 * 10 + 5
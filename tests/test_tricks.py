@@ -0,0 +1,42 @@
+from nostrum_calculations import tricks
+
+
+def test_sync_scripts_only_renders_changed_inputs(tmp_path):
+    rendered = []
+
+    def render(script_name, job):
+        rendered.append(job)
+        with open(script_name, "w") as sf:
+            sf.write("#!/bin/bash\n" + job + "\n")
+
+    scripts = {str(tmp_path / (str(i) + ".sh")): {"job": "echo " + str(i)} for i in range(3)}
+    hash_file = str(tmp_path / ".script_hashes")
+
+    assert sorted(tricks.syncScripts(scripts, render, hash_file)) == sorted(scripts)
+    assert len(rendered) == 3
+
+    rendered.clear()
+    assert tricks.syncScripts(scripts, render, hash_file) == []
+    assert rendered == []
+
+    changed = str(tmp_path / "1.sh")
+    scripts[changed] = {"job": "echo changed"}
+    assert tricks.syncScripts(scripts, render, hash_file) == [changed]
+    assert rendered == ["echo changed"]
+
+    # A script edited by hand is rendered again
+    rendered.clear()
+    with open(changed, "a") as sf:
+        sf.write("echo edited\n")
+    assert tricks.syncScripts(scripts, render, hash_file) == [changed]
+    assert rendered == ["echo changed"]
+
+
+def test_write_if_changed(tmp_path):
+    file_name = str(tmp_path / "general.sh")
+
+    assert tricks.writeIfChanged(file_name, "sbatch a.sh\n")
+    assert not tricks.writeIfChanged(file_name, "sbatch a.sh\n")
+    assert tricks.writeIfChanged(file_name, "sbatch b.sh\n")
+    with open(file_name) as f:
+        assert f.read() == "sbatch b.sh\n"
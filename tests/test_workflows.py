@@ -0,0 +1,55 @@
+import os
+import subprocess
+
+from nostrum_calculations import workflows
+
+parse_script = """import argparse, os
+parser = argparse.ArgumentParser()
+parser.add_argument("--input_path")
+parser.add_argument("--output_path")
+args = parser.parse_args()
+with open(args.output_path, "w") as of:
+    for f in sorted(os.listdir(args.input_path)):
+        of.write(f[:-4] + "\\n")
+"""
+
+# Writes the sequences of each input and, if FAIL is set, dies after a partial one
+run_script = """import argparse, os, sys
+parser = argparse.ArgumentParser()
+parser.add_argument("--jsonl_path")
+parser.add_argument("--out_folder")
+args = parser.parse_args()
+os.makedirs(args.out_folder + "/seqs", exist_ok=True)
+for name in open(args.jsonl_path).read().split():
+    with open(args.out_folder + "/seqs/" + name + ".fa", "w") as of:
+        of.write(">" + name + "\\n")
+        if os.environ.get("FAIL"):
+            sys.exit(1)
+        of.write("MKV\\n")
+"""
+
+
+def test_killed_batches_leave_no_truncated_outputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mpnn = tmp_path / "ProteinMPNN"
+    (mpnn / "helper_scripts").mkdir(parents=True)
+    (mpnn / "helper_scripts" / "parse_multiple_chains.py").write_text(parse_script)
+    (mpnn / "protein_mpnn_run.py").write_text(run_script)
+    pdbs = []
+    for name in ["a", "b"]:
+        (tmp_path / (name + ".pdb")).write_text("END\n")
+        pdbs.append(name + ".pdb")
+
+    jobs = workflows.proteinMPNNBatchJobs(pdbs, "out", str(mpnn), batch_size=2)
+    assert len(jobs) == 1
+
+    failed = subprocess.run(
+        ["bash", "-c", jobs[0]], cwd=str(tmp_path), env=dict(os.environ, FAIL="1")
+    )
+    assert failed.returncode == 1
+    assert not (tmp_path / "out" / "seqs" / "a.fa").exists()
+
+    subprocess.run(["bash", "-c", jobs[0]], cwd=str(tmp_path), check=True)
+    for name in ["a", "b"]:
+        fa = tmp_path / "out" / "seqs" / (name + ".fa")
+        assert fa.read_text() == ">" + name + "\nMKV\n"